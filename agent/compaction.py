@@ -0,0 +1,122 @@
+import asyncio
+import contextvars
+import logging
+from typing import Awaitable, Callable
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import BaseMessage, HumanMessage, RemoveMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# (messages to fold in, previous summary) -> new summary
+Summarizer = Callable[[list[BaseMessage], str], Awaitable[str]]
+
+SUMMARY_PROMPT = """Condense the conversation below between a user and their scheduling assistant into a short summary.
+Keep facts that later turns may depend on: names, dates, times, event IDs, decisions and open requests.
+Do not add anything that is not in the conversation.
+
+{previous}Conversation:
+{conversation}"""
+
+class ModelSummarizer:
+    """Summarizer backed by a chat model, typically a cheaper one than the agent's."""
+    def __init__(self, model: BaseChatModel):
+        self.model = model
+
+    async def __call__(self, messages: list[BaseMessage], summary: str = None) -> str:
+        previous = f"Summary so far:\n{summary}\n\n" if summary else ""
+        conversation = "\n".join(f"{m.type}: {m.text()}" for m in messages if m.text())
+        resp = await self.model.ainvoke(SUMMARY_PROMPT.format(previous=previous, conversation=conversation))
+        return resp.text()
+
+
+class Compactor:
+    """
+    Graph node that keeps a thread's history under a token budget.
+    Once the history grows past `budget` tokens, everything but the most recent `keep` tokens
+    is folded into a rolling summary (kept in `state["summary"]`) and removed from the
+    checkpointed messages. With `defer` on, the summary is prepared in the background after a
+    turn that ends above `defer_threshold` of the budget, and the next turn just applies it,
+    so the model call never waits on summarization.
+    :param summarizer: async callable (messages, previous summary) -> summary
+    :param budget: token budget for the messages sent to the model
+    :param keep: tokens of recent history always kept verbatim
+    :param token_counter: callable counting the tokens of a message list
+    """
+    def __init__(
+            self,
+            summarizer: Summarizer,
+            budget: int = 16000,
+            keep: int = 6000,
+            defer: bool = True,
+            defer_threshold: float = 0.8,
+            token_counter: Callable[[list[BaseMessage]], int] = count_tokens_approximately):
+        self.summarizer = summarizer
+        self.budget = budget
+        self.keep = keep
+        self.defer = defer
+        self.defer_threshold = defer_threshold
+        self.token_counter = token_counter
+        self._pending = TTLCache(maxsize=4096, ttl=3600) # thread_id -> (summary, ids it covers)
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    def split(self, messages: list[BaseMessage]) -> int:
+        """Index of the first message kept verbatim. The kept part always starts at a user turn,
+        so a tool call is never separated from its result."""
+        kept_tokens = 0
+        index = len(messages)
+        for i in range(len(messages) - 1, -1, -1):
+            kept_tokens += self.token_counter([messages[i]])
+            if kept_tokens > self.keep:
+                break
+            index = i
+        while index < len(messages) and not isinstance(messages[index], HumanMessage):
+            index += 1
+        if index == len(messages): # a single turn over `keep`, keep the whole last turn
+            index = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
+        return index
+
+    def _compacted(self, summary: str, removed: list[BaseMessage]) -> dict:
+        return {"summary": summary, "messages": [RemoveMessage(id=m.id) for m in removed]}
+
+    async def __call__(self, state: dict) -> dict: # graph `compact` node
+        thread_id = state.get("thread_id")
+        messages = state["messages"]
+        pending = self._pending.pop(thread_id, None)
+        if pending is not None:
+            summary, covered = pending
+            ids = {m.id for m in messages}
+            if covered <= ids: # history hasn't been rewritten since the summary was made
+                return self._compacted(summary, [m for m in messages if m.id in covered])
+
+        if self.token_counter(messages) <= self.budget:
+            return {}
+        index = self.split(messages)
+        if index == 0:
+            return {}
+        summary = await self.summarizer(messages[:index], state.get("summary"))
+        return self._compacted(summary, messages[:index])
+
+    def schedule(self, thread_id: str, state: dict):
+        """Prepare the next compaction in the background, call after a turn's response is sent."""
+        if not self.defer or thread_id in self._tasks:
+            return
+        messages = state.get("messages", [])
+        if self.token_counter(messages) <= self.budget * self.defer_threshold:
+            return
+        index = self.split(messages)
+        if index == 0:
+            return
+        # a fresh context: the turn's callbacks would stream the summarizer's tokens to the user
+        task = asyncio.create_task(self._prepare(thread_id, messages[:index], state.get("summary")), context=contextvars.Context())
+        self._tasks[thread_id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(thread_id, None))
+
+    async def _prepare(self, thread_id: str, messages: list[BaseMessage], summary: str):
+        try:
+            new_summary = await self.summarizer(messages, summary)
+        except Exception as e:
+            logger.warning("background compaction of thread %s failed: %r", thread_id, e)
+            return
+        self._pending.set(thread_id, (new_summary, {m.id for m in messages}))
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+from google.ai import generativelanguage_v1beta as glm
+from google.api_core.exceptions import GoogleAPICallError, NotFound
+from google.protobuf import duration_pb2, field_mask_pb2
+from langchain_core.messages import AIMessage
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+logger = logging.getLogger(__name__)
+
+TYPES = {
+    "string": glm.Type.STRING,
+    "number": glm.Type.NUMBER,
+    "integer": glm.Type.INTEGER,
+    "boolean": glm.Type.BOOLEAN,
+    "array": glm.Type.ARRAY,
+    "object": glm.Type.OBJECT
+}
+
+def _schema(schema: dict) -> glm.Schema:
+    """A JSON schema as the Gemini API's Schema, an anyOf with null is a nullable field."""
+    options = schema.get("anyOf", [])
+    variants = [option for option in options if option.get("type") != "null"]
+    if len(variants) == 1: # Optional[X]
+        schema = {**variants[0], **{k: v for k, v in schema.items() if k != "anyOf"}}
+        variants = []
+    fields = {}
+    if len(variants) < len(options):
+        fields["nullable"] = True
+    if variants:
+        fields["any_of"] = [_schema(variant) for variant in variants]
+    elif schema.get("type") in TYPES:
+        fields["type_"] = TYPES[schema["type"]]
+    if schema.get("description"):
+        fields["description"] = schema["description"]
+    if schema.get("enum"):
+        fields["enum"] = [str(value) for value in schema["enum"]]
+    if "items" in schema:
+        fields["items"] = _schema(schema["items"])
+    if schema.get("properties"):
+        fields["properties"] = {name: _schema(value) for name, value in schema["properties"].items()}
+    if schema.get("required"):
+        fields["required"] = schema["required"]
+    return glm.Schema(**fields)
+
+def function_declarations(tools: list) -> glm.Tool:
+    """
+    The tools as Gemini function declarations, built from the JSON schemas LangChain gives every
+    tool (the same ones WrapperChatModel binds), not langchain_google_genai's private converter.
+    """
+    declarations = []
+    for tool in tools:
+        function = convert_to_openai_tool(tool)["function"]
+        parameters = function.get("parameters", {})
+        declarations.append(glm.FunctionDeclaration(
+            name=function["name"],
+            description=function.get("description", ""),
+            parameters=_schema(parameters) if parameters.get("properties") else None
+        ))
+    return glm.Tool(function_declarations=declarations)
+
+class ContextCache:
+    """
+    Gemini explicit context cache holding the static part of every request, the system prompt
+    and the tool declarations, so each turn only sends the conversation itself.
+    `name()` hands out a live cache handle: it creates the cache on first use and extends its TTL
+    shortly before it lapses. If the cache can't be created (for example the prefix is below the
+    model's minimum cacheable size) it backs off for `retry_after` seconds and returns None, and
+    callers use the uncached path.
+    :param model: Gemini model name, a cache only works with the model it was created for
+    :param system_prompt: static system instruction
+    :param tools: the tools bound to the model
+    :param ttl: cache lifetime in seconds, extended while the cache is in use
+    :param refresh_margin: extend the TTL when less than this many seconds remain
+    """
+    def __init__(self, model: str, system_prompt: str, tools: list, api_key: str, ttl: int = 3600, refresh_margin: int = 300, retry_after: int = 600):
+        self.model = model if model.startswith("models/") else f"models/{model}"
+        self.system_prompt = system_prompt
+        self.tools = tools
+        self.api_key = api_key
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self._client: glm.CacheServiceAsyncClient = None
+        self._name: str = None
+        self._expires = 0.0
+        self._disabled_until = 0.0
+        self._lock = asyncio.Lock()
+        # metrics
+        self.hits = 0 # model calls that read from a cache (explicit or implicit)
+        self.misses = 0
+        self.cached_tokens = 0
+        self.input_tokens = 0
+        self.creates = 0
+        self.errors = 0
+
+    @property
+    def client(self) -> glm.CacheServiceAsyncClient:
+        if self._client is None: # async gapic clients must be built inside the running loop
+            self._client = glm.CacheServiceAsyncClient(client_options={"api_key": self.api_key})
+        return self._client
+
+    async def name(self) -> str:
+        """Return the name of a live cache, or None if caching is currently unavailable."""
+        if self._name and time.monotonic() < self._expires - self.refresh_margin:
+            return self._name
+        if time.monotonic() < self._disabled_until:
+            return None
+        async with self._lock: # one create/extend at a time
+            if self._name and time.monotonic() < self._expires - self.refresh_margin:
+                return self._name
+            try:
+                if self._name is None:
+                    await self._create()
+                else:
+                    try:
+                        await self._extend()
+                    except NotFound: # expired or deleted server side
+                        await self._create()
+            except GoogleAPICallError as e:
+                self.errors += 1
+                self._name = None
+                self._disabled_until = time.monotonic() + self.retry_after
+                logger.warning("Gemini context cache unavailable, retrying in %ss: %r", self.retry_after, e)
+                return None
+        return self._name
+
+    async def _create(self):
+        cached = await self.client.create_cached_content(
+            cached_content=glm.CachedContent(
+                model=self.model,
+                display_name="agent-static-prefix",
+                system_instruction=glm.Content(parts=[glm.Part(text=self.system_prompt)]),
+                tools=[function_declarations(self.tools)],
+                ttl=duration_pb2.Duration(seconds=self.ttl)
+            )
+        )
+        self._name = cached.name
+        self._expires = time.monotonic() + self.ttl
+        self.creates += 1
+
+    async def _extend(self):
+        await self.client.update_cached_content(
+            cached_content=glm.CachedContent(name=self._name, ttl=duration_pb2.Duration(seconds=self.ttl)),
+            update_mask=field_mask_pb2.FieldMask(paths=["ttl"])
+        )
+        self._expires = time.monotonic() + self.ttl
+
+    async def close(self):
+        """Delete the cache so it stops accruing storage cost, call on shutdown."""
+        if self._name is None:
+            return
+        try:
+            await self.client.delete_cached_content(name=self._name)
+        except GoogleAPICallError as e:
+            logger.warning("failed to delete Gemini context cache %s: %r", self._name, e)
+        self._name = None
+
+    def record(self, message: AIMessage):
+        """Count a model response as a cache hit or miss from its usage metadata."""
+        usage = getattr(message, "usage_metadata", None)
+        if not usage:
+            return
+        cached = usage.get("input_token_details", {}).get("cache_read", 0)
+        self.hits += 1 if cached else 0
+        self.misses += 0 if cached else 1
+        self.cached_tokens += cached
+        self.input_tokens += usage.get("input_tokens", 0)
+
+    def stats(self) -> dict:
+        return {
+            "name": self._name,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / (self.hits + self.misses) if self.hits + self.misses else 0.0,
+            "cached_tokens": self.cached_tokens,
+            "input_tokens": self.input_tokens,
+            "creates": self.creates,
+            "errors": self.errors
+        }
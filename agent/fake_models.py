@@ -0,0 +1,142 @@
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+from typing import Any, AsyncIterator, Callable, Optional, Union
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+
+'''
+Offline chat models for tests and benchmarks. They can be bound to tools and dropped into
+create_react_agent or the graph wherever a Gemini model goes:
+
+    fast = FakeChatModel(responses=["Sure!"], latency=0.05, name="fast")
+    agent = create_react_agent(fast, tools)
+
+They can also be made unreliable, to exercise retries, hedging and fallbacks:
+
+    flaky = FakeChatModel(fail_rate=0.2, slow_rate=0.05, slow_latency=5.0, seed=1)
+'''
+
+class FakeModelError(ConnectionError):
+    """Raised by a FakeChatModel set to fail, retryable like a dropped connection."""
+
+Response = Union[str, AIMessage, Callable[[list[BaseMessage]], Union[str, AIMessage]]]
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model answering from a fixed script.
+    :param responses: replies cycled through in order, each a string, an AIMessage (e.g. with
+        tool_calls) or a callable taking the prompt messages and returning either
+    :param latency: seconds every call takes, when streaming the time to the first token
+    :param token_latency: seconds between streamed tokens (words), streaming is used whenever
+        the caller streams, e.g. the graph's "messages" stream mode
+    :param fail_first: number of calls that fail before the model starts answering
+    :param fail_rate: probability that any later call fails
+    :param error: exception (instance or class) a failing call raises, FakeModelError by default
+    :param slow_rate: probability that a call takes `slow_latency` instead of `latency`
+    :param seed: seed of the failure and slowness draws, for repeatable runs
+    """
+    responses: list = ["ok"]
+    latency: float = 0.0
+    token_latency: float = 0.0
+    fail_first: int = 0
+    fail_rate: float = 0.0
+    error: Any = None
+    slow_rate: float = 0.0
+    slow_latency: float = 0.0
+    seed: Optional[int] = None
+    _cycle: Any = PrivateAttr(default=None)
+    _calls: int = PrivateAttr(default=0)
+    _failures: int = PrivateAttr(default=0)
+    _random: Any = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any):
+        self._cycle = itertools.cycle(self.responses)
+        self._random = random.Random(self.seed)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    @property
+    def calls(self) -> int:
+        return self._calls
+
+    @property
+    def failures(self) -> int:
+        return self._failures
+
+    def bind_tools(self, tools: list, **kwargs) -> "FakeChatModel":
+        return self
+
+    def _draw(self) -> tuple[float, bool]:
+        """(latency, fails) of the next call."""
+        self._calls += 1
+        slow = self.slow_rate and self._random.random() < self.slow_rate
+        fails = self._calls <= self.fail_first or (self.fail_rate and self._random.random() < self.fail_rate)
+        return (self.slow_latency if slow else self.latency), bool(fails)
+
+    def _fail(self):
+        self._failures += 1
+        error = self.error or FakeModelError
+        raise error(f"{self.name or 'fake model'} failed") if isinstance(error, type) else error
+
+    async def _aprepare(self):
+        latency, fails = self._draw()
+        if latency:
+            await asyncio.sleep(latency)
+        if fails:
+            self._fail()
+
+    def _respond(self, messages: list[BaseMessage]) -> ChatResult:
+        response: Response = next(self._cycle)
+        if callable(response):
+            response = response(messages)
+        message = response.model_copy() if isinstance(response, AIMessage) else AIMessage(response)
+        input_tokens = count_tokens_approximately(messages)
+        output_tokens = count_tokens_approximately([message])
+        message.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        latency, fails = self._draw()
+        if latency:
+            time.sleep(latency)
+        if fails:
+            self._fail()
+        return self._respond(messages)
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        await self._aprepare()
+        return self._respond(messages)
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        await self._aprepare() # a failing stream fails before its first chunk
+        message: AIMessage = self._respond(messages).generations[0].message
+        pieces = re.findall(r"\S+\s*|\s+", message.text())
+        for i, piece in enumerate(pieces):
+            if i and self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=piece, id=message.id))
+            if run_manager:
+                await run_manager.on_llm_new_token(piece, chunk=chunk)
+            yield chunk
+        # tool calls and usage arrive with the last chunk, as they do from Gemini
+        chunk = ChatGenerationChunk(message=AIMessageChunk(
+            content="",
+            id=message.id,
+            tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": i}
+                for i, call in enumerate(message.tool_calls)
+            ],
+            usage_metadata=message.usage_metadata
+        ))
+        if run_manager:
+            await run_manager.on_llm_new_token("", chunk=chunk)
+        yield chunk
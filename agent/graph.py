@@ -1,61 +1,216 @@
 import asyncio
-from langchain.chat_models import init_chat_model
-from langchain_core.messages import HumanMessage, AIMessage
+from langchain_core.messages import HumanMessage, AIMessage, AIMessageChunk, ToolMessage
 from langchain_core.runnables.configurable import RunnableConfig
-from langgraph.checkpoint.redis import AsyncRedisSaver
 from langgraph.graph import START, StateGraph, END
 from langgraph.graph.message import add_messages
 from langgraph.graph.state import CompiledStateGraph
 from langgraph.prebuilt import ToolNode, tools_condition, create_react_agent
-import os, yaml
+import os, time
 from fastapi import FastAPI
 from typing import Annotated, Union
 from typing_extensions import TypedDict
-from agent.tools import weather, google_cal
-from agent.prompts import prompt_template
+from agent.tools import weather, google_cal, calendar_tools
+from agent.tools.calendar_prefetch import prefetcher
+from agent.prompts import prompt_template, cached_prompt_template, sys_prompt, current_context
+from agent.compaction import Compactor, ModelSummarizer
+from agent.router import Router, HeuristicClassifier
+from agent.resilience import ResilientChatModel
+from agent.lazy_model import LazyChatModel
 from utils.loggers import TrainingDataLogger
+from utils import metrics
 import pprint
+from utils.config import config
 
 td_logger = TrainingDataLogger("graph")
 
-with open("config.yml") as f: config = yaml.safe_load(f)
-
 os.environ["GOOGLE_API_KEY"] = config["google"]["key"]
 
-model = init_chat_model(
-    "gemini-2.5-flash-preview-05-20", # model name
-    model_provider="google_genai",
-    temperature=0
-    )
+MODEL_NAME = "gemini-2.5-flash-preview-05-20"
+
+resilience_config = config.get("resilience", {})
+
+resilient_models: dict[str, ResilientChatModel] = {} # model name -> wrapper, for stats and warming
+lazy_models: dict[str, LazyChatModel] = {} # model name -> model, built by load_models or on first use
+
+def gemini(name: str) -> LazyChatModel:
+    if name not in lazy_models:
+        lazy_models[name] = LazyChatModel(model=name, provider="google_genai", options={"temperature": 0})
+    return lazy_models[name]
+
+def load_models():
+    """Import and build every model the graph uses, blocking, the app runs it in a thread at startup."""
+    for model in list(lazy_models.values()):
+        model.load()
+
+def chat_model(name: str):
+    """
+    Gemini chat model `name`, built on first use (see agent/lazy_model.py). With `resilience.enabled`
+    it is wrapped with deadlines, retries, hedging and the `resilience.fallbacks` models, see
+    agent/resilience.py.
+    """
+    model = gemini(name)
+    if not resilience_config.get("enabled"):
+        return model
+    if name not in resilient_models:
+        fallbacks = [gemini(fallback) for fallback in resilience_config.get("fallbacks", []) if fallback != name]
+        resilient_models[name] = ResilientChatModel(
+            models=[model, *fallbacks],
+            timeout=resilience_config.get("timeout", 60),
+            first_token_timeout=resilience_config.get("first_token_timeout", 20),
+            retries=resilience_config.get("retries", 2),
+            backoff=resilience_config.get("backoff", 0.5),
+            hedge=resilience_config.get("hedge", False),
+            hedge_percentile=resilience_config.get("hedge_percentile", 0.95),
+            hedge_delay=resilience_config.get("hedge_delay", 3.0),
+            breaker_failures=resilience_config.get("breaker_failures", 5),
+            breaker_reset=resilience_config.get("breaker_reset", 30)
+            )
+    return resilient_models[name]
 
-tools = [google_cal.tool]
+base_model = chat_model(MODEL_NAME)
 
-model = model.bind_tools(tools)
+tools_config = config["google"].get("calendar", {}).get("tools", {})
+
+if tools_config.get("per_action"):
+    # one lean tool per calendar action, a route can be limited to the actions it needs
+    tools = calendar_tools.select()
+    route_tools = {route: calendar_tools.select(actions) for route, actions in tools_config.get("routes", {}).items()}
+else:
+    tools = [google_cal.tool]
+    route_tools = {}
+
+model = base_model.bind_tools(route_tools.get("full", tools))
 
 agent = create_react_agent(
     model,
-    tools
+    route_tools.get("full", tools)
 )
 
+cache_config = config["google"].get("context_cache", {})
+
+if cache_config.get("enabled"):
+    from agent.context_cache import ContextCache # pulls in the generated Gemini API clients
+
+# explicit Gemini cache for the system prompt + tool declarations, off unless configured
+context_cache = ContextCache(
+    MODEL_NAME,
+    sys_prompt,
+    route_tools.get("full", tools),
+    config["google"]["key"],
+    ttl=cache_config.get("ttl", 3600),
+    refresh_margin=cache_config.get("refresh_margin", 300)
+    ) if cache_config.get("enabled") else None
+
+compaction_config = config.get("compaction", {})
+
+# keeps long threads under a token budget by folding old turns into a rolling summary
+compactor = Compactor(
+    ModelSummarizer(chat_model(compaction_config.get("model", "gemini-2.0-flash-lite"))),
+    budget=compaction_config.get("budget", 16000),
+    keep=compaction_config.get("keep", 6000),
+    defer=compaction_config.get("defer", True)
+    ) if compaction_config.get("enabled") else None
+
+router_config = config.get("router", {})
+
+# sends easy turns (small talk, short lookups) to a cheaper model, the rest to MODEL_NAME
+router = Router(
+    {
+        "fast": create_react_agent(
+            chat_model(router_config.get("fast_model", "gemini-2.0-flash-lite")).bind_tools(route_tools.get("fast", tools)),
+            route_tools.get("fast", tools)
+            ),
+        "full": agent
+    },
+    HeuristicClassifier(**router_config.get("classifier", {})),
+    default="full",
+    costs=router_config.get("costs", {})
+    ) if router_config.get("enabled") else None
+
+memory_config = config.get("memory", {})
+
+if memory_config.get("enabled"):
+    from agent.memory import embeddings # numpy, only needed with memory on
+    from agent.memory.extract import ModelExtractor
+    from agent.memory.manager import MemoryManager
+    from agent.memory.store import DiskMemoryStore
+
+# long-term memories per user, retrieved into the prompt each turn and extracted after it
+memory = MemoryManager(
+    embeddings.CachedEmbedder(
+        embeddings.load(memory_config.get("embedder", "hashing"), **memory_config.get("embedder_options", {})),
+        maxsize=memory_config.get("embedding_cache", 10000)
+        ),
+    ModelExtractor(chat_model(memory_config.get("model", "gemini-2.0-flash-lite"))) if memory_config.get("extract", True) else None,
+    store=DiskMemoryStore(memory_config.get("path", "memories")) if memory_config.get("store") == "disk" else None, # Postgres is attached by the app
+    k=memory_config.get("k", 5),
+    budget=memory_config.get("budget", 300),
+    min_score=memory_config.get("min_score", 0.15),
+    dedup=memory_config.get("dedup", 0.9),
+    always=memory_config.get("always", ["procedure"]),
+    ann_threshold=memory_config.get("ann_threshold", 4096),
+    flush_interval=memory_config.get("flush_interval", 2.0),
+    max_users=memory_config.get("max_users", 1000),
+    ttl=memory_config.get("ttl", 3600)
+    ) if memory_config.get("enabled") else None
+
 class State(TypedDict):
     # Messages have the type "list". The `add_messages` function
     # in the annotation defines how this state key should be updated
     # (in this case, it appends messages to the list, rather than overwriting them)
     messages: Annotated[list, add_messages]
+    summary: str # rolling summary of compacted turns
+    route: str # model tier picked by the router for the current turn
+    memories: str # long-term memories retrieved for the current turn
     user_id: str
     thread_id: str
 
 async def call_agent(state: State): # graph `model` node
-    prompt = await prompt_template.ainvoke(state)
-    resp = await agent.ainvoke(prompt)
+    prompt_input = {**state, "context": current_context(state.get("summary"))}
+    if state.get("memories"):
+        prompt_input["context"] += "\n\n" + state["memories"]
+    if prefetcher:
+        events = await prefetcher.context(state["thread_id"]) # waits briefly for the prefetch node's fetch
+        if events:
+            prompt_input["context"] += "\n\n" + events
+    route = state.get("route") or "full"
+    start = time.perf_counter()
+    cache_name = await context_cache.name() if context_cache and route == "full" else None # the cache belongs to MODEL_NAME
+    if cache_name:
+        # system prompt and tools come from the cache, tool calls are routed by the graph's `tools` node
+        prompt = await cached_prompt_template.ainvoke(prompt_input)
+        new_messages = [await base_model.ainvoke(prompt, cached_content=cache_name)]
+    else:
+        prompt = await prompt_template.ainvoke(prompt_input)
+        resp = await (router.get(route) if router else agent).ainvoke(prompt)
+        new_messages = resp["messages"][len(prompt.messages):] # only what the agent added, not the prompt itself
+
+    if router:
+        router.record(route, time.perf_counter() - start, new_messages)
+
+    if context_cache:
+        for message in new_messages:
+            if isinstance(message, AIMessage):
+                context_cache.record(message)
+
+    final = not getattr(new_messages[-1], "tool_calls", None) # final answer of the turn
+    if compactor and final:
+        compactor.schedule(state["thread_id"], {**state, "messages": state["messages"] + new_messages})
+    prefetch = prefetcher.finish(state["thread_id"]) if prefetcher and final else None
+    if memory and final:
+        user_message = next((m for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), None)
+        if user_message is not None:
+            memory.schedule(state["user_id"], user_message.text(), new_messages[-1].text())
 
     td_logger.log({
         "user": dict(state["messages"][-1]),
-        "ai": dict(resp["messages"][-1]),
+        "ai": dict(new_messages[-1]),
         "thread_id": state["thread_id"], 
-        "user_id": state["user_id"]
+        "user_id": state["user_id"],
+        "route": route,
+        "prefetch": prefetch
     })
-    return resp
+    return {"messages": new_messages}
 
 
 workflow = StateGraph(state_schema=State) # create graph
@@ -63,26 +218,65 @@ workflow.add_node("model", call_agent) # create agent node
 workflow.add_node("tools", ToolNode(tools)) # create tools node
 workflow.add_conditional_edges("model", tools_condition) 
 workflow.add_edge("tools", "model")
-workflow.add_edge(START, "model") # add connection from start to model
-
-async def chat(msg: str, _id: str, app: Union[FastAPI, CompiledStateGraph], user_id: str = None): 
-    cfig = {"configurable": {"thread_id": _id, "app": app, "user_id": user_id}}
-    if type(app) == FastAPI: 
-        await app.state.graph.aupdate_state(cfig,values={"user_id": user_id, "thread_id": _id})
-        async for chunk, metadata in app.state.graph.astream( # iterate over chunks streamed from model
-                {"messages": [HumanMessage(msg)], "language": "English"}, # pass user input to model
-                cfig, # pass config to model
-                stream_mode="messages"
-                ):
-            if isinstance(chunk, AIMessage): # if chunk is an AIMessage (not human message)
-                yield chunk.content
-    elif type(app) == CompiledStateGraph:
+entry = [] # nodes run in order before the model, each turn
+if prefetcher:
+    workflow.add_node("prefetch", prefetcher) # start fetching upcoming events, runs alongside the nodes after it
+    entry.append("prefetch")
+if memory:
+    workflow.add_node("memory", memory) # put the user's related long-term memories in the prompt
+    entry.append("memory")
+if compactor:
+    workflow.add_node("compact", compactor) # trim history before the model sees it
+    entry.append("compact")
+if router:
+    workflow.add_node("router", router) # pick the model tier for this turn
+    entry.append("router")
+entry.append("model")
+workflow.add_edge(START, entry[0]) # add connection from start to the first node
+for a, b in zip(entry, entry[1:]):
+    workflow.add_edge(a, b)
+
+async def chat_events(msg: str, _id: str, app: Union[FastAPI, CompiledStateGraph], user_id: str = None):
+    """
+    Run one turn and stream it as (event, data) pairs:
+    ("token", {"text"}) for answer text, ("tool_start", {"name", "id"}) when the model calls a tool
+    and ("tool_end", {"name", "id", "status"}) when the tool returned.
+    """
+    cfig = {"configurable": {"thread_id": _id, "app": app, "user_id": user_id}, "callbacks": [metrics.callback]} # times nodes, model calls and tools
+    retention = None
+    if type(app) == FastAPI:
+        graph = app.state.graph
+        retention = getattr(app.state, "retention", None)
+        if retention:
+            await retention.restore(_id) # no-op unless the thread was offloaded to Postgres
+    else:
         graph = app
+    with metrics.span("update_state"):
         await graph.aupdate_state(cfig,values={"user_id": user_id, "thread_id": _id})
-        async for chunk, metadata in graph.astream( # iterate over chunks streamed from model
-                {"messages": [HumanMessage(msg)], "language": "English"}, # pass user input to model
-                cfig, # pass config to model
-                stream_mode="messages"
-                ):
-            if isinstance(chunk, AIMessage): # if chunk is an AIMessage (not human message)
-                yield chunk.content
+    started = set() # tool calls already announced, their args keep streaming in later chunks
+    async for chunk, metadata in graph.astream( # iterate over chunks streamed from model
+            {"messages": [HumanMessage(msg)], "language": "English"}, # pass user input to model
+            cfig, # pass config to model
+            stream_mode="messages"
+            ):
+        if isinstance(chunk, AIMessage): # if chunk is an AIMessage (not human message)
+            text = chunk.text()
+            if text: # tool call chunks carry no text
+                yield "token", {"text": text}
+            calls = chunk.tool_call_chunks if isinstance(chunk, AIMessageChunk) else chunk.tool_calls
+            for call in calls:
+                key = call.get("id") or (chunk.id, call.get("index"))
+                if call.get("name") and key not in started:
+                    started.add(key)
+                    yield "tool_start", {"name": call["name"], "id": call.get("id")}
+        elif isinstance(chunk, ToolMessage):
+            yield "tool_end", {"name": chunk.name, "id": chunk.tool_call_id, "status": chunk.status}
+    metrics.TOOL_CALLS_PER_TURN.observe(len(started))
+    if retention:
+        retention.schedule(_id)
+
+async def chat(msg: str, _id: str, app: Union[FastAPI, CompiledStateGraph], user_id: str = None):
+    """The turn's answer text as it streams, see chat_events for tool activity."""
+    async for event, data in chat_events(msg, _id, app, user_id):
+        if event == "token":
+            yield data["text"]
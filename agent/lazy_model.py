@@ -0,0 +1,77 @@
+import threading
+from typing import Any, AsyncIterator, Optional
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+from agent.wrapped_model import INNER, WrapperChatModel
+
+'''
+Chat models built on first use. Importing the provider's package (langchain_google_genai and the
+generated Google API clients behind it) is the slowest part of importing the app, LazyChatModel
+stands in for the model until it is called or `load()`ed, which the app does in its lifespan,
+off the event loop. Everything the graph does at import time (bind_tools, create_react_agent,
+wrapping it in a ResilientChatModel) works without loading it.
+'''
+
+
+class LazyChatModel(WrapperChatModel):
+    """
+    `init_chat_model(model, model_provider=provider, **options)`, called once when first needed.
+    :param model: model name
+    :param provider: LangChain provider name, also what metrics and circuit breakers are labelled with
+    :param options: init_chat_model keyword arguments, e.g. temperature
+    """
+    model: str
+    provider: str
+    options: dict = {}
+    _model: Any = PrivateAttr(default=None)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "lazy-chat-model"
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self) -> BaseChatModel:
+        """The real model, imported and built on the first call."""
+        if self._model is None:
+            with self._lock: # the lifespan loads in a thread, a request may get there first
+                if self._model is None:
+                    from langchain.chat_models import init_chat_model
+                    self._model = init_chat_model(self.model, model_provider=self.provider, **self.options)
+        return self._model
+
+    def _get_ls_params(self, stop: Optional[list[str]] = None, **kwargs) -> dict:
+        # answered without loading, ResilientChatModel asks for the provider when it is built
+        return {
+            "ls_provider": self.provider,
+            "ls_model_name": self.model,
+            "ls_model_type": "chat",
+            "ls_temperature": self.options.get("temperature"),
+            **({"ls_stop": stop} if stop else {})
+        }
+
+    def _inner(self, kwargs: dict) -> tuple[Any, dict]:
+        """The loaded model, with the bound tools if any, and the kwargs left for it."""
+        (model,), kwargs = self._with_tools([self.load()], kwargs)
+        return model, kwargs
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        model, kwargs = self._inner(kwargs)
+        return ChatResult(generations=[ChatGeneration(message=model.invoke(messages, INNER, stop=stop, **kwargs))])
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        model, kwargs = self._inner(kwargs)
+        return ChatResult(generations=[ChatGeneration(message=await model.ainvoke(messages, INNER, stop=stop, **kwargs))])
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        model, kwargs = self._inner(kwargs)
+        async for chunk in model.astream(messages, INNER, stop=stop, **kwargs):
+            generation = ChatGenerationChunk(message=chunk if isinstance(chunk, AIMessageChunk) else AIMessageChunk(content=chunk.content))
+            if run_manager:
+                await run_manager.on_llm_new_token(generation.text, chunk=generation)
+            yield generation
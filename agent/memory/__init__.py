@@ -0,0 +1 @@
+__all__ = ["embeddings","index","store","extract","manager"]
\ No newline at end of file
@@ -0,0 +1,122 @@
+import asyncio
+import hashlib
+import importlib
+import re
+import numpy as np
+from typing import Callable
+from utils.cache import TTLCache
+
+'''
+Text embeddings for long-term memory, computed locally. An embedder is any callable taking a list
+of texts and returning an (n, dim) float32 array of L2 normalized rows, with a `name` (stored
+next to every vector, so vectors of another embedder are recomputed) and `dim`. Set `threaded`
+on embedders that are slow enough to be run off the event loop.
+'''
+
+# texts -> (n, dim) float32, rows L2 normalized
+Embedder = Callable[[list[str]], np.ndarray]
+
+WORD = re.compile(r"[a-z0-9']+")
+
+STOPWORDS = frozenset(
+    "a an the and or but if of to in on at for with by from as is are was were be been am do does did "
+    "i me my we our you your it its this that these those what which who when where how can could would "
+    "should will shall please just so than then there their them they he she his her him".split())
+
+def features(text: str) -> list[tuple[str, float]]:
+    """Weighted features of a text: stemmed content words, and their bigrams at half weight."""
+    words = [stem(w) for w in WORD.findall(text.lower()) if w not in STOPWORDS]
+    return [(w, 1.0) for w in words] + [(f"{a} {b}", 0.5) for a, b in zip(words, words[1:])]
+
+def stem(word: str) -> str:
+    """Crude suffix stripping, enough for "meetings"/"meeting" and "prefers"/"prefer" to match."""
+    for suffix in ("ing", "ed", "es", "s"):
+        if len(word) > len(suffix) + 2 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+class HashingEmbedder:
+    """
+    Embeds without a model: content words and their bigrams are hashed into `dim` signed buckets.
+    Matches memories that share words with the message, in microseconds and with nothing to
+    download, which is enough for short facts like "prefers meetings after 10am".
+    """
+    threaded = False
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in features(text):
+                h = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+                vectors[row, h % self.dim] += weight if h >> 63 else -weight
+        return normalize(vectors)
+
+
+class SentenceTransformerEmbedder:
+    """A local sentence-transformers model, needs the optional `sentence-transformers` package."""
+    threaded = True
+
+    def __init__(self, model: str = "all-MiniLM-L6-v2", device: str = None):
+        from sentence_transformers import SentenceTransformer # optional and slow to import, only when configured
+        self.model = SentenceTransformer(model, device=device)
+        self.dim = self.model.get_sentence_embedding_dimension()
+        self.name = f"st-{model}"
+
+    def __call__(self, texts: list[str]) -> np.ndarray:
+        return self.model.encode(texts, normalize_embeddings=True, convert_to_numpy=True).astype(np.float32)
+
+
+def load(name: str = "hashing", **options) -> Embedder:
+    """Embedder by name, "hashing", "sentence-transformers" or "package.module:factory" for your own."""
+    if name == "hashing":
+        return HashingEmbedder(**options)
+    if name == "sentence-transformers":
+        return SentenceTransformerEmbedder(**options)
+    module, _, factory = name.partition(":")
+    return getattr(importlib.import_module(module), factory)(**options)
+
+
+class CachedEmbedder:
+    """
+    Embedder with an LRU cache of recent texts, so a memory or a repeated message is embedded once.
+    :param embedder: the embedder doing the work
+    :param maxsize: texts cached
+    :param ttl: seconds a cached vector is kept
+    """
+    def __init__(self, embedder: Embedder, maxsize: int = 10000, ttl: float = 86400):
+        self.embedder = embedder
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.embedded = 0
+
+    @property
+    def name(self) -> str:
+        return self.embedder.name
+
+    @property
+    def dim(self) -> int:
+        return self.embedder.dim
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = [self.cache.get(text) for text in texts]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        if missing:
+            computed = await asyncio.to_thread(self.embedder, missing) if getattr(self.embedder, "threaded", False) else self.embedder(missing)
+            self.embedded += len(missing)
+            fresh = dict(zip(missing, computed))
+            for text, vector in fresh.items():
+                self.cache.set(text, vector)
+            vectors = [fresh[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return np.stack(vectors) if vectors else np.zeros((0, self.dim), np.float32)
+
+    def stats(self) -> dict:
+        lookups = self.cache.hits + self.cache.misses
+        return {"embedded": self.embedded, "cache_hit_rate": self.cache.hits / lookups if lookups else 0.0}
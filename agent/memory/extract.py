@@ -0,0 +1,68 @@
+import json
+import logging
+import re
+from langchain_core.language_models import BaseChatModel
+
+logger = logging.getLogger(__name__)
+
+'''
+Extraction of durable memories from a finished turn. Only turns where the user says something
+about themselves are sent to the (cheap) extraction model, most calendar lookups aren't.
+'''
+
+KINDS = ("fact", "preference", "procedure")
+
+# the user talks about themselves, their habits or how they want things done
+PERSONAL = re.compile(
+    r"\b(i|i'm|i am|i've|my|mine|me|we|our|us|always|never|usually|every|prefer\w*|like|love|hate|"
+    r"don't|do not|please (don't|always|never)|call me|remember|from now on|going forward)\b", re.I)
+
+EXTRACT_PROMPT = """You maintain long-term memory for a scheduling assistant.
+From the exchange below, extract facts about the user worth remembering in future conversations:
+stable facts (people, places, routines, time zone), preferences (meeting times, durations, buffers)
+and procedures (how they want requests handled). Skip one-off requests, event details that are on
+the calendar anyway, and anything the assistant said that the user didn't confirm.
+{known}
+Answer with a JSON array only, [] if there is nothing new, e.g.
+[{{"text": "Prefers no meetings before 10am", "kind": "preference"}}]
+Kinds: fact, preference, procedure. When a memory corrects or updates one already remembered,
+add "replaces" with that memory's number.
+
+User: {user}
+Assistant: {answer}"""
+
+class ModelExtractor:
+    """Extracts memories with a chat model, typically a cheaper one than the agent's."""
+    def __init__(self, model: BaseChatModel):
+        self.model = model
+
+    def worth(self, user_text: str) -> bool:
+        return bool(PERSONAL.search(user_text))
+
+    async def __call__(self, user_text: str, answer: str, known: list[str] = ()) -> list[dict]:
+        """
+        :param known: related memories the user already has, so they aren't extracted again
+        :return: [{"text", "kind", "replaces"}], replaces is an index into `known` or None
+        """
+        listed = "Already remembered (don't repeat these):\n" + "\n".join(f"{i}. {text}" for i, text in enumerate(known, 1)) + "\n" if known else ""
+        resp = await self.model.ainvoke(EXTRACT_PROMPT.format(known=listed, user=user_text, answer=answer))
+        return parse(resp.text(), len(known))
+
+def parse(text: str, known: int = 0) -> list[dict]:
+    """The memories in a model's answer, whatever surrounds the JSON array."""
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        return []
+    try:
+        items = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        logger.warning("unparseable memory extraction: %r", text[:200])
+        return []
+    return [
+        {
+            "text": item["text"].strip(),
+            "kind": item.get("kind") if item.get("kind") in KINDS else "fact",
+            "replaces": item["replaces"] - 1 if isinstance(item.get("replaces"), int) and 1 <= item["replaces"] <= known else None
+        }
+        for item in items if isinstance(item, dict) and isinstance(item.get("text"), str) and item["text"].strip()
+    ]
@@ -0,0 +1,125 @@
+import numpy as np
+from typing import Callable
+
+'''
+Vector index of one user's memories, cosine similarity over L2 normalized rows.
+
+Up to `ann_threshold` vectors a search is a single matrix-vector product over all of them, which
+stays well under a millisecond. Past that an inverted file index (IVF) is trained: the vectors
+are clustered into about sqrt(n) lists with spherical k-means, and a search only scores the
+vectors of the `nprobe` lists whose centroids are closest to the query. Training runs off the
+event loop (`trainer` snapshots the vectors, `install` applies the result) and brute force
+serves searches until it is done.
+'''
+
+class VectorIndex:
+    """
+    :param dim: vector dimension
+    :param ann_threshold: vectors from which the IVF index is used
+    :param nprobe: lists scored per search once the IVF index is used
+    """
+    def __init__(self, dim: int, ann_threshold: int = 4096, nprobe: int = 8):
+        self.dim = dim
+        self.ann_threshold = ann_threshold
+        self.nprobe = nprobe
+        self.ids: list[str] = []
+        self._rows: dict[str, int] = {} # id -> row
+        self._data = np.zeros((16, dim), np.float32) # grown by doubling, the first len(ids) rows are used
+        self._version = 0 # bumped when rows move, training started before is discarded
+        self._centroids = None
+        self._lists: list[list[int]] = None # rows of each centroid's list
+        self._trained = 0 # vectors the IVF index was trained on
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._data[:len(self.ids)]
+
+    def add(self, ids: list[str], vectors: np.ndarray):
+        """Insert vectors, replacing those of ids already in the index."""
+        for id, vector in zip(ids, vectors):
+            row = self._rows.get(id)
+            if row is None:
+                row = len(self.ids)
+                if row == len(self._data):
+                    self._data = np.concatenate([self._data, np.zeros_like(self._data)])
+                self.ids.append(id)
+                self._rows[id] = row
+            elif self._lists is not None:
+                self._lists[self._list_of(row)].remove(row)
+            self._data[row] = vector
+            if self._lists is not None:
+                self._lists[int(np.argmax(self._centroids @ vector))].append(row)
+
+    def remove(self, ids: list[str]):
+        for id in ids:
+            row = self._rows.pop(id, None)
+            if row is None:
+                continue
+            last = len(self.ids) - 1
+            if row != last: # move the last row into the gap
+                self._data[row] = self._data[last]
+                self.ids[row] = self.ids[last]
+                self._rows[self.ids[row]] = row
+            self.ids.pop()
+            self._version += 1
+            self._centroids = self._lists = None # rows moved, retrain
+            self._trained = 0
+
+    def _list_of(self, row: int) -> int:
+        return next(i for i, rows in enumerate(self._lists) if row in rows)
+
+    def search(self, query: np.ndarray, k: int) -> list[tuple[str, float]]:
+        """Up to `k` (id, similarity) pairs, most similar first."""
+        if not self.ids:
+            return []
+        if self._lists is None:
+            rows = None
+            scores = self.vectors @ query
+        else:
+            probed = np.argsort(self._centroids @ query)[::-1][:self.nprobe]
+            rows = np.fromiter((row for i in probed for row in self._lists[i]), dtype=np.int64)
+            scores = self._data[rows] @ query
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(self.ids[row if rows is None else rows[row]], float(scores[row])) for row in top]
+
+    def needs_training(self) -> bool:
+        return len(self.ids) >= self.ann_threshold and len(self.ids) >= 2 * self._trained
+
+    def trainer(self, iterations: int = 8, sample: int = 20000, seed: int = 0) -> Callable[[], tuple]:
+        """
+        Snapshot the current vectors and return a function clustering them, for a worker thread.
+        Pass its result to `install`.
+        """
+        vectors, version = self.vectors.copy(), self._version
+        def train() -> tuple:
+            rng = np.random.default_rng(seed)
+            nlist = max(1, int(np.sqrt(len(vectors))))
+            sampled = vectors[rng.choice(len(vectors), min(sample, len(vectors)), replace=False)]
+            centroids = sampled[rng.choice(len(sampled), nlist, replace=False)].copy()
+            for _ in range(iterations): # spherical k-means
+                assigned = np.argmax(sampled @ centroids.T, axis=1)
+                for i in range(nlist):
+                    members = sampled[assigned == i]
+                    if len(members):
+                        centroid = members.sum(axis=0)
+                        centroids[i] = centroid / (np.linalg.norm(centroid) or 1)
+            return version, len(vectors), centroids, np.argmax(vectors @ centroids.T, axis=1)
+        return train
+
+    def install(self, trained: tuple):
+        version, size, centroids, assigned = trained
+        if version != self._version or size > len(self.ids):
+            return # rows moved while training
+        lists = [[] for _ in range(len(centroids))]
+        for row, i in enumerate(assigned):
+            lists[i].append(row)
+        for row in range(size, len(self.ids)): # added while training
+            lists[int(np.argmax(centroids @ self._data[row]))].append(row)
+        self._centroids, self._lists, self._trained = centroids, lists, size
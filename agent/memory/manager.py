@@ -0,0 +1,332 @@
+import asyncio
+import collections
+import contextvars
+import datetime
+import logging
+import statistics
+import time
+import uuid
+import numpy as np
+from langchain_core.messages.utils import count_tokens_approximately
+from utils import metrics
+from utils.cache import TTLCache
+from agent.memory.embeddings import CachedEmbedder
+from agent.memory.extract import ModelExtractor
+from agent.memory.index import VectorIndex
+from agent.memory.store import Memory
+
+logger = logging.getLogger(__name__)
+
+'''
+Long-term memory of each user, so what the user told the agent once doesn't have to stay in the
+thread's history. The `memory` graph node embeds the user's message, searches the user's index
+and puts the closest memories in the prompt, within a token budget. After the turn's answer is
+out, `schedule` has the extraction model pull durable facts and preferences from it in the
+background. They are embedded, replace the memory they correct (or restate) or are added, and
+written to the store by a background writer, so a turn never waits on the extraction or the
+store. Each user's memories are loaded into memory on their first turn and kept for `ttl`. With
+several workers, a version counter per user in Redis is bumped after every write and checked on
+each retrieval, so memories written by one worker reach the others on the user's next turn.
+'''
+
+class UserMemories:
+    """One user's memories and their vector index."""
+    def __init__(self, index: VectorIndex, version: int = 0):
+        self.index = index
+        self.version = version # of the user's stored memories when they were loaded
+        self.memories: dict[str, Memory] = {}
+
+    def add(self, memories: list[Memory]):
+        for memory in memories:
+            self.memories[memory.id] = memory
+        if memories:
+            self.index.add([m.id for m in memories], np.stack([m.vector for m in memories]))
+
+
+class MemoryManager:
+    """
+    :param embedder: embeds memories and messages, with its cache
+    :param extractor: pulls memories out of finished turns, None to only retrieve
+    :param store: PostgresMemoryStore or DiskMemoryStore, None keeps memories in process only
+    :param k: memories retrieved per turn at most
+    :param budget: tokens the retrieved memories may add to the prompt
+    :param min_score: similarity below which a memory isn't considered related
+    :param dedup: similarity above which a new memory replaces an existing one, corrections are
+        matched by the extractor itself
+    :param always: kinds included in every turn's memories, newest first, e.g. procedures
+    :param ann_threshold: memories of a user from which their index switches to IVF search
+    :param flush_interval: seconds new memories wait before they are written, to batch them
+    :param max_users: users whose memories are kept loaded
+    :param ttl: seconds a user's loaded memories are kept without a turn
+    :param versions: Redis client holding each user's memory version, None when one process owns the store
+    """
+    def __init__(
+            self,
+            embedder: CachedEmbedder,
+            extractor: ModelExtractor = None,
+            store = None,
+            k: int = 5,
+            budget: int = 300,
+            min_score: float = 0.15,
+            dedup: float = 0.9,
+            always: tuple = ("procedure",),
+            ann_threshold: int = 4096,
+            flush_interval: float = 2.0,
+            max_users: int = 1000,
+            ttl: float = 3600,
+            versions = None):
+        self.embedder = embedder
+        self.extractor = extractor
+        self.store = store
+        self.k = k
+        self.budget = budget
+        self.min_score = min_score
+        self.dedup = dedup
+        self.always = tuple(always)
+        self.ann_threshold = ann_threshold
+        self.flush_interval = flush_interval
+        self.versions = versions
+        self._users = TTLCache(maxsize=max_users, ttl=ttl) # user_id -> UserMemories
+        self._loading: dict[str, asyncio.Task] = {}
+        self._dirty: dict[str, dict[str, Memory]] = {} # user_id -> memories waiting to be written
+        self._tasks: set[asyncio.Task] = set() # extractions and index training in flight
+        self._writer: asyncio.Task = None
+        self._training: set[str] = set()
+        # metrics
+        self.retrievals = 0
+        self.injected = 0 # retrievals that added memories to the prompt
+        self.latencies = collections.deque(maxlen=1000) # seconds per retrieval
+        self.skipped = 0 # turns not worth an extraction
+        self.extractions = 0
+        self.added = 0
+        self.merged = 0
+        self.written = 0
+        self.write_errors = 0
+        self.reloads = 0 # loaded memories dropped because another worker wrote newer ones
+
+    def start(self, store, versions = None):
+        """
+        Persist to `store` from now on, e.g. once the app's Postgres pool exists.
+        :param versions: Redis client shared by the workers, see `versions` above
+        """
+        self.store = store
+        self.versions = versions or self.versions
+
+    def _version_key(self, user_id: str) -> str:
+        return f"memory:version:{user_id}"
+
+    async def _version(self, user_id: str) -> int:
+        """The version of the user's stored memories, None when it can't be told."""
+        if self.versions is None:
+            return None
+        try:
+            return int(await self.versions.get(self._version_key(user_id)) or 0)
+        except Exception as e: # Redis down: keep serving the loaded copy
+            logger.warning("memory version of user %s unavailable: %r", user_id, e)
+            return None
+
+    async def stop(self):
+        """Finish running extractions and write everything pending. Call before closing the store's pool."""
+        if self._tasks:
+            await asyncio.wait(self._tasks, timeout=10)
+        if self._writer:
+            self._writer.cancel()
+        await self.flush()
+
+    async def user(self, user_id: str, check: bool = False) -> UserMemories:
+        """
+        The user's memories, loaded from the store on first use (concurrent callers share the load).
+        :param check: reload them if another worker wrote since they were loaded
+        """
+        loaded = self._users.get(user_id)
+        if loaded is not None and check:
+            version = await self._version(user_id)
+            if version is not None and version != loaded.version and user_id not in self._dirty:
+                self.reloads += 1
+                self._users.pop(user_id)
+                loaded = None
+        if loaded is not None:
+            return loaded
+        if user_id not in self._loading:
+            task = asyncio.create_task(self._load(user_id))
+            self._loading[user_id] = task
+            task.add_done_callback(lambda t: self._loading.pop(user_id, None))
+        return await asyncio.shield(self._loading[user_id])
+
+    async def _load(self, user_id: str) -> UserMemories:
+        version = await self._version(user_id) # read first, a write landing during the load bumps it again
+        with metrics.span("memory", "load"):
+            memories = await self.store.load(user_id) if self.store else []
+        stale = [m for m in memories if m.embedder != self.embedder.name or len(m.vector) != self.embedder.dim]
+        if stale: # stored by another embedder, re-embed once
+            for memory, vector in zip(stale, await self.embedder.embed([m.text for m in stale])):
+                memory.vector, memory.embedder = vector, self.embedder.name
+            self._mark(user_id, stale)
+        loaded = UserMemories(VectorIndex(self.embedder.dim, self.ann_threshold), version or 0)
+        loaded.add(memories)
+        self._users.set(user_id, loaded)
+        self._maybe_train(user_id, loaded)
+        return loaded
+
+    async def __call__(self, state: dict) -> dict: # graph `memory` node
+        messages = state["messages"]
+        user_id = state.get("user_id")
+        if not user_id or not messages or messages[-1].type != "human":
+            return {"memories": ""}
+        start = time.perf_counter()
+        try:
+            memories = await self.retrieve(user_id, messages[-1].text())
+        except Exception as e: # the turn goes on without memories
+            logger.warning("memory retrieval for user %s failed: %r", user_id, e)
+            return {"memories": ""}
+        self.latencies.append(time.perf_counter() - start)
+        return {"memories": self.render(memories)}
+
+    async def retrieve(self, user_id: str, text: str) -> list[Memory]:
+        """The user's memories for a message: the `always` kinds, then the most similar, within the budget."""
+        loaded = await self.user(user_id, check=True)
+        self.retrievals += 1
+        if not loaded.memories:
+            return []
+        candidates = sorted((m for m in loaded.memories.values() if m.kind in self.always), key=lambda m: m.updated_at, reverse=True)
+        query = (await self.embedder.embed([text]))[0]
+        candidates += [loaded.memories[id] for id, score in loaded.index.search(query, self.k) if score >= self.min_score]
+        picked, seen, used = [], set(), 0
+        for memory in candidates:
+            if memory.id in seen:
+                continue
+            tokens = count_tokens_approximately([memory.text])
+            if used + tokens > self.budget or len(picked) >= self.k + len(self.always):
+                break
+            picked.append(memory)
+            seen.add(memory.id)
+            used += tokens
+        self.injected += bool(picked)
+        return picked
+
+    def render(self, memories: list[Memory]) -> str:
+        if not memories:
+            return ""
+        lines = ["What you remember about this user from earlier conversations:"]
+        lines.extend(f"- {m.text} ({m.kind})" for m in memories)
+        return "\n".join(lines)
+
+    def schedule(self, user_id: str, user_text: str, answer: str):
+        """Extract memories from a finished turn in the background, call once its answer is out."""
+        if not self.extractor or not user_id:
+            return
+        if not self.extractor.worth(user_text):
+            self.skipped += 1
+            return
+        self._spawn(self._extract(user_id, user_text, answer))
+
+    def _spawn(self, coro):
+        # a fresh context: the turn's callbacks would stream the extraction model's tokens to the user
+        task = asyncio.create_task(coro, context=contextvars.Context())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _extract(self, user_id: str, user_text: str, answer: str):
+        try:
+            loaded = await self.user(user_id)
+            query = (await self.embedder.embed([user_text]))[0]
+            related = [loaded.memories[id] for id, score in loaded.index.search(query, self.k) if score >= self.min_score]
+            with metrics.span("memory", "extract"):
+                items = await self.extractor(user_text, answer, [m.text for m in related])
+            vectors = await self.embedder.embed([item["text"] for item in items])
+        except Exception as e:
+            logger.warning("memory extraction for user %s failed: %r", user_id, e)
+            return
+        self.extractions += 1
+        now = datetime.datetime.now(datetime.timezone.utc)
+        changed = []
+        for item, vector in zip(items, vectors):
+            match = loaded.index.search(vector, 1)
+            if item["replaces"] is not None:
+                memory = related[item["replaces"]]
+            elif match and match[0][1] >= self.dedup: # restated, keep one memory
+                memory = loaded.memories[match[0][0]]
+            else:
+                memory = None
+            if memory is not None and memory.id in loaded.memories:
+                memory.text, memory.kind, memory.vector, memory.updated_at = item["text"], item["kind"], vector, now
+                self.merged += 1
+            else:
+                memory = Memory(uuid.uuid4().hex[:16], item["text"], item["kind"], vector, self.embedder.name, now)
+                self.added += 1
+            loaded.add([memory])
+            changed.append(memory)
+        self._mark(user_id, changed)
+        self._maybe_train(user_id, loaded)
+
+    def _maybe_train(self, user_id: str, loaded: UserMemories):
+        if loaded.index.needs_training() and user_id not in self._training:
+            self._training.add(user_id)
+            self._spawn(self._train(user_id, loaded.index))
+
+    async def _train(self, user_id: str, index: VectorIndex):
+        try:
+            index.install(await asyncio.to_thread(index.trainer()))
+        except Exception as e: # searches stay brute force, retried when the next memory is added
+            logger.warning("training the memory index of user %s failed: %r", user_id, e)
+        finally:
+            self._training.discard(user_id)
+
+    def _mark(self, user_id: str, memories: list[Memory]):
+        if not memories or not self.store:
+            return
+        self._dirty.setdefault(user_id, {}).update((m.id, m) for m in memories)
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval) # batch what else arrives meanwhile
+            await self.flush()
+
+    async def flush(self):
+        dirty, self._dirty = self._dirty, {}
+        for user_id, memories in dirty.items():
+            try:
+                with metrics.span("memory", "save"):
+                    await self.store.save(user_id, list(memories.values()))
+            except Exception as e:
+                self.write_errors += 1
+                logger.warning("writing %d memories of user %s failed: %r", len(memories), user_id, e)
+                pending = self._dirty.setdefault(user_id, {})
+                for id, memory in memories.items():
+                    pending.setdefault(id, memory) # retried with the next flush
+                continue
+            self.written += len(memories)
+            await self._bump(user_id)
+
+    async def _bump(self, user_id: str):
+        """Tell the other workers the user's stored memories changed."""
+        if self.versions is None:
+            return
+        try:
+            version = await self.versions.incr(self._version_key(user_id))
+        except Exception as e: # the other workers catch up when their copy expires
+            logger.warning("bumping the memory version of user %s failed: %r", user_id, e)
+            return
+        loaded = self._users.get(user_id)
+        if loaded is not None and version == loaded.version + 1:
+            loaded.version = version # our own write, this copy already has it
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "retrievals": self.retrievals,
+            "injected": self.injected,
+            "p50_retrieval": statistics.median(latencies) if latencies else 0.0,
+            "p95_retrieval": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            "skipped": self.skipped,
+            "extractions": self.extractions,
+            "added": self.added,
+            "merged": self.merged,
+            "written": self.written,
+            "write_errors": self.write_errors,
+            "reloads": self.reloads,
+            "pending_writes": sum(len(m) for m in self._dirty.values()),
+            **self.embedder.stats()
+        }
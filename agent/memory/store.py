@@ -0,0 +1,117 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import numpy as np
+
+'''
+Where memories are persisted. Both stores keep each memory's text, kind and embedding (with the
+name of the embedder that produced it) per user, and are only written by the manager's
+background writer, never during a turn.
+
+PostgresMemoryStore needs:
+```sql
+CREATE TABLE IF NOT EXISTS memories (
+    user_id text NOT NULL,
+    memory_id text NOT NULL,
+    kind text NOT NULL,
+    text text NOT NULL,
+    embedder text NOT NULL,
+    embedding bytea NOT NULL,
+    created_at timestamptz NOT NULL,
+    updated_at timestamptz NOT NULL,
+    PRIMARY KEY (user_id, memory_id)
+);
+```
+'''
+
+class Memory:
+    """One durable fact or preference of a user."""
+    __slots__ = ("id", "text", "kind", "vector", "embedder", "created_at", "updated_at")
+
+    def __init__(self, id: str, text: str, kind: str = "fact", vector: np.ndarray = None, embedder: str = None, created_at: datetime.datetime = None, updated_at: datetime.datetime = None):
+        self.id = id
+        self.text = text
+        self.kind = kind
+        self.vector = vector
+        self.embedder = embedder
+        self.created_at = created_at or datetime.datetime.now(datetime.timezone.utc)
+        self.updated_at = updated_at or self.created_at
+
+
+MEMORY_UPSERT = """
+INSERT INTO memories(user_id, memory_id, kind, text, embedder, embedding, created_at, updated_at)
+VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+ON CONFLICT (user_id, memory_id) DO UPDATE SET
+    kind = EXCLUDED.kind, text = EXCLUDED.text, embedder = EXCLUDED.embedder,
+    embedding = EXCLUDED.embedding, updated_at = EXCLUDED.updated_at
+"""
+
+class PostgresMemoryStore:
+    """:param pool: asyncpg pool"""
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def load(self, user_id: str) -> list[Memory]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT * FROM memories WHERE user_id = $1", user_id)
+        return [
+            Memory(row["memory_id"], row["text"], row["kind"], np.frombuffer(row["embedding"], np.float32), row["embedder"], row["created_at"], row["updated_at"])
+            for row in rows
+        ]
+
+    async def save(self, user_id: str, memories: list[Memory], deleted: list[str] = ()):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if deleted:
+                    await conn.execute("DELETE FROM memories WHERE user_id = $1 AND memory_id = ANY($2::text[])", user_id, list(deleted))
+                if memories:
+                    await conn.executemany(MEMORY_UPSERT, [
+                        (user_id, m.id, m.kind, m.text, m.embedder, m.vector.astype(np.float32).tobytes(), m.created_at, m.updated_at)
+                        for m in memories
+                    ])
+
+
+class DiskMemoryStore:
+    """
+    One .npz file per user under `path` (named by the hash of their id), for running without Postgres (e.g. the CLI).
+    A save rewrites the user's file, fine for the few hundred memories a user has.
+    """
+    def __init__(self, path: str = "memories"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, user_id: str) -> str:
+        # hashed, a user id is never trusted as a path
+        return os.path.join(self.path, f"{hashlib.sha256(user_id.encode()).hexdigest()}.npz")
+
+    def _read(self, user_id: str) -> dict[str, Memory]:
+        if not os.path.exists(self._file(user_id)):
+            return {}
+        with np.load(self._file(user_id)) as data:
+            meta, vectors = json.loads(str(data["meta"])), data["vectors"]
+        return {
+            m["id"]: Memory(m["id"], m["text"], m["kind"], vector, m["embedder"], datetime.datetime.fromisoformat(m["created_at"]), datetime.datetime.fromisoformat(m["updated_at"]))
+            for m, vector in zip(meta, vectors)
+        }
+
+    def _write(self, user_id: str, memories: list[Memory], deleted: list[str]):
+        current = self._read(user_id)
+        for id in deleted:
+            current.pop(id, None)
+        current.update((m.id, m) for m in memories)
+        meta = [
+            {"id": m.id, "text": m.text, "kind": m.kind, "embedder": m.embedder, "created_at": m.created_at.isoformat(), "updated_at": m.updated_at.isoformat()}
+            for m in current.values()
+        ]
+        vectors = np.stack([m.vector for m in current.values()]) if current else np.zeros((0, 0), np.float32)
+        tmp = self._file(user_id) + ".tmp.npz"
+        np.savez(tmp, meta=json.dumps(meta), vectors=vectors)
+        os.replace(tmp, self._file(user_id)) # readers never see a half written file
+
+    async def load(self, user_id: str) -> list[Memory]:
+        return list((await asyncio.to_thread(self._read, user_id)).values())
+
+    async def save(self, user_id: str, memories: list[Memory], deleted: list[str] = ()):
+        await asyncio.to_thread(self._write, user_id, memories, list(deleted))
@@ -1,21 +1,36 @@
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-import yaml
+from langchain_core.messages import SystemMessage
 import datetime
 from zoneinfo import ZoneInfo
-
-with open("config.yml", "r") as f: config = yaml.safe_load(f)
+from utils.config import config
 
 with open(f"prompts/{config["prompts"][config["prompts"]["active"]]}") as f: sys_prompt = f.read()
 
 location = ["Denver, Colorado", ZoneInfo("America/Denver")]
 
+def current_context(summary: str = None) -> str:
+    """The per-turn part of the system prompt, kept out of the static prefix so the prefix stays cacheable."""
+    context = f"The current time in {location[0]} is {datetime.datetime.now(location[1]).strftime('%Y-%m-%d %H:%M:%S')}"
+    if summary:
+        context += f"\n\nSummary of the earlier conversation with this user:\n{summary}"
+    return context
 
+# The static system prompt goes first and is byte-identical on every turn, so providers can reuse
+# it from cache. Gemini merges the second system message into the same system instruction.
 prompt_template = ChatPromptTemplate.from_messages(
     [
-        (
-            "system",
-            sys_prompt + f"The current time in {location[0]} is {datetime.datetime.now(location[1]).strftime('%Y-%m-%d %H:%M:%S')}",
-        ),
+        SystemMessage(sys_prompt),
+        ("system", "{context}"),
+        MessagesPlaceholder(variable_name="messages"),
+    ]
+).partial(context=current_context)
+
+# Used when the system prompt and tool declarations are served from an explicit context cache.
+# A request that uses a cache can't carry a system instruction, so the dynamic context rides in
+# a leading user turn instead.
+cached_prompt_template = ChatPromptTemplate.from_messages(
+    [
+        ("human", "{context}"),
         MessagesPlaceholder(variable_name="messages"),
     ]
-)
\ No newline at end of file
+).partial(context=current_context)
@@ -0,0 +1,365 @@
+import asyncio
+import collections
+import logging
+import random
+import statistics
+import time
+from typing import Any, AsyncIterator, Callable, Iterable, Optional
+from google.api_core import exceptions as google_errors
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableBinding
+from pydantic import PrivateAttr
+from agent.lazy_model import LazyChatModel
+from agent.wrapped_model import INNER, WrapperChatModel
+
+logger = logging.getLogger(__name__)
+
+'''
+Keeps model calls answering when the provider is slow or failing. ResilientChatModel wraps the
+primary model and its fallbacks and is used wherever a chat model goes (bind_tools,
+create_react_agent, streaming). Each call:
+
+1. skips models whose provider's circuit breaker is open
+2. gives each attempt a deadline, `first_token_timeout` until the first streamed chunk and
+   `timeout` in total
+3. optionally sends a second, hedged request when the first one is slower than the
+   `hedge_percentile` latency of recent calls, and keeps whichever answers first
+4. retries timeouts, 5xx and dropped connections with jittered exponential backoff, and
+   falls back to the next model once retries run out (without retrying on a rate limit, quotas
+   are per model)
+
+These retries sit on top of the provider's own: langchain_google_genai (2.1.x) retries every
+Google API error, rate limits included, once after at least 2 seconds inside each attempt, and
+can't be told not to. So an attempt is up to two calls to Gemini, a rate limit reaches the
+fallback after that inner retry, and the attempt's deadline covers both calls.
+
+A stream is only retried before its first chunk, once tokens reached the client a failure is
+raised. Calls pinned to the primary model, e.g. with its `cached_content`, never fall back.
+'''
+
+# kwargs that only make sense for the primary model
+PINNED = ("cached_content",)
+
+def classify(error: BaseException) -> Optional[str]:
+    """"timeout", "rate_limited" or "unavailable" for errors worth another attempt, None otherwise."""
+    if isinstance(error, (TimeoutError, google_errors.DeadlineExceeded)):
+        return "timeout"
+    if isinstance(error, google_errors.TooManyRequests): # ResourceExhausted included
+        return "rate_limited"
+    if isinstance(error, (ConnectionError, google_errors.ServerError)):
+        return "unavailable"
+    return None
+
+def provider(model) -> str:
+    """LangChain provider name of a chat model, tool bindings included."""
+    while isinstance(model, RunnableBinding):
+        model = model.bound
+    try:
+        return model._get_ls_params().get("ls_provider") or type(model).__name__
+    except Exception:
+        return type(model).__name__
+
+
+class CircuitOpen(Exception):
+    """Every model of a call was skipped because its provider's breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calling a provider that keeps failing. After `failures` failures in a row it opens and
+    calls skip the provider for `reset` seconds, then lets a single probe call through (half-open):
+    its success closes it, its failure opens it for `reset` more seconds. A probe that never
+    reports back, e.g. a cancelled turn, is replaced by another after `reset` seconds.
+    """
+    CLOSED, OPEN, HALF_OPEN = 0, 1, 2
+
+    def __init__(self, failures: int = 5, reset: float = 30.0):
+        self.failures = failures
+        self.reset = reset
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.probe_at = None # when the half-open probe was let through
+        self.opened = 0 # times it opened
+
+    def _half_open(self):
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset:
+            self.state = self.HALF_OPEN
+            self.probe_at = None
+
+    def allow(self) -> bool:
+        self._half_open()
+        if self.state == self.HALF_OPEN:
+            now = time.monotonic()
+            if self.probe_at is not None and now - self.probe_at < self.reset:
+                return False # a probe is in flight, the others keep skipping the provider
+            self.probe_at = now
+        return self.state != self.OPEN
+
+    def success(self):
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.probe_at = None
+
+    def failure(self):
+        self.consecutive += 1
+        if self.state == self.HALF_OPEN or self.consecutive >= self.failures:
+            if self.state != self.OPEN:
+                self.opened += 1
+                logger.warning("circuit opened after %d failures", self.consecutive)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self.probe_at = None
+
+    def stats(self) -> dict:
+        self._half_open() # report half-open once the reset time passed, without taking the probe
+        return {"state": self.state, "consecutive_failures": self.consecutive, "opened": self.opened}
+
+
+breakers: dict[str, CircuitBreaker] = {} # provider -> breaker, shared by every wrapper in the process
+
+def breaker(name: str, failures: int = 5, reset: float = 30.0) -> CircuitBreaker:
+    if name not in breakers:
+        breakers[name] = CircuitBreaker(failures, reset)
+    return breakers[name]
+
+def breaker_stats() -> dict:
+    return {name: b.stats() for name, b in breakers.items()}
+
+
+class ResilientChatModel(WrapperChatModel):
+    """
+    :param models: the primary model followed by its fallbacks, in the order they are tried
+    :param providers: breaker name of each model, by default its LangChain provider
+    :param timeout: seconds an attempt may take in total
+    :param first_token_timeout: seconds a streamed attempt may take to its first chunk
+    :param retries: retries per model before falling back to the next one, each attempt may be two provider calls (see above)
+    :param backoff: base seconds of the jittered exponential backoff between retries
+    :param max_backoff: longest wait between retries
+    :param hedge: send a hedged request when an attempt is slower than usual
+    :param hedge_percentile: latency percentile of recent attempts after which the hedge is sent
+    :param hedge_delay: hedge delay until `min_samples` attempts have been timed
+    :param min_samples: timed attempts needed before the percentile is used
+    :param breaker_failures: failures in a row that open a provider's breaker
+    :param breaker_reset: seconds a breaker stays open
+    """
+    models: list[Any]
+    providers: Optional[list[str]] = None
+    timeout: float = 60.0
+    first_token_timeout: float = 20.0
+    retries: int = 2
+    backoff: float = 0.5
+    max_backoff: float = 8.0
+    hedge: bool = False
+    hedge_percentile: float = 0.95
+    hedge_delay: float = 3.0
+    min_samples: int = 20
+    breaker_failures: int = 5
+    breaker_reset: float = 30.0
+    _latencies: dict = PrivateAttr(default=None)
+    _stats: Any = PrivateAttr(default_factory=collections.Counter)
+
+    def model_post_init(self, __context: Any):
+        # seconds to the answer (invoke) and to the first chunk (stream) of winning attempts
+        self._latencies = {False: collections.deque(maxlen=1000), True: collections.deque(maxlen=1000)}
+        if self.providers is None:
+            self.providers = [provider(model) for model in self.models]
+
+    @property
+    def _llm_type(self) -> str:
+        return "resilient-chat-model"
+
+    def _get_ls_params(self, stop: Optional[list[str]] = None, **kwargs) -> dict:
+        primary = self.models[0]
+        while isinstance(primary, RunnableBinding):
+            primary = primary.bound
+        if isinstance(primary, BaseChatModel): # metrics are labelled with the primary model's name
+            return primary._get_ls_params(stop=stop)
+        return super()._get_ls_params(stop=stop, **kwargs)
+
+    def _chain(self, kwargs: dict) -> tuple[list[tuple[Any, str]], dict]:
+        """(model, breaker name) pairs to try and the kwargs left for them."""
+        models, kwargs = self._with_tools(self.models, kwargs)
+        chain = list(zip(models, self.providers))
+        if any(kwargs.get(name) is not None for name in PINNED):
+            chain = chain[:1]
+        return chain, kwargs
+
+    def current_hedge_delay(self, streaming: bool) -> float:
+        latencies = self._latencies[streaming]
+        if len(latencies) < self.min_samples:
+            return self.hedge_delay
+        return sorted(latencies)[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile))]
+
+    async def _race(self, attempt: Callable[[], Any], streaming: bool, cleanup: Callable = None):
+        """Result of `attempt()` under its deadline, hedged with a second one when it is slow."""
+        deadline = self.first_token_timeout if streaming else self.timeout
+        starts = {}
+        def launch():
+            task = asyncio.create_task(asyncio.wait_for(attempt(), deadline))
+            starts[task] = time.perf_counter()
+            return task
+        tasks = [launch()]
+        try:
+            if self.hedge:
+                done, _ = await asyncio.wait(tasks, timeout=self.current_hedge_delay(streaming))
+                if not done:
+                    self._stats["hedged"] += 1
+                    tasks.append(launch())
+            error = None
+            while tasks:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None:
+                        if starts[task] != min(starts.values()):
+                            self._stats["hedge_wins"] += 1
+                        self._latencies[streaming].append(time.perf_counter() - starts[task])
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks: # the slower attempt
+                task.cancel()
+            for result in await asyncio.gather(*tasks, return_exceptions=True):
+                if cleanup and not isinstance(result, BaseException):
+                    await cleanup(result) # finished before it could be cancelled
+
+    async def _call(self, attempt: Callable[[Any], Any], streaming: bool, kwargs: dict, cleanup: Callable = None):
+        """
+        Run `attempt(model, kwargs)` through the chain of models until one succeeds.
+        :return: its result and the breaker of the model that produced it
+        """
+        chain, kwargs = self._chain(kwargs)
+        self._stats["calls"] += 1
+        last_error = None
+        for i, (model, name) in enumerate(chain):
+            circuit = breaker(name, self.breaker_failures, self.breaker_reset)
+            if not circuit.allow():
+                self._stats["breaker_skips"] += 1
+                continue
+            if last_error is not None:
+                self._stats["fallbacks"] += 1
+                logger.warning("falling back to model %d of %d after %r", i + 1, len(chain), last_error)
+            for retry in range(self.retries + 1):
+                if retry:
+                    self._stats["retries"] += 1
+                    await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))) # full jitter
+                try:
+                    result = await self._race(lambda: attempt(model, kwargs), streaming, cleanup)
+                except Exception as e:
+                    kind = classify(e)
+                    if kind is None:
+                        self._stats["failed"] += 1
+                        raise
+                    self._stats[kind] += 1
+                    last_error = e
+                    if kind != "rate_limited":
+                        circuit.failure()
+                    if not circuit.allow() or (kind == "rate_limited" and i < len(chain) - 1):
+                        break # on to the next model
+                    continue
+                circuit.success()
+                return result, circuit
+        self._stats["failed"] += 1
+        raise last_error or CircuitOpen(f"circuit open for {sorted(set(name for _, name in chain))}")
+
+    def _generate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        # sync callers get the fallback chain only, deadlines and hedging need the event loop
+        chain, kwargs = self._chain(kwargs)
+        for i, (model, _) in enumerate(chain):
+            try:
+                message = model.invoke(messages, INNER, stop=stop, **kwargs)
+                return ChatResult(generations=[ChatGeneration(message=message)])
+            except Exception as e:
+                if classify(e) is None or i == len(chain) - 1:
+                    raise
+
+    async def _agenerate(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        async def attempt(model, kwargs):
+            return await model.ainvoke(messages, INNER, stop=stop, **kwargs)
+        message, _ = await self._call(attempt, False, kwargs)
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages: list[BaseMessage], stop: Optional[list[str]] = None, run_manager=None, **kwargs) -> AsyncIterator[ChatGenerationChunk]:
+        async def attempt(model, kwargs):
+            started = time.perf_counter()
+            stream = aiter(model.astream(messages, INNER, stop=stop, **kwargs))
+            try:
+                return await anext(stream), stream, started
+            except BaseException:
+                await stream.aclose()
+                raise
+        async def cleanup(result):
+            await result[1].aclose()
+
+        (chunk, stream, started), circuit = await self._call(attempt, True, kwargs, cleanup)
+        try:
+            while True:
+                generation = ChatGenerationChunk(message=chunk if isinstance(chunk, AIMessageChunk) else AIMessageChunk(content=chunk.content))
+                if run_manager:
+                    await run_manager.on_llm_new_token(generation.text, chunk=generation)
+                yield generation
+                remaining = self.timeout - (time.perf_counter() - started)
+                try:
+                    chunk = await asyncio.wait_for(anext(stream), max(0.0, remaining))
+                except StopAsyncIteration:
+                    break
+        except Exception as e:
+            kind = classify(e)
+            if kind:
+                self._stats["stream_" + kind] += 1 # too late to retry, part of the answer was sent
+                if kind != "rate_limited":
+                    circuit.failure()
+            raise
+        finally:
+            await stream.aclose()
+
+    async def warm(self):
+        """Open the wrapped models' connections, so the first turn doesn't pay for the handshake."""
+        seen = set()
+        for model in self.models:
+            while isinstance(model, RunnableBinding):
+                model = model.bound
+            if id(model) in seen:
+                continue
+            seen.add(id(model))
+            try:
+                await warm_model(model)
+                self._stats["warmed"] += 1
+            except Exception as e:
+                logger.warning("warming %s failed: %r", provider(model), e)
+
+    def stats(self) -> dict:
+        streamed = sorted(self._latencies[True])
+        return {
+            **{key: self._stats[key] for key in ("calls", "retries", "fallbacks", "hedged", "hedge_wins", "timeout", "rate_limited", "unavailable", "breaker_skips", "failed")},
+            "hedge_delay": self.current_hedge_delay(True),
+            "p50_first_chunk": statistics.median(streamed) if streamed else 0.0,
+            "p95_first_chunk": streamed[int(len(streamed) * 0.95)] if streamed else 0.0
+        }
+
+
+async def warm_model(model: BaseChatModel):
+    if isinstance(model, LazyChatModel):
+        model = await asyncio.to_thread(model.load) # the import is slow, keep it off the loop
+    client = getattr(model, "async_client", None) # Gemini: builds the gRPC channel, counting tokens is free
+    if client is not None:
+        await client.count_tokens(request={"model": model.model, "contents": [{"role": "user", "parts": [{"text": "ping"}]}]})
+    # other models connect on first use
+
+async def warm(models: Iterable[ResilientChatModel], timeout: float = 10.0):
+    """Warm every model at once, giving up after `timeout` seconds."""
+    try:
+        await asyncio.wait_for(asyncio.gather(*(model.warm() for model in models)), timeout)
+    except asyncio.TimeoutError:
+        logger.warning("warming the models took over %ss", timeout)
+
+async def keep_warm(models: Iterable[ResilientChatModel], interval: float = 240.0):
+    """Re-warm every `interval` seconds so idle connections aren't dropped, run it as a background task."""
+    models = list(models)
+    while True:
+        await asyncio.sleep(interval)
+        await warm(models)
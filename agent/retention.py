@@ -0,0 +1,202 @@
+import asyncio
+import json
+import logging
+import time
+from langgraph.checkpoint.redis import AsyncRedisSaver
+from langgraph.checkpoint.redis.base import CHECKPOINT_PREFIX, CHECKPOINT_BLOB_PREFIX, CHECKPOINT_WRITE_PREFIX
+from langgraph.checkpoint.redis.util import to_storage_safe_id, to_storage_safe_str
+from redisvl.index import AsyncSearchIndex
+from redisvl.query import FilterQuery
+from redisvl.query.filter import Tag
+
+logger = logging.getLogger(__name__)
+
+ROOT_NS = to_storage_safe_str("")
+
+ARCHIVE_SQL = """
+INSERT INTO checkpoint_archive(thread_id, checkpoint_type, checkpoint, metadata, archived_at)
+VALUES ($1, $2, $3, $4, NOW())
+ON CONFLICT (thread_id) DO UPDATE
+SET checkpoint_type = $2, checkpoint = $3, metadata = $4, archived_at = NOW()
+"""
+
+class CheckpointRetention:
+    """
+    Retention policy for the AsyncRedisSaver checkpointer.
+    After every turn (`schedule`) it prunes a thread down to its last `keep_last` root checkpoints,
+    along with their pending writes, subgraph checkpoints and channel blobs no kept checkpoint
+    references. It also either sets `idle_ttl` on what is left or, with `offload` on, records the
+    thread's activity so `sweep` can move idle threads to Postgres and `restore` can bring them back.
+    :param saver: the graph's checkpointer, its search indexes are used to find a thread's keys
+    :param keep_last: root checkpoints kept per thread
+    :param idle_ttl: seconds after the last turn before Redis drops the thread, None keeps it forever
+    :param offload: archive idle threads to the `checkpoint_archive` table instead of letting them expire
+    :param offload_after: seconds without a turn before `sweep` archives a thread
+    :param sweep_interval: seconds between the sweeps `run_sweeps` makes
+    :param pool: asyncpg pool, required for offload
+    """
+    ACTIVITY_KEY = "checkpoint_activity" # zset thread_id -> last turn epoch
+    ARCHIVED_PREFIX = "checkpoint_archived:"
+    SWEEP_KEY = "checkpoint_sweep" # set by the worker sweeping this interval
+
+    def __init__(self, saver: AsyncRedisSaver, keep_last: int = 20, idle_ttl: int = 7 * 86400, offload: bool = False, offload_after: int = 7 * 86400, sweep_interval: float = 3600, pool=None):
+        if keep_last < 1:
+            raise ValueError("keep_last must be at least 1, the latest checkpoint is the thread's state")
+        self.saver = saver
+        self.redis = saver._redis
+        self.keep_last = keep_last
+        self.idle_ttl = None if offload else idle_ttl # offloaded threads must outlive the sweep interval
+        self.offload = offload
+        self.offload_after = offload_after
+        self.sweep_interval = sweep_interval
+        self.pool = pool
+        self._tasks: dict[str, asyncio.Task] = {}
+
+    async def _find(self, index: AsyncSearchIndex, thread_id: str, fields: list) -> list[dict]:
+        query = FilterQuery(filter_expression=Tag("thread_id") == to_storage_safe_id(thread_id), return_fields=fields)
+        docs = []
+        async for batch in index.paginate(query, page_size=500):
+            docs.extend(batch)
+        return docs
+
+    async def thread_keys(self, thread_id: str) -> dict:
+        """All checkpoint, write and blob documents of a thread, as returned by the saver's indexes."""
+        # blobs and writes first: a checkpoint and its blobs are written in one transaction, so
+        # anything found here is guaranteed to have its checkpoint show up in the later search
+        blobs = await self._find(self.saver.checkpoint_blobs_index, thread_id, ["checkpoint_ns", "channel", "version"])
+        writes = await self._find(self.saver.checkpoint_writes_index, thread_id, ["checkpoint_ns", "checkpoint_id"])
+        checkpoints = await self._find(self.saver.checkpoints_index, thread_id, ["checkpoint_ns", "checkpoint_id"])
+        return {"checkpoints": checkpoints, "writes": writes, "blobs": blobs}
+
+    async def prune(self, thread_id: str) -> int:
+        """
+        Drop everything but the last `keep_last` root checkpoints of a thread and refresh its TTL.
+        :return: number of keys deleted
+        """
+        docs = await self.thread_keys(thread_id)
+        root = sorted((d for d in docs["checkpoints"] if d["checkpoint_ns"] == ROOT_NS), key=lambda d: d["checkpoint_id"]) # ids are time ordered
+        if not root:
+            return 0
+        kept = root[-self.keep_last:]
+        cutoff = kept[0]["checkpoint_id"]
+        kept_ids = {d["id"] for d in kept}
+        # subgraph (e.g. the nested react agent) checkpoints only matter for runs newer than the cutoff
+        kept_ids.update(d["id"] for d in docs["checkpoints"] if d["checkpoint_ns"] != ROOT_NS and d["checkpoint_id"] >= cutoff)
+
+        kept_checkpoints = {(d["checkpoint_ns"], d["checkpoint_id"]) for d in docs["checkpoints"] if d["id"] in kept_ids}
+        drop = {d["id"] for d in docs["checkpoints"] if d["id"] not in kept_ids}
+        drop.update(d["id"] for d in docs["writes"] if (d["checkpoint_ns"], d["checkpoint_id"]) not in kept_checkpoints)
+
+        # blobs are shared between checkpoints, keep every (channel, version) a kept checkpoint points at
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key in kept_ids:
+                pipe.json().get(key, "$.checkpoint_ns", "$.checkpoint.channel_versions")
+            versions = await pipe.execute()
+        referenced = set()
+        for doc in versions:
+            if not doc or not doc.get("$.checkpoint.channel_versions"):
+                continue
+            ns = doc["$.checkpoint_ns"][0]
+            referenced.update((ns, channel, str(version)) for channel, version in doc["$.checkpoint.channel_versions"][0].items())
+        drop.update(d["id"] for d in docs["blobs"] if (d["checkpoint_ns"], d["channel"], d["version"]) not in referenced)
+
+        remaining = [d["id"] for group in docs.values() for d in group if d["id"] not in drop]
+        drop = list(drop)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for i in range(0, len(drop), 500):
+                pipe.delete(*drop[i:i + 500])
+            if self.idle_ttl:
+                for key in remaining:
+                    pipe.expire(key, self.idle_ttl)
+            if self.offload:
+                pipe.zadd(self.ACTIVITY_KEY, {thread_id: time.time()})
+            await pipe.execute()
+        return len(drop)
+
+    def schedule(self, thread_id: str):
+        """Prune a thread in the background, call once a turn has finished."""
+        if thread_id in self._tasks:
+            return
+        task = asyncio.create_task(self.prune(thread_id))
+        self._tasks[thread_id] = task
+        task.add_done_callback(lambda t: self._done(thread_id, t))
+
+    def _done(self, thread_id: str, task: asyncio.Task):
+        self._tasks.pop(thread_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("checkpoint pruning for thread %s failed: %r", thread_id, task.exception())
+
+    async def delete(self, thread_id: str):
+        docs = await self.thread_keys(thread_id)
+        keys = [d["id"] for group in docs.values() for d in group]
+        for i in range(0, len(keys), 500):
+            await self.redis.delete(*keys[i:i + 500])
+
+    async def archive(self, thread_id: str) -> bool:
+        """Copy a thread's latest checkpoint to Postgres and remove it from Redis."""
+        tup = await self.saver.aget_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}})
+        if tup is None:
+            return False
+        type_, data = self.saver.serde.dumps_typed(tup.checkpoint)
+        async with self.pool.acquire() as conn:
+            await conn.execute(ARCHIVE_SQL, thread_id, type_, data if isinstance(data, bytes) else data.encode(), json.dumps(tup.metadata, default=str))
+        await self.redis.set(self.ARCHIVED_PREFIX + thread_id, 1)
+        await self.delete(thread_id)
+        await self.redis.zrem(self.ACTIVITY_KEY, thread_id)
+        return True
+
+    async def restore(self, thread_id: str) -> bool:
+        """Bring an archived thread back into Redis. A single EXISTS when the thread isn't archived."""
+        if not self.offload or not await self.redis.exists(self.ARCHIVED_PREFIX + thread_id):
+            return False
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT checkpoint_type, checkpoint, metadata FROM checkpoint_archive WHERE thread_id = $1", thread_id)
+        if row is not None:
+            checkpoint = self.saver.serde.loads_typed((row["checkpoint_type"], bytes(row["checkpoint"])))
+            await self.saver.aput(
+                {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}},
+                checkpoint,
+                json.loads(row["metadata"]),
+                checkpoint["channel_versions"]
+            )
+        await self.redis.delete(self.ARCHIVED_PREFIX + thread_id)
+        return row is not None
+
+    async def sweep(self) -> int:
+        """Archive every thread idle for longer than `offload_after`. Run periodically when offload is on."""
+        idle = await self.redis.zrangebyscore(self.ACTIVITY_KEY, "-inf", time.time() - self.offload_after)
+        archived = 0
+        for thread_id in idle:
+            thread_id = thread_id.decode() if isinstance(thread_id, bytes) else thread_id
+            archived += await self.archive(thread_id)
+        return archived
+
+    async def run_sweeps(self):
+        """
+        Sweep every `sweep_interval` seconds, run it as a background task when offload is on.
+        Only the first worker to get there in an interval sweeps.
+        """
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                if await self.redis.set(self.SWEEP_KEY, 1, nx=True, ex=max(1, int(self.sweep_interval))):
+                    archived = await self.sweep()
+                    if archived:
+                        logger.info("archived %s idle threads", archived)
+            except Exception as e:
+                logger.warning("checkpoint sweep failed: %r", e)
+
+    async def report(self) -> list[dict]:
+        """Per-thread checkpoint, write and blob counts and their memory usage in bytes, largest first."""
+        threads = {}
+        for prefix, kind in ((CHECKPOINT_PREFIX, "checkpoints"), (CHECKPOINT_WRITE_PREFIX, "writes"), (CHECKPOINT_BLOB_PREFIX, "blobs")):
+            keys = [k.decode() if isinstance(k, bytes) else k async for k in self.redis.scan_iter(match=f"{prefix}:*", count=1000)]
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.memory_usage(key)
+                sizes = await pipe.execute()
+            for key, size in zip(keys, sizes):
+                thread = threads.setdefault(key.split(":")[1], {"checkpoints": 0, "writes": 0, "blobs": 0, "bytes": 0})
+                thread[kind] += 1
+                thread["bytes"] += size or 0
+        return sorted(({"thread_id": k, **v} for k, v in threads.items()), key=lambda t: t["bytes"], reverse=True)
@@ -0,0 +1,123 @@
+import collections
+import re
+import statistics
+from typing import Callable
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+# (messages of the thread) -> route name
+Classifier = Callable[[list[BaseMessage]], str]
+
+SMALL_TALK = re.compile(r"^\W*(hi|hello|hey|thanks|thank you|thx|ok|okay|cool|great|nice|got it|perfect|bye|good (morning|night))\b", re.I)
+CONFIRMATION = re.compile(r"^\W*(yes|yeah|yep|sure|please do|do it|go ahead|sounds good|confirm|no|nope)\b", re.I)
+LOOKUP = re.compile(r"\b(what('s| is| do i have)|do i have|am i (free|busy)|anything (on|planned)|show|list|when is|what time)\b", re.I)
+# multi-step or write requests, always sent to the full model
+COMPLEX = re.compile(
+    r"\b(reschedul\w*|move|push|cancel|delete|remove|shift|swap|rearrange|recurring|every|weekly|daily|"
+    r"unless|if|instead|and then|after that|conflict\w*|overlap\w*|find (a |some )?time|best time|all of|each)\b", re.I)
+
+class HeuristicClassifier:
+    """
+    Picks "fast" or "full" for a turn from the user's last message, without a model call.
+    Small talk and short calendar lookups go to the fast model. Anything that writes to the
+    calendar, chains steps or has conditions goes to the full one, and so does a short reply
+    like "yes" that confirms an action the agent just proposed.
+    :param max_words: lookups longer than this are treated as complex
+    """
+    def __init__(self, max_words: int = 16, fast: str = "fast", full: str = "full"):
+        self.max_words = max_words
+        self.fast = fast
+        self.full = full
+
+    def __call__(self, messages: list[BaseMessage]) -> str:
+        human = next((i for i in range(len(messages) - 1, -1, -1) if isinstance(messages[i], HumanMessage)), None)
+        if human is None:
+            return self.full
+        text = messages[human].text().strip()
+        previous = next((m for m in reversed(messages[:human]) if isinstance(m, AIMessage) and m.text()), None)
+        if CONFIRMATION.match(text) and previous is not None and previous.text().rstrip().endswith("?"):
+            return self.full # the agent asked before acting, the next step is the action itself
+        if COMPLEX.search(text):
+            return self.full
+        words = len(text.split())
+        if SMALL_TALK.match(text) and words <= 6:
+            return self.fast
+        if LOOKUP.search(text) and words <= self.max_words:
+            return self.fast
+        return self.full
+
+
+class RouteStats:
+    """Latency and token/cost counters for one route."""
+    def __init__(self, input_cost: float = 0.0, output_cost: float = 0.0, window: int = 1000):
+        self.input_cost = input_cost # $ per million tokens
+        self.output_cost = output_cost
+        self.turns = 0
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.latencies = collections.deque(maxlen=window) # seconds per model node run
+
+    def record(self, latency: float, messages: list[BaseMessage]):
+        self.calls += 1
+        self.latencies.append(latency)
+        for message in messages:
+            usage = getattr(message, "usage_metadata", None)
+            if usage:
+                self.input_tokens += usage.get("input_tokens", 0)
+                self.output_tokens += usage.get("output_tokens", 0)
+
+    @property
+    def cost(self) -> float:
+        return (self.input_tokens * self.input_cost + self.output_tokens * self.output_cost) / 1e6
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "turns": self.turns,
+            "calls": self.calls,
+            "p50_latency": statistics.median(latencies) if latencies else 0.0,
+            "p95_latency": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cost": self.cost
+        }
+
+
+class Router:
+    """
+    Graph node choosing which model tier answers a turn. It runs once per turn, before the
+    model node, and stores the route in `state["route"]` so tool round trips within the turn
+    stay on the same model.
+    :param routes: route name -> the runnable (react agent) serving it
+    :param classifier: callable (messages) -> route name
+    :param default: route used when the classifier returns an unknown name
+    :param costs: route name -> {"input_cost": $/1M tokens, "output_cost": $/1M tokens}
+    """
+    def __init__(self, routes: dict, classifier: Classifier, default: str = "full", costs: dict = None):
+        if default not in routes:
+            raise ValueError(f"default route {default!r} is not one of {list(routes)}")
+        self.routes = routes
+        self.classifier = classifier
+        self.default = default
+        costs = costs or {}
+        self.stats = {name: RouteStats(**costs.get(name, {})) for name in routes}
+
+    def classify(self, messages: list[BaseMessage]) -> str:
+        route = self.classifier(messages)
+        return route if route in self.routes else self.default
+
+    async def __call__(self, state: dict) -> dict: # graph `router` node
+        route = self.classify(state["messages"])
+        self.stats[route].turns += 1
+        return {"route": route}
+
+    def get(self, route: str):
+        """The runnable serving a route, the default one for unknown or missing routes."""
+        return self.routes.get(route) or self.routes[self.default]
+
+    def record(self, route: str, latency: float, messages: list[BaseMessage]):
+        """Count one model node run, call with the messages it produced."""
+        self.stats.get(route, self.stats[self.default]).record(latency, messages)
+
+    def report(self) -> dict:
+        return {name: stats.summary() for name, stats in self.stats.items()}
@@ -0,0 +1,89 @@
+import datetime
+from zoneinfo import ZoneInfo
+
+'''
+Interval arithmetic behind the calendar tool's find_slots action. Intervals are (start, end)
+pairs of aware datetimes, half open. Everything is a sort plus linear sweeps, so a busy list of
+n intervals costs O(n log n) however long the searched range is.
+'''
+
+Interval = tuple[datetime.datetime, datetime.datetime]
+
+def merge(intervals: list[Interval], buffer: datetime.timedelta = datetime.timedelta(0)) -> list[Interval]:
+    """Sort and merge overlapping or touching intervals, each padded by `buffer` on both sides."""
+    merged = []
+    for start, end in sorted((s - buffer, e + buffer) for s, e in intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+def working_windows(
+        time_min: datetime.datetime,
+        time_max: datetime.datetime,
+        tz: ZoneInfo,
+        day_start: datetime.time = datetime.time(9),
+        day_end: datetime.time = datetime.time(17),
+        weekends: bool = False) -> list[Interval]:
+    """Working hours of every local day between time_min and time_max, clipped to the range.
+    Days are built in `tz`, so DST shifts move the window with the wall clock."""
+    windows = []
+    day = time_min.astimezone(tz).date()
+    last = time_max.astimezone(tz).date()
+    while day <= last:
+        if weekends or day.weekday() < 5:
+            start = max(datetime.datetime.combine(day, day_start, tz), time_min)
+            end = min(datetime.datetime.combine(day, day_end, tz), time_max)
+            if start < end:
+                windows.append((start, end))
+        day += datetime.timedelta(days=1)
+    return windows
+
+def subtract(windows: list[Interval], busy: list[Interval]) -> list[Interval]:
+    """Free parts of sorted, disjoint `windows` once sorted, merged `busy` is removed (one sweep)."""
+    free = []
+    i = 0
+    for start, end in windows:
+        while i < len(busy) and busy[i][1] <= start: # busy intervals entirely before this window
+            i += 1
+        cursor = start
+        j = i
+        while j < len(busy) and busy[j][0] < end:
+            if busy[j][0] > cursor:
+                free.append((cursor, busy[j][0]))
+            cursor = max(cursor, busy[j][1])
+            j += 1
+        if cursor < end:
+            free.append((cursor, end))
+    return free
+
+def _align(dt: datetime.datetime, step: datetime.timedelta) -> datetime.datetime:
+    """Round up to the next multiple of `step` past the hour, e.g. 10:07 -> 10:15 for 15 minutes."""
+    base = dt.replace(minute=0, second=0, microsecond=0)
+    steps = -(-(dt - base) // step)
+    return base + steps * step
+
+def candidate_slots(free: list[Interval], duration: datetime.timedelta, limit: int = 5, step: datetime.timedelta = datetime.timedelta(minutes=15)) -> list[Interval]:
+    """
+    Up to `limit` slots of `duration`, at most one per day, then filling in the earliest remaining
+    room, so the model sees options spread over the range instead of five back to back.
+    """
+    fits = []
+    for start, end in free:
+        slot_start = _align(start, step)
+        if slot_start + duration <= end:
+            fits.append((slot_start, end))
+    picked, days = [], set()
+    for start, end in fits:
+        if len(picked) < limit and start.date() not in days:
+            picked.append((start, start + duration))
+            days.add(start.date())
+    for start, end in fits: # second pass: more slots from the free intervals already used
+        cursor = start
+        while len(picked) < limit and cursor + duration <= end:
+            if (cursor, cursor + duration) not in picked:
+                picked.append((cursor, cursor + duration))
+            cursor += max(duration, step)
+    return sorted(picked)[:limit]
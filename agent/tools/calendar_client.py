@@ -0,0 +1,119 @@
+import asyncio
+import datetime
+import functools
+import json
+import httplib2
+import google_auth_httplib2
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from google.oauth2.credentials import Credentials
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document, Resource
+from googleapiclient.http import HttpRequest
+from utils.cache import TTLCache
+from utils import metrics
+from utils.config import config
+
+cal_config = config["google"].get("calendar", {})
+
+# The discovery document ships with googleapiclient. Parse it once per process instead of
+# letting `build()` read and parse it again on every tool invocation.
+DISCOVERY_DOC = json.loads(discovery_cache.get_static_doc("calendar", "v3"))
+
+# Every blocking `.execute()` runs here. The executor size is also the cap on concurrent
+# Calendar requests per worker, anything past it waits in the executor queue, not on the loop.
+executor = ThreadPoolExecutor(max_workers=cal_config.get("max_workers", 16), thread_name_prefix="gcal")
+
+def default_http_factory(creds: Credentials):
+    return google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=cal_config.get("http_timeout", 30)))
+
+http_factory: Callable = default_http_factory
+
+def set_http_factory(factory: Callable = None):
+    """
+    Swap the transport used for every Calendar request, e.g. `FakeCalendar().http_factory` in tests.
+    :param factory: callable taking credentials and returning an httplib2.Http-like object, None restores the default
+    """
+    global http_factory
+    http_factory = factory or default_http_factory
+    sessions.clear()
+
+
+def parse_time(value: str) -> datetime.datetime:
+    """Parse an RFC3339 dateTime or an all-day date (taken as midnight UTC)."""
+    dt = datetime.datetime.fromisoformat(value)
+    return dt if dt.tzinfo else dt.replace(tzinfo=datetime.timezone.utc)
+
+def event_bounds(event: dict) -> tuple[datetime.datetime, datetime.datetime]:
+    return (
+        parse_time(event["start"].get("dateTime") or event["start"]["date"]),
+        parse_time(event["end"].get("dateTime") or event["end"]["date"])
+    )
+
+
+class CalendarSession:
+    """
+    A user's Calendar service plus a small pool of HTTP objects.
+    httplib2.Http is not thread safe, so each in-flight request borrows its own from the pool
+    and hands it back afterwards, which keeps connections alive between requests.
+    """
+    def __init__(self, user_id: str, creds: Credentials, max_http: int = 4):
+        self.user_id = user_id
+        self.creds = creds
+        self.max_http = max_http
+        self._free_http = []
+        self.service: Resource = build_from_document(DISCOVERY_DOC, http=self._acquire_http())
+
+    def _acquire_http(self):
+        if self._free_http:
+            return self._free_http.pop()
+        return http_factory(self.creds)
+
+    def _release_http(self, http, creds: Credentials):
+        if creds is self.creds and len(self._free_http) < self.max_http: # drop objects tied to stale creds
+            self._free_http.append(http)
+
+    def update_creds(self, creds: Credentials):
+        if creds.token != self.creds.token: # refreshed or re-authorized
+            self.creds = creds
+            self._free_http.clear()
+
+    async def execute(self, request: HttpRequest, num_retries: int = None):
+        """
+        Run a request built from `self.service` on the Calendar executor.
+        :param request: an unexecuted googleapiclient HttpRequest
+        :param num_retries: retries on 5xx / rate limit errors, defaults to `google.calendar.num_retries`
+        :return: the parsed JSON response
+        """
+        if num_retries is None:
+            num_retries = cal_config.get("num_retries", 1)
+        creds = self.creds
+        http = self._acquire_http()
+        try:
+            with metrics.span("calendar_api", request.methodId or ""):
+                return await asyncio.get_running_loop().run_in_executor(
+                    executor,
+                    functools.partial(request.execute, http=http, num_retries=num_retries)
+                )
+        finally:
+            self._release_http(http, creds)
+
+
+sessions = TTLCache(
+    maxsize=cal_config.get("pool_size", 1024),
+    ttl=cal_config.get("pool_ttl", 900) # evict sessions idle for longer than this
+    )
+
+def get_session(user_id: str, creds: Credentials) -> CalendarSession:
+    """
+    Return the pooled Calendar session for a user, building one on first use.
+    :param user_id: Supabase user ID
+    :param creds: the user's current Google credentials
+    """
+    session: CalendarSession = sessions.get(user_id)
+    if session is None:
+        session = CalendarSession(user_id, creds, max_http=cal_config.get("http_per_user", 4))
+    else:
+        session.update_creds(creds)
+    sessions.set(user_id, session) # refresh the idle timer
+    return session
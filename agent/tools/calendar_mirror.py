@@ -0,0 +1,245 @@
+import asyncio
+import datetime
+import hmac
+import logging
+import secrets
+import uuid
+from fastapi import FastAPI
+from googleapiclient.errors import HttpError
+from utils import auth, database
+from utils.cache import TTLCache
+from agent.tools.calendar_client import CalendarSession, get_session, event_bounds, parse_time
+from utils.config import config
+
+logger = logging.getLogger(__name__)
+
+mirror_config = config["google"].get("calendar", {}).get("mirror", {})
+
+class CalendarMirror:
+    """
+    Per-user copy of the primary calendar in Postgres (`calendar_events`), kept current with
+    incremental sync: every sync sends the stored syncToken and gets back only what changed.
+    get/get_many are answered from the mirror's time and text indexes. A user is synced before a
+    query when the last sync on this worker is older than `max_staleness` seconds, or sooner when
+    a push notification arrives. Writes still go to Google and are copied into the mirror.
+    Recurring events are expanded into instances, which never end for an open series, so a full
+    sync only covers `past_days` before to `future_days` after it. Queries reaching outside that
+    range go to the API, and the range is moved forward with a new full sync every `rewindow_days`.
+    :param max_staleness: seconds a sync is trusted before the next query syncs again
+    :param page_size: events per list request while syncing
+    :param past_days: days before a full sync it copies
+    :param future_days: days after a full sync it copies
+    :param rewindow_days: days before the range is moved forward by a full sync
+    :param webhook_url: public URL of the notification endpoint, None disables push notifications
+    :param channel_ttl: requested lifetime of a notification channel in seconds
+    """
+    def __init__(self, max_staleness: int = 30, page_size: int = 2500, past_days: int = 90, future_days: int = 365, rewindow_days: int = 7, webhook_url: str = None, channel_ttl: int = 7 * 86400):
+        self.page_size = page_size
+        self.past = datetime.timedelta(days=past_days)
+        self.future = datetime.timedelta(days=future_days)
+        self.rewindow = datetime.timedelta(days=rewindow_days)
+        self.webhook_url = webhook_url
+        self.channel_ttl = channel_ttl
+        self._fresh = TTLCache(maxsize=4096, ttl=max_staleness) # user_id -> synced recently
+        self._windows = TTLCache(maxsize=4096, ttl=86400) # user_id -> (start, end) the mirror covers
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._background = set() # resyncs started by notifications
+        # metrics
+        self.syncs = 0
+        self.full_syncs = 0
+        self.events_synced = 0
+        self.queries = 0
+        self.out_of_window = 0 # get_many queries sent to the API
+        self.notifications = 0
+
+    async def _single_flight(self, user_id: str, factory):
+        task = self._inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._inflight[user_id] = task
+            task.add_done_callback(lambda t: self._inflight.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def ensure_fresh(self, app: FastAPI, session: CalendarSession):
+        if self._fresh.get(session.user_id):
+            return
+        await self._single_flight(session.user_id, lambda: self.sync(app, session))
+
+    async def _list(self, session: CalendarSession, **params) -> tuple[list, str]:
+        items, page_token = [], None
+        while True:
+            result = await session.execute(session.service.events().list(
+                calendarId="primary",
+                singleEvents=True,
+                maxResults=self.page_size,
+                pageToken=page_token,
+                **params
+            ))
+            items.extend(result.get("items", []))
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return items, result.get("nextSyncToken")
+
+    async def sync(self, app: FastAPI, session: CalendarSession) -> int:
+        """
+        Bring a user's mirror up to date, incrementally when a sync token is stored.
+        :return: number of changed events
+        """
+        user_id = session.user_id
+        state = await database.get_calendar_sync(app, user_id)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        window = (state["window_start"], state["window_end"]) if state and state["window_start"] else None
+        token = state["sync_token"] if state and window and window[0] + self.past + self.rewindow > now else None
+        changes, full = None, False
+        if token:
+            try:
+                changes, next_token = await self._list(session, syncToken=token, showDeleted=True)
+            except HttpError as e:
+                if e.resp.status != 410: # 410 Gone: token expired, start over
+                    raise
+        if changes is None:
+            window = (now - self.past, now + self.future)
+            changes, next_token = await self._list(session, timeMin=window[0].isoformat(), timeMax=window[1].isoformat())
+            full = True
+            self.full_syncs += 1
+
+        live = [e for e in changes if e.get("status") != "cancelled"]
+        await database.apply_calendar_changes(
+            app,
+            user_id,
+            [(e, *event_bounds(e)) for e in live],
+            deleted=[e["id"] for e in changes if e.get("status") == "cancelled"],
+            replace=full # a full sync replaces the mirror
+        )
+        await database.set_calendar_sync(app, user_id, sync_token=next_token, synced_at=now, window_start=window[0], window_end=window[1])
+        self._windows.set(user_id, window)
+        self._fresh.set(user_id, True)
+        self.syncs += 1
+        self.events_synced += len(changes)
+
+        if self.webhook_url and (state is None or state["channel_expires"] is None
+                or state["channel_expires"] < datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)):
+            try:
+                await self.watch(app, session, state)
+            except HttpError as e:
+                logger.warning("calendar watch for user %s failed: %r", user_id, e)
+        return len(changes)
+
+    async def watch(self, app: FastAPI, session: CalendarSession, state=None):
+        """Open a push notification channel for the user's calendar, replacing the previous one."""
+        channel_id, channel_token = str(uuid.uuid4()), secrets.token_urlsafe(24)
+        channel = await session.execute(session.service.events().watch(
+            calendarId="primary",
+            body={
+                "id": channel_id,
+                "type": "web_hook",
+                "address": self.webhook_url,
+                "token": channel_token,
+                "params": {"ttl": str(self.channel_ttl)}
+            }
+        ))
+        expires = datetime.datetime.fromtimestamp(int(channel["expiration"]) / 1000, datetime.timezone.utc) if channel.get("expiration") else None
+        await database.set_calendar_sync(
+            app,
+            session.user_id,
+            channel_id=channel_id,
+            channel_token=channel_token,
+            resource_id=channel.get("resourceId"),
+            channel_expires=expires
+        )
+        if state is not None and state["channel_id"]: # stop the old channel, it would keep notifying until it expires
+            try:
+                await session.execute(session.service.channels().stop(body={"id": state["channel_id"], "resourceId": state["resource_id"]}))
+            except HttpError:
+                pass
+
+    async def notify(self, app: FastAPI, channel_id: str, channel_token: str, resource_state: str) -> bool:
+        """
+        Handle a push notification: mark the user stale and resync in the background.
+        :return: False if the channel is unknown or the token doesn't match
+        """
+        state = await database.find_calendar_channel(app, channel_id)
+        if state is None or not hmac.compare_digest(state["channel_token"] or "", channel_token or ""):
+            return False
+        self.notifications += 1
+        if resource_state == "sync": # handshake sent when the channel is created
+            return True
+        self.mark_stale(state["user_id"])
+        task = asyncio.create_task(self._resync(app, state["user_id"]))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return True
+
+    def mark_stale(self, user_id: str):
+        """Sync the user again before their next query."""
+        self._fresh.pop(user_id, None)
+
+    async def _resync(self, app: FastAPI, user_id: str):
+        try:
+            creds = await auth.find_google_oauth_creds(app, user_id)
+            if creds is None: # disconnected, the next tool call asks the user to sign in
+                return
+            await self._single_flight(user_id, lambda: self.sync(app, get_session(user_id, creds)))
+        except Exception as e:
+            logger.warning("calendar resync for user %s failed: %r", user_id, e)
+
+    async def get_many(self, app: FastAPI, session: CalendarSession, kwargs: dict) -> list[dict]:
+        """
+        Answer an events.list query (timeMin, timeMax, q, maxResults) from the mirror.
+        :return: the events, None when the query reaches outside the synced range
+        """
+        await self.ensure_fresh(app, session)
+        window = self._windows.get(session.user_id)
+        if window is None: # synced on this worker before the range was evicted
+            await self._single_flight(session.user_id, lambda: self.sync(app, session))
+            window = self._windows.get(session.user_id)
+        start = parse_time(kwargs["timeMin"]) if kwargs.get("timeMin") else None
+        end = parse_time(kwargs["timeMax"]) if kwargs.get("timeMax") else None
+        if start is None or end is None or start < window[0] or end > window[1]:
+            self.out_of_window += 1
+            return None
+        self.queries += 1
+        return await database.query_calendar_events(
+            app,
+            session.user_id,
+            start,
+            end,
+            kwargs.get("q"),
+            kwargs.get("maxResults") or 250
+        )
+
+    async def get(self, app: FastAPI, session: CalendarSession, event_id: str) -> dict:
+        await self.ensure_fresh(app, session)
+        self.queries += 1
+        return await database.get_calendar_event(app, session.user_id, event_id)
+
+    async def apply(self, app: FastAPI, user_id: str, event: dict):
+        """Copy an event written through the API into the mirror."""
+        if event.get("status") == "cancelled":
+            await self.remove(app, user_id, event["id"])
+        else:
+            await database.apply_calendar_changes(app, user_id, [(event, *event_bounds(event))])
+
+    async def remove(self, app: FastAPI, user_id: str, event_id: str):
+        await database.apply_calendar_changes(app, user_id, [], deleted=[event_id])
+
+    def stats(self) -> dict:
+        return {
+            "syncs": self.syncs,
+            "full_syncs": self.full_syncs,
+            "events_synced": self.events_synced,
+            "queries": self.queries,
+            "out_of_window": self.out_of_window,
+            "notifications": self.notifications
+        }
+
+
+mirror = CalendarMirror(
+    max_staleness=mirror_config.get("max_staleness", 30),
+    page_size=mirror_config.get("page_size", 2500),
+    past_days=mirror_config.get("past_days", 90),
+    future_days=mirror_config.get("future_days", 365),
+    rewindow_days=mirror_config.get("rewindow_days", 7),
+    webhook_url=mirror_config.get("webhook_url"),
+    channel_ttl=mirror_config.get("channel_ttl", 7 * 86400)
+    ) if mirror_config.get("enabled") else None
@@ -0,0 +1,178 @@
+import asyncio
+import datetime
+import logging
+import re
+from fastapi import FastAPI
+from utils import auth
+from utils.cache import TTLCache
+from agent.tools.calendar_client import get_session, event_bounds, parse_time
+from agent.tools.calendar_mirror import mirror
+from agent.tools.calendar_results import LIST_FIELDS, render_event
+from utils.config import config
+
+logger = logging.getLogger(__name__)
+
+prefetch_config = config["google"].get("calendar", {}).get("prefetch", {})
+
+CALENDAR_INTENT = re.compile(
+    r"\b(calendar|schedul\w*|agenda|free|busy|availab\w*|meeting\w*|appointment\w*|events?|plans?|booked|"
+    r"today|tonight|tomorrow|this week|next week|weekend|monday|tuesday|wednesday|thursday|friday|saturday|sunday|"
+    r"morning|afternoon|evening)\b", re.I)
+
+class Window:
+    """Events of a user's primary calendar between `start` and `end`, as the API returned them."""
+    def __init__(self, start: datetime.datetime, end: datetime.datetime, events: list[dict], truncated: bool):
+        self.start = start
+        self.end = end
+        self.events = events
+        self.truncated = truncated # more events than max_results, the window can't answer queries
+
+    def covers(self, kwargs: dict) -> bool:
+        if self.truncated or kwargs.get("q") or not kwargs.get("timeMin") or not kwargs.get("timeMax"):
+            return False
+        return self.start <= parse_time(kwargs["timeMin"]) and parse_time(kwargs["timeMax"]) <= self.end
+
+    def query(self, kwargs: dict) -> list[dict]:
+        """Same filtering as events.list: end after timeMin, start before timeMax."""
+        time_min, time_max = parse_time(kwargs["timeMin"]), parse_time(kwargs["timeMax"])
+        events = [e for e in self.events if event_bounds(e)[1] > time_min and event_bounds(e)[0] < time_max]
+        return events[:kwargs.get("maxResults") or len(events)]
+
+
+class CalendarPrefetcher:
+    """
+    Fetches the user's upcoming events while the turn is still on its way to the model.
+    The `prefetch` graph node starts the fetch when the user's message looks calendar related.
+    The model node waits at most `wait` seconds for it and, if it arrived, puts the events in the
+    prompt so the model can answer without a get_many round trip. Otherwise the fetch keeps
+    running and a get_many call inside the window is answered from it instead of the API.
+    :param window_days: days ahead of now to fetch
+    :param max_results: events fetched, a window with more is only used as context
+    :param wait: seconds the model call waits for an in-flight fetch
+    :param ttl: seconds a fetched window is reused, writes through the tool drop it sooner
+    """
+    def __init__(self, window_days: int = 7, max_results: int = 100, wait: float = 0.3, ttl: int = 120):
+        self.window_days = window_days
+        self.max_results = max_results
+        self.wait = wait
+        self.windows = TTLCache(maxsize=4096, ttl=ttl) # user_id -> Window
+        self._tasks: dict[str, asyncio.Task] = {} # user_id -> in-flight fetch
+        self._turns = TTLCache(maxsize=4096, ttl=600) # thread_id -> outcome of the current turn
+        # metrics
+        self.started = 0
+        self.failed = 0
+        self.outcomes = {"injected": 0, "served": 0, "unused": 0}
+
+    def likely(self, messages: list) -> bool:
+        return bool(messages) and messages[-1].type == "human" and bool(CALENDAR_INTENT.search(messages[-1].text()))
+
+    async def __call__(self, state: dict, config: dict) -> dict: # graph `prefetch` node
+        thread_id, user_id = state.get("thread_id"), state.get("user_id")
+        if user_id and self.likely(state["messages"]):
+            self._turns.set(thread_id, {"user_id": user_id, "injected": False, "served": False})
+            self.start(config["configurable"].get("app"), user_id)
+        return {}
+
+    def start(self, app: FastAPI, user_id: str):
+        """Begin fetching a user's window in the background unless one is cached or in flight."""
+        if self.windows.get(user_id) is not None or user_id in self._tasks:
+            return
+        self.started += 1
+        task = asyncio.create_task(self._fetch(app, user_id))
+        self._tasks[user_id] = task
+        task.add_done_callback(lambda t: self._tasks.pop(user_id) if self._tasks.get(user_id) is t else None)
+
+    async def _fetch(self, app: FastAPI, user_id: str) -> Window:
+        creds = await auth.find_google_oauth_creds(app, user_id) # read only, a speculative fetch mustn't reissue the sign-in link
+        if creds is None: # not connected yet, the tool will tell the user
+            return None
+        start = datetime.datetime.now(datetime.timezone.utc)
+        end = start + datetime.timedelta(days=self.window_days)
+        session = get_session(user_id, creds)
+        try:
+            events = await mirror.get_many(app, session, {"timeMin": start.isoformat(), "timeMax": end.isoformat(), "maxResults": self.max_results + 1}) if mirror else None
+            if events is not None:
+                result = {"items": events[:self.max_results], "nextPageToken": len(events) > self.max_results or None}
+            else:
+                result = await session.execute(session.service.events().list(
+                    calendarId="primary",
+                    timeMin=start.isoformat(),
+                    timeMax=end.isoformat(),
+                    maxResults=self.max_results,
+                    singleEvents=True,
+                    orderBy="startTime",
+                    fields=LIST_FIELDS
+                ))
+        except Exception as e:
+            self.failed += 1
+            logger.warning("calendar prefetch for user %s failed: %r", user_id, e)
+            return None
+        window = Window(start, end, result.get("items", []), bool(result.get("nextPageToken")))
+        if self._tasks.get(user_id) is not asyncio.current_task(): # invalidated while in flight
+            return None
+        self.windows.set(user_id, window)
+        return window
+
+    async def get(self, user_id: str, timeout: float = None) -> Window:
+        """The user's window, waiting up to `timeout` seconds (forever if None) for an in-flight fetch."""
+        window = self.windows.get(user_id)
+        if window is not None or user_id not in self._tasks:
+            return window
+        try:
+            return await asyncio.wait_for(asyncio.shield(self._tasks[user_id]), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def context(self, thread_id: str) -> str:
+        """Prompt text with the prefetched events for this turn, None when there is nothing to add."""
+        turn = self._turns.get(thread_id)
+        if turn is None:
+            return None
+        window = await self.get(turn["user_id"], self.wait)
+        if window is None:
+            return None
+        turn["injected"] = True
+        return self.render(window)
+
+    async def lookup(self, user_id: str, thread_id: str, kwargs: dict) -> list[dict]:
+        """Answer a get_many call from the prefetched window, None if it doesn't cover the query."""
+        window = await self.get(user_id) # the fetch is the same request, waiting on it is never slower
+        if window is None or not window.covers(kwargs):
+            return None
+        turn = self._turns.get(thread_id)
+        if turn is not None:
+            turn["served"] = True
+        return window.query(kwargs)
+
+    def invalidate(self, user_id: str):
+        """Drop a user's window after the calendar was written to, an in-flight fetch is discarded."""
+        self.windows.pop(user_id, None)
+        self._tasks.pop(user_id, None)
+
+    def finish(self, thread_id: str) -> str:
+        """Record how the turn used the prefetch, call once the turn's final answer is out."""
+        turn = self._turns.pop(thread_id, None)
+        if turn is None:
+            return None
+        outcome = "injected" if turn["injected"] else "served" if turn["served"] else "unused"
+        self.outcomes[outcome] += 1
+        return outcome
+
+    def render(self, window: Window) -> str:
+        note = f"first {len(window.events)} events only" if window.truncated else "already fetched (no need to call get_many for this range)"
+        lines = [f"The user's calendar from {window.start:%Y-%m-%d %H:%M} UTC to {window.end:%Y-%m-%d %H:%M} UTC, {note} (id | time | title | location | description):"]
+        lines.extend(f"- {render_event(event)}" for event in window.events)
+        if not window.events:
+            lines.append("- no events")
+        return "\n".join(lines)
+
+    def stats(self) -> dict:
+        return {"started": self.started, "failed": self.failed, **self.outcomes}
+
+
+prefetcher = CalendarPrefetcher(
+    window_days=prefetch_config.get("window_days", 7),
+    max_results=prefetch_config.get("max_results", 100),
+    wait=prefetch_config.get("wait", 0.3),
+    ttl=prefetch_config.get("ttl", 120)
+    ) if prefetch_config.get("enabled") else None
@@ -0,0 +1,142 @@
+import collections
+import datetime
+import html
+import json
+import logging
+import re
+from langchain_core.messages.utils import count_tokens_approximately
+from agent.tools.calendar_client import parse_time
+from utils.config import config
+
+logger = logging.getLogger(__name__)
+
+results_config = config["google"].get("calendar", {}).get("results", {})
+
+'''
+Shapes calendar tool results before they go back to the model. The API is asked for only the
+fields the model uses (`fields` partial responses), and results are rendered as one dense line
+per event instead of stringified JSON, e.g.
+
+    abc123 | 2026-11-03 10:00-11:00 -07:00 | Dentist | at 123 Main St
+
+The same text is what the checkpoint stores, so the prompt and the checkpoint shrink together.
+'''
+
+# partial-response selectors, events keep status for the mirror's write-through
+EVENT_FIELDS = "id,status,summary,description,location,start,end"
+LIST_FIELDS = f"items({EVENT_FIELDS}),nextPageToken"
+FREEBUSY_FIELDS = "calendars"
+
+DESCRIPTION_CHARS = results_config.get("description_chars", 160)
+
+TAG = re.compile(r"<[^>]+>")
+SPACE = re.compile(r"\s+")
+
+def _clean(text: str, limit: int) -> str:
+    text = SPACE.sub(" ", html.unescape(TAG.sub(" ", text))).strip()
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+def _offset(dt: datetime.datetime) -> str:
+    offset = dt.strftime("%z")
+    return "Z" if offset in ("+0000", "") else f"{offset[:3]}:{offset[3:]}"
+
+def render_span(start: dict, end: dict) -> str:
+    """Event times as briefly as they stay unambiguous, all-day end dates are exclusive."""
+    if start.get("date"):
+        first = datetime.date.fromisoformat(start["date"])
+        last = datetime.date.fromisoformat(end.get("date") or start["date"]) - datetime.timedelta(days=1)
+        return f"{first} all day" if last <= first else f"{first}..{last} all day"
+    begin, finish = parse_time(start["dateTime"]), parse_time(end["dateTime"])
+    if begin.date() == finish.date() and begin.utcoffset() == finish.utcoffset():
+        return f"{begin:%Y-%m-%d %H:%M}-{finish:%H:%M} {_offset(begin)}"
+    return f"{begin:%Y-%m-%d %H:%M} {_offset(begin)} to {finish:%Y-%m-%d %H:%M} {_offset(finish)}"
+
+def render_event(event: dict) -> str:
+    line = f"{event['id']} | {render_span(event['start'], event['end'])} | {event.get('summary') or '(no title)'}"
+    if event.get("location"):
+        line += f" | at {_clean(event['location'], DESCRIPTION_CHARS)}"
+    if event.get("description"):
+        line += f" | {_clean(event['description'], DESCRIPTION_CHARS)}"
+    return line
+
+def render_events(events: list[dict], more: bool = False) -> str:
+    if not events:
+        return "No events."
+    lines = [f"{len(events)} event{'s' if len(events) != 1 else ''} (id | time | title | location | description):"]
+    lines.extend(render_event(event) for event in events)
+    if more:
+        lines.append("More events match, narrow the time range or raise maxResults.")
+    return "\n".join(lines)
+
+def render_slots(result: dict) -> str:
+    if not result["slots"]:
+        lines = [f"No free slots in {result['timeZone']}."]
+    else:
+        lines = [f"Free slots ({result['timeZone']}):"]
+        for slot in result["slots"]:
+            start, end = parse_time(slot["start"]), parse_time(slot["end"])
+            lines.append(f"- {start:%a %Y-%m-%d %H:%M}-{end:%H:%M}")
+    for calendar_id, reason in result.get("unavailableCalendars", {}).items():
+        lines.append(f"Busy times of {calendar_id} are unknown ({reason}).")
+    return "\n".join(lines)
+
+def render(action: str, result) -> str:
+    """Text for one action's result, strings (messages for the model) pass through."""
+    if isinstance(result, str):
+        return result
+    action = action.lower()
+    if action == "delete":
+        return "Deleted."
+    if action == "get_many":
+        return render_events(result["items"], bool(result.get("nextPageToken")))
+    if action == "find_slots":
+        return render_slots(result)
+    if action in ("create", "update"):
+        return f"{'Created' if action == 'create' else 'Updated'}: {render_event(result)}"
+    if isinstance(result, dict) and "id" in result:
+        return render_event(result)
+    return str(result)
+
+def render_batch(results: list[tuple[str, str, bool]]) -> str:
+    """Results of a batched call, one (action, text, ok) per operation in order."""
+    lines = []
+    for i, (action, text, ok) in enumerate(results, 1):
+        text = text.replace("\n", "\n    ")
+        lines.append(f"{i}. {action} {'ok' if ok else 'error'}: {text}")
+    return "\n".join(lines)
+
+
+class ResultStats:
+    """
+    Measured size of the results the tool hands back, per action, next to what the same data
+    would have cost as JSON. Token counts are approximate (the same estimate compaction uses).
+    """
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.tokens = collections.Counter()
+        self.json_tokens = collections.Counter()
+        self.chars = collections.Counter()
+
+    def record(self, action: str, text: str, data) -> int:
+        """Count one rendered result, `data` is the shaped API result it was rendered from."""
+        tokens = count_tokens_approximately([text])
+        json_tokens = count_tokens_approximately([data if isinstance(data, str) else json.dumps(data, default=str)])
+        self.calls[action] += 1
+        self.tokens[action] += tokens
+        self.json_tokens[action] += json_tokens
+        self.chars[action] += len(text)
+        logger.debug("calendar %s result: %d tokens (%d as json)", action, tokens, json_tokens)
+        return tokens
+
+    def summary(self) -> dict:
+        return {
+            action: {
+                "calls": calls,
+                "avg_tokens": self.tokens[action] / calls,
+                "avg_json_tokens": self.json_tokens[action] / calls,
+                "avg_chars": self.chars[action] / calls
+            } for action, calls in self.calls.items()
+        }
+
+
+result_stats = ResultStats()
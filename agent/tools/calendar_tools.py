@@ -0,0 +1,102 @@
+import json
+import types
+import typing
+from typing import Annotated, Optional, Union
+from typing_extensions import is_typeddict
+from pydantic import BaseModel, Field, create_model
+from langchain_core.messages.utils import count_tokens_approximately
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool, StructuredTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from utils.schemas import CreateEvent, GetEvent, UpdateEvent, DeleteEvent, GetManyEvents, FindSlots
+from agent.tools import google_cal
+
+'''
+The calendar capability as one small tool per action, generated from the TypedDicts in
+utils.schemas, instead of the single google_calendar tool whose arguments are a union of every
+action's kwargs. Each tool declares only its own fields and a one line description, so a route
+can also be given just the actions it needs. Several actions in one turn become parallel tool
+calls, which the tool node runs concurrently.
+'''
+
+# action -> (kwargs schema, description)
+ACTIONS = {
+    "get_many": (GetManyEvents, "List events on the user's calendar in a time range, optionally matching search terms."),
+    "get": (GetEvent, "Get one event from the user's calendar by its ID."),
+    "find_slots": (FindSlots, "Find free time slots of a given length across one or more calendars, within working hours. Use this instead of listing events when looking for a time to meet."),
+    "create": (CreateEvent, "Create an event on the user's calendar."),
+    "update": (UpdateEvent, "Change fields of an event on the user's calendar, fields left out are kept."),
+    "delete": (DeleteEvent, "Delete an event from the user's calendar.")
+}
+
+_models: dict[type, type[BaseModel]] = {}
+
+def _field(hint) -> tuple:
+    """(type, FieldInfo) for one TypedDict annotation, Optional[...] fields become not required."""
+    optional = False
+    if typing.get_origin(hint) in (Union, types.UnionType) and type(None) in typing.get_args(hint):
+        optional = True
+        hint = next(arg for arg in typing.get_args(hint) if arg is not type(None))
+    description = None
+    if typing.get_origin(hint) is Annotated:
+        hint, *metadata = typing.get_args(hint)
+        description = next((m for m in metadata if isinstance(m, str)), None)
+    hint = _convert(hint)
+    if optional:
+        return Optional[hint], Field(default=None, description=description)
+    return hint, Field(description=description)
+
+def _convert(hint):
+    if is_typeddict(hint):
+        return schema_model(hint)
+    if typing.get_origin(hint) is list:
+        return list[_convert(typing.get_args(hint)[0])]
+    return hint
+
+def schema_model(schema: type) -> type[BaseModel]:
+    """Pydantic model with the fields of a TypedDict from utils.schemas, nested TypedDicts included."""
+    if schema not in _models:
+        hints = typing.get_type_hints(schema, include_extras=True)
+        _models[schema] = create_model(
+            schema.__name__,
+            __doc__=schema.__doc__,
+            **{name: _field(hint) for name, hint in hints.items()}
+        )
+    return _models[schema]
+
+def build_tool(action: str) -> StructuredTool:
+    schema, description = ACTIONS[action]
+    model = schema_model(schema)
+
+    async def run(config: RunnableConfig, **kwargs) -> str:
+        # every field present (None when left out) and nested models as dicts, as the gcal_* functions expect
+        return await google_cal.run_action(config, action, model(**kwargs).model_dump())
+
+    return StructuredTool.from_function(
+        coroutine=run,
+        name=f"calendar_{action}",
+        description=description,
+        args_schema=model
+    )
+
+tools = {action: build_tool(action) for action in ACTIONS}
+
+def select(actions: list[str] = None) -> list[StructuredTool]:
+    """The generated tools for `actions` (all of them if None), in declaration order."""
+    unknown = set(actions or ()) - set(tools)
+    if unknown:
+        raise ValueError(f"unknown calendar actions {sorted(unknown)}, expected some of {list(tools)}")
+    return [tool for action, tool in tools.items() if actions is None or action in actions]
+
+def declaration_tokens(declared: list[BaseTool]) -> int:
+    """Approximate tokens the tool declarations add to every model call."""
+    return count_tokens_approximately([json.dumps([convert_to_openai_tool(t) for t in declared])])
+
+def report(routes: dict[str, list[str]] = None) -> dict:
+    """Declaration tokens of the union tool, of all per-action tools, of each one, and of each route's subset."""
+    return {
+        "union": declaration_tokens([google_cal.tool]),
+        "per_action": declaration_tokens(select()),
+        "actions": {action: declaration_tokens([tool]) for action, tool in tools.items()},
+        "routes": {route: declaration_tokens(select(actions)) for route, actions in (routes or {}).items()}
+    }
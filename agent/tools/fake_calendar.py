@@ -0,0 +1,235 @@
+import json
+import time
+import uuid
+import datetime
+import threading
+import urllib.parse
+import httplib2
+
+'''
+In-memory stand-in for the Google Calendar v3 API, used by tests and benchmarks.
+It speaks the httplib2 interface googleapiclient uses, so requests go through the real
+discovery based client and only the network hop is replaced:
+
+    cal = FakeCalendar()
+    calendar_client.set_http_factory(cal.http_factory)
+
+Listing supports incremental sync like the real API: the last page of a list carries a
+nextSyncToken, and a list with `syncToken` returns only events changed since then, deleted ones
+included as "cancelled". `expire_sync_tokens()` makes every outstanding token answer 410 Gone.
+The `fields` partial-response parameter is honoured on every request.
+'''
+
+def _parse_time(value: str) -> datetime.datetime:
+    if "T" not in value: # all-day date
+        return datetime.datetime.fromisoformat(value).replace(tzinfo=datetime.timezone.utc)
+    dt = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+
+def _parse_fields(fields: str, i: int = 0) -> tuple:
+    """Parse a partial-response selector like "items(id,start),nextPageToken" into a nested dict."""
+    selected, name = {}, ""
+    while i < len(fields):
+        char = fields[i]
+        if char == "(":
+            selected[name.strip()], i = _parse_fields(fields, i + 1)
+            name = None
+        elif char == ")":
+            break
+        elif char == ",":
+            if name:
+                selected[name.strip()] = None
+            name = ""
+        else:
+            name = (name or "") + char
+        i += 1
+    if name:
+        selected[name.strip()] = None
+    return selected, i
+
+def select_fields(data, selected: dict):
+    """Apply a parsed `fields` selector the way the API does, lists are filtered item by item."""
+    if isinstance(data, list):
+        return [select_fields(item, selected) for item in data]
+    if not isinstance(data, dict):
+        return data
+    return {k: data[k] if sub is None else select_fields(data[k], sub) for k, sub in selected.items() if k in data}
+
+def event_bounds(event: dict) -> tuple:
+    start = event["start"].get("dateTime") or event["start"].get("date")
+    end = event["end"].get("dateTime") or event["end"].get("date")
+    return _parse_time(start), _parse_time(end)
+
+
+class FakeCalendar:
+    """
+    Thread safe in-memory calendar store. One instance holds every calendar of every user.
+    :param latency: seconds each request sleeps before answering, to simulate the network
+    """
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calendars = {} # calendarId -> {eventId: event}
+        self.requests = [] # (method, path) of every request served
+        self.channels = {} # channel id -> watch channel
+        self._seq = 0 # bumped on every change, sync tokens are values of it
+        self._changed = {} # (calendarId, eventId) -> seq of the last change
+        self._min_sync_token = 0
+        self._lock = threading.Lock()
+
+    def http_factory(self, creds=None):
+        return FakeHttp(self)
+
+    def add_event(self, event: dict, calendar_id: str = "primary") -> dict:
+        with self._lock:
+            return self._insert(calendar_id, event)
+
+    def expire_sync_tokens(self):
+        with self._lock:
+            self._seq += 1
+            self._min_sync_token = self._seq
+
+    def _touch(self, calendar_id: str, event_id: str):
+        self._seq += 1
+        self._changed[(calendar_id, event_id)] = self._seq
+
+    def _insert(self, calendar_id: str, body: dict) -> dict:
+        event = {k: v for k, v in body.items() if v is not None}
+        event_id = event.get("id") or uuid.uuid4().hex
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        event.update({
+            "kind": "calendar#event",
+            "id": event_id,
+            "status": "confirmed",
+            "htmlLink": f"https://www.google.com/calendar/event?eid={event_id}",
+            "created": event.get("created", now),
+            "updated": now,
+            "etag": f'"{time.time_ns()}"'
+        })
+        self.calendars.setdefault(calendar_id, {})[event_id] = event
+        self._touch(calendar_id, event_id)
+        return event
+
+    def _list(self, calendar_id: str, params: dict) -> tuple:
+        if "syncToken" in params:
+            if set(params) & {"timeMin", "timeMax", "q", "orderBy", "updatedMin"}:
+                return 400, {"error": {"code": 400, "message": "syncToken can't be combined with filters"}}
+            since = int(params["syncToken"])
+            if since < self._min_sync_token:
+                return 410, {"error": {"code": 410, "message": "Sync token is no longer valid, a full sync is required.", "errors": [{"reason": "fullSyncRequired"}]}}
+            events = [e for e in self.calendars.get(calendar_id, {}).values() if self._changed[(calendar_id, e["id"])] > since]
+            events.sort(key=lambda e: self._changed[(calendar_id, e["id"])])
+            return 200, self._page(events, params)
+
+        events = [e for e in self.calendars.get(calendar_id, {}).values() if e["status"] != "cancelled" or params.get("showDeleted") == "true"]
+        if "timeMin" in params:
+            time_min = _parse_time(params["timeMin"])
+            events = [e for e in events if event_bounds(e)[1] > time_min]
+        if "timeMax" in params:
+            time_max = _parse_time(params["timeMax"])
+            events = [e for e in events if event_bounds(e)[0] < time_max]
+        if "q" in params:
+            terms = params["q"].lower().split()
+            events = [e for e in events if all(t in " ".join(str(e.get(k, "")) for k in ("summary", "description", "location")).lower() for t in terms)]
+        events.sort(key=lambda e: event_bounds(e)[0])
+        return 200, self._page(events, params)
+
+    def _page(self, events: list, params: dict) -> dict:
+        offset = int(params.get("pageToken", 0))
+        max_results = int(params.get("maxResults", 250))
+        page = events[offset:offset + max_results]
+        result = {"kind": "calendar#events", "items": page}
+        if offset + max_results < len(events):
+            result["nextPageToken"] = str(offset + max_results)
+        else:
+            result["nextSyncToken"] = str(self._seq)
+        return result
+
+    def _watch(self, calendar_id: str, body: dict) -> dict:
+        ttl = int(body.get("params", {}).get("ttl", 604800))
+        channel = {
+            "kind": "api#channel",
+            "id": body["id"],
+            "resourceId": f"{calendar_id}-events",
+            "resourceUri": f"https://www.googleapis.com/calendar/v3/calendars/{calendar_id}/events",
+            "token": body.get("token"),
+            "address": body.get("address"),
+            "expiration": str(int((time.time() + ttl) * 1000))
+        }
+        self.channels[body["id"]] = channel
+        return channel
+
+    def _free_busy(self, body: dict) -> dict:
+        time_min, time_max = _parse_time(body["timeMin"]), _parse_time(body["timeMax"])
+        calendars = {}
+        for item in body.get("items", []):
+            if item["id"] not in self.calendars:
+                calendars[item["id"]] = {"errors": [{"domain": "global", "reason": "notFound"}], "busy": []}
+                continue
+            busy = []
+            for event in self.calendars[item["id"]].values():
+                if event["status"] == "cancelled" or event.get("transparency") == "transparent":
+                    continue
+                start, end = event_bounds(event)
+                if end > time_min and start < time_max:
+                    busy.append((max(start, time_min), min(end, time_max)))
+            calendars[item["id"]] = {"busy": [{"start": s.isoformat(), "end": e.isoformat()} for s, e in sorted(busy)]}
+        return {"kind": "calendar#freeBusy", "timeMin": body["timeMin"], "timeMax": body["timeMax"], "calendars": calendars}
+
+    def handle(self, method: str, uri: str, body) -> tuple:
+        """Route one request, returns (status, json body or None)."""
+        url = urllib.parse.urlparse(uri)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.removeprefix("/calendar/v3/").strip("/").split("/")
+        payload = json.loads(body) if body else {}
+        self.requests.append((method, url.path))
+
+        with self._lock:
+            if path == ["channels", "stop"] and method == "POST":
+                self.channels.pop(payload.get("id"), None)
+                return 204, None
+            if path == ["freeBusy"] and method == "POST":
+                return 200, self._free_busy(payload)
+            if len(path) == 4 and path[0] == "calendars" and path[2] == "events" and path[3] == "watch" and method == "POST":
+                return 200, self._watch(urllib.parse.unquote(path[1]), payload)
+            if len(path) >= 3 and path[0] == "calendars" and path[2] == "events":
+                calendar_id = urllib.parse.unquote(path[1])
+                events = self.calendars.setdefault(calendar_id, {})
+                if len(path) == 3:
+                    if method == "GET":
+                        return self._list(calendar_id, params)
+                    if method == "POST":
+                        return 200, self._insert(calendar_id, payload)
+                else:
+                    event_id = urllib.parse.unquote(path[3])
+                    event = events.get(event_id)
+                    if event is None or event["status"] == "cancelled":
+                        return 404, {"error": {"code": 404, "message": "Not Found"}}
+                    if method == "GET":
+                        return 200, event
+                    if method in ("PUT", "PATCH"):
+                        updated = payload if method == "PUT" else {**event, **payload}
+                        updated["created"] = event["created"]
+                        return 200, self._insert(calendar_id, {**updated, "id": event_id})
+                    if method == "DELETE":
+                        event["status"] = "cancelled"
+                        self._touch(calendar_id, event_id)
+                        return 204, None
+        return 404, {"error": {"code": 404, "message": f"Unknown route {method} {url.path}"}}
+
+
+class FakeHttp:
+    """httplib2.Http look-alike that answers from a FakeCalendar."""
+    def __init__(self, calendar: FakeCalendar):
+        self.calendar = calendar
+
+    def request(self, uri, method="GET", body=None, headers=None, redirections=None, connection_type=None):
+        if self.calendar.latency:
+            time.sleep(self.calendar.latency)
+        status, data = self.calendar.handle(method, uri, body)
+        fields = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(uri).query)).get("fields")
+        if fields and status == 200:
+            data = select_fields(data, _parse_fields(fields)[0])
+        content = b"" if data is None else json.dumps(data).encode()
+        return httplib2.Response({"status": str(status), "content-type": "application/json"}), content
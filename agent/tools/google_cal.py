@@ -1,24 +1,39 @@
 from langchain_core.tools import tool
 from pydantic import BaseModel, Field
-from googleapiclient.discovery import build, Resource
 from google.oauth2.credentials import Credentials
 from fastapi import FastAPI
 from utils import auth
 from utils.errors import GoogleOauthFaliure
+from agent.tools.calendar_client import CalendarSession, get_session, parse_time
+from agent.tools.calendar_prefetch import prefetcher
+from agent.tools.calendar_mirror import mirror
+from agent.tools import availability
+from agent.tools.calendar_results import EVENT_FIELDS, LIST_FIELDS, FREEBUSY_FIELDS, render, render_batch, result_stats
+from agent.prompts import location
 from typing_extensions import Annotated
-from typing import Union
+from typing import Optional, Union
 from langgraph.prebuilt import InjectedState
-from utils.schemas import CreateEvent, GetEvent, UpdateEvent, DeleteEvent, GetManyEvents
+from utils.schemas import CreateEvent, GetEvent, UpdateEvent, DeleteEvent, GetManyEvents, FindSlots, Operation
 from langchain_core.tools import InjectedToolArg
 from langchain_core.runnables import RunnableConfig
-from googleapiclient.http import HttpRequest
 
+import asyncio
+import datetime
+import logging
+from googleapiclient.errors import HttpError
 import pprint
+from zoneinfo import ZoneInfo
+from utils.config import config
+
+logger = logging.getLogger(__name__)
+
+MAX_OPERATIONS = config["google"].get("calendar", {}).get("max_operations", 50)
+BATCH_CONCURRENCY = config["google"].get("calendar", {}).get("batch_concurrency", 8)
 
 class ToolInputSchema(BaseModel):
     """
-Interact with the user's Google Calendar. You are able to create events, get events, update events, and delete events.
-When using this tool, pass the operation (create, get, get many, update, or delete) as well as the kwargs corresponding to that operation.
+Interact with the user's Google Calendar. You are able to create events, get events, update events, delete events, and find free time.
+When using this tool, pass the operation (create, get, get many, update, delete, or find_slots) as well as the kwargs corresponding to that operation.
 Use the below examples of the kwargs for each operation.
 
 Schema for create:
@@ -73,41 +88,154 @@ Schema for delete:
 kwargs: {
     "eventId": "string" # The ID of the event
 }
+
+Schema for find_slots (use this instead of get_many when looking for a free time, it returns a few open slots):
+kwargs: {
+    "timeMin": "string", (required) # Start of the range to search, RFC3339 with time zone offset
+    "timeMax": "string", (required) # End of the range to search, RFC3339 with time zone offset
+    "durationMinutes": "integer", (required) # Length of the slot needed
+    "calendars": ["string"], (optional) # Calendar IDs (e.g. attendees' email addresses) that must all be free. Defaults to ["primary"]
+    "timeZone": "string", (optional) # IANA time zone of the working hours. Defaults to the user's time zone
+    "workingHours": {"start": "HH:MM", "end": "HH:MM"}, (optional) # Defaults to 09:00 to 17:00
+    "includeWeekends": "boolean", (optional) # Defaults to false
+    "bufferMinutes": "integer", (optional) # Minutes kept free around every busy period. Defaults to 0
+    "maxSlots": "integer" (optional) # Defaults to 5
+}
+
+To run several actions at once (e.g. move every meeting on a day), pass operations instead of action and kwargs.
+They run concurrently and the result has one numbered line per operation, in order, marked ok or error:
+operations: [
+    {"action": "update", "kwargs": {"eventId": "abc", "start": {...}, "end": {...}}},
+    {"action": "delete", "kwargs": {"eventId": "def"}}
+]
     """
-    action: str = Field(description="Action to perform on the calendar. Either 'create', 'get', 'get_many', 'update', or 'delete'")
-    kwargs: Union[CreateEvent, GetEvent, UpdateEvent, DeleteEvent, GetManyEvents] = Field(description="Keyword arguments for the action.")
+    action: Optional[str] = Field(default=None, description="Action to perform on the calendar. Either 'create', 'get', 'get_many', 'update', 'delete', or 'find_slots'")
+    kwargs: Optional[Union[CreateEvent, GetEvent, UpdateEvent, DeleteEvent, GetManyEvents, FindSlots]] = Field(default=None, description="Keyword arguments for the action.")
+    operations: Optional[list[Operation]] = Field(default=None, description="Several actions to run in one call, instead of action and kwargs.")
 
 @tool("google_calendar", args_schema=ToolInputSchema)
 async def tool(
-    action: str, 
-    kwargs: Union[CreateEvent, GetEvent, UpdateEvent, DeleteEvent, GetManyEvents], 
-    config: RunnableConfig
+    config: RunnableConfig,
+    action: str = None,
+    kwargs: Union[CreateEvent, GetEvent, UpdateEvent, DeleteEvent, GetManyEvents, FindSlots] = None,
+    operations: list[Operation] = None
     ) -> str:
     print("tool invoked")
 
     user_id: str = config["configurable"].get("user_id")
     app: FastAPI = config["configurable"].get("app")
+    thread_id: str = config["configurable"].get("thread_id")
+    if not operations and not action:
+        return "Pass either an action with its kwargs or a list of operations."
+    if operations and len(operations) > MAX_OPERATIONS:
+        return f"Too many operations, pass at most {MAX_OPERATIONS} per call."
+
+    if not operations:
+        return await run_action(config, action, kwargs)
+
     try:
         creds: Credentials = await auth.get_google_oauth_creds(app, user_id)
     except GoogleOauthFaliure as e:
         return e.message
      
-    service: Resource = build('calendar', 'v3', credentials=creds)
+    service: CalendarSession = get_session(user_id, creds) # pooled per user, no discovery rebuild
+
+    # bounded fan-out: every operation runs concurrently, at most BATCH_CONCURRENCY at a time
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    async def run(op: Operation) -> tuple[str, str, bool]:
+        async with semaphore:
+            try:
+                result = await run_operation(app, thread_id, service, op["action"], op.get("kwargs") or {})
+                text = render(op["action"], result)
+                result_stats.record(op["action"].lower(), text, result)
+                return op["action"], text, True
+            except HttpError as e:
+                return op["action"], f"{e.resp.status} {e.reason}", False
+            except (KeyError, TypeError, ValueError) as e:
+                return op["action"], f"invalid kwargs: {e!r}", False
+            except Exception as e: # one failure doesn't sink the rest, siblings' writes still commit
+                logger.warning("calendar batch operation %s for user %s failed: %r", op["action"], user_id, e)
+                return op["action"], getattr(e, "message", None) or f"failed: {e!r}", False
+    return render_batch(await asyncio.gather(*(run(op) for op in operations)))
+
+async def run_action(config: RunnableConfig, action: str, kwargs: dict) -> str:
+    """Run a single action for the tool call's user and render its result for the model."""
+    user_id: str = config["configurable"].get("user_id")
+    app: FastAPI = config["configurable"].get("app")
+    try:
+        creds: Credentials = await auth.get_google_oauth_creds(app, user_id)
+    except GoogleOauthFaliure as e:
+        return e.message
+    service: CalendarSession = get_session(user_id, creds) # pooled per user, no discovery rebuild
+    result = await run_operation(app, config["configurable"].get("thread_id"), service, action, kwargs)
+    text = render(action, result)
+    result_stats.record(action.lower(), text, result)
+    return text
+
+async def run_operation(app: FastAPI, thread_id: str, service: CalendarSession, action: str, kwargs: dict):
+    """
+    Run one calendar action for the session's user, through the prefetch window and the mirror when they are on.
+    :return: the API shaped result (get_many: {"items", "nextPageToken"}), or a message string for the model
+    """
+    user_id = service.user_id
+    action = action.lower()
+    if prefetcher and action == "get_many":
+        events = await prefetcher.lookup(user_id, thread_id, kwargs)
+        if events is not None: # answered from the window fetched alongside the model call
+            return {"items": events}
+    elif prefetcher and action in ("create", "update", "delete"):
+        prefetcher.invalidate(user_id)
+
+    if mirror and action in ("get", "get_many"): # reads come from the synced local copy
+        try:
+            if action == "get_many":
+                events = await mirror.get_many(app, service, kwargs)
+                if events is not None: # None: the range isn't mirrored
+                    return {"items": events}
+            else:
+                event = await mirror.get(app, service, kwargs["eventId"])
+                if event is not None:
+                    return event
+        except Exception as e:
+            logger.warning("calendar mirror unavailable for user %s, querying Google: %r", user_id, e)
 
-    if action.lower() == "create":
-        return await gcal_create_event(service, kwargs)
-    elif action.lower() == "get":
+    if action == "create":
+        result = await gcal_create_event(service, kwargs)
+        if mirror:
+            await write_through(user_id, mirror.apply(app, user_id, result))
+        return result
+    elif action == "get":
         return await gcal_get_event(service, kwargs)
-    elif action.lower() == "get_many":
+    elif action == "get_many":
         return await gcal_get_many_events(service, kwargs)
-    elif action.lower() == "update":
-        return await gcal_update_event(service, kwargs)
-    elif action.lower() == "delete":
-        return await gcal_delete_event(service, kwargs)
+    elif action == "update":
+        result = await gcal_update_event(service, kwargs)
+        if mirror:
+            await write_through(user_id, mirror.apply(app, user_id, result))
+        return result
+    elif action == "delete":
+        result = await gcal_delete_event(service, kwargs)
+        if mirror:
+            await write_through(user_id, mirror.remove(app, user_id, kwargs["eventId"]))
+        return result
+    elif action == "find_slots":
+        return await gcal_find_slots(service, kwargs)
     else:
-        return "Invalid action. Please choose one of 'create', 'get', 'get_many', 'update', or 'delete'"
+        return "Invalid action. Please choose one of 'create', 'get', 'get_many', 'update', 'delete', or 'find_slots'"
 
-async def gcal_create_event(service: Resource, kwargs: CreateEvent):
+async def write_through(user_id: str, write):
+    """
+    Copy a write Google already accepted into the mirror. A failure here must not fail the tool
+    call, the model would retry a write that happened, so the user is resynced on the next read instead.
+    :param write: the mirror coroutine
+    """
+    try:
+        await write
+    except Exception as e:
+        mirror.mark_stale(user_id)
+        logger.warning("calendar mirror write for user %s failed, resyncing on the next read: %r", user_id, e)
+
+async def gcal_create_event(service: CalendarSession, kwargs: CreateEvent):
     print("create event invoked")
     body = {
         "colorId": None, # The color of the event. This is an ID referring to an entry in the event section of the colors definition (see the  colors endpoint).
@@ -125,68 +253,98 @@ async def gcal_create_event(service: Resource, kwargs: CreateEvent):
             "timeZone": kwargs['end']['timeZone']
         }
     }
-    result = service.events().insert(
+    result = await service.execute(service.service.events().insert(
         calendarId='primary', 
-        body=body
-        ).execute()
-    return result # TODO parse
+        body=body,
+        fields=EVENT_FIELDS
+        ))
+    return result
 
-async def gcal_get_event(service: Resource, kwargs: GetEvent):
+async def gcal_get_event(service: CalendarSession, kwargs: GetEvent):
 
-    result = service.events().get(
+    result = await service.execute(service.service.events().get(
         calendarId='primary',
-        eventId=kwargs["eventId"]
-    )
-    return result # TODO parse
+        eventId=kwargs["eventId"],
+        fields=EVENT_FIELDS
+    ))
+    return result
 
-async def gcal_get_many_events(service: Resource, kwargs: GetManyEvents):
-    result: HttpRequest = service.events().list(
+async def gcal_get_many_events(service: CalendarSession, kwargs: GetManyEvents):
+    result: dict = await service.execute(service.service.events().list(
         calendarId='primary',
         maxResults=kwargs["maxResults"],
         q=kwargs["q"],
         timeMax=kwargs["timeMax"],
-        timeMin=kwargs["timeMin"]
-    ).execute()
-    response_keys = ["end","htmlLink","id", "start", "summary","description"]
-    items = dict(result.items())
-    output_items = []
-    for item in items["items"]:
-        output = {}
-        for k,v in item.items():
-            if k in response_keys:
-                output[k] = v
-        output_items.append(output)
-    return output_items
-
-async def gcal_update_event(service: Resource, kwargs: UpdateEvent):
-    result = service.events().update(
+        timeMin=kwargs["timeMin"],
+        fields=LIST_FIELDS
+    ))
+    return result
+
+async def gcal_update_event(service: CalendarSession, kwargs: UpdateEvent):
+    # patch, so fields the model leaves out (e.g. everything but start/end when moving an event) are kept
+    body = {k: v for k, v in kwargs.items() if k != "eventId" and v is not None}
+    for key in ("start", "end"):
+        if key in body:
+            body[key] = {k: v for k, v in body[key].items() if v is not None}
+    result = await service.execute(service.service.events().patch(
         calendarId='primary',
-        eventId=kwargs.eventId,
-        body = {
-            "summary": kwargs['summary'],
-            "description": kwargs['description'],
-            "location": kwargs['location'],
-            "start": {
-                "date": kwargs['start']['date'],
-                "dateTime": kwargs['start']['dateTime'],
-                "timeZone": kwargs['start']['timeZone']
-            },
-            "end": {
-                "date": kwargs['end']['date'],
-                "dateTime": kwargs['end']['dateTime'],
-                "timeZone": kwargs['end']['timeZone']
-            }
-        }
-    )
-    return result # TODO parse
+        eventId=kwargs["eventId"],
+        body=body,
+        fields=EVENT_FIELDS
+    ))
+    return result
 
-async def gcal_delete_event(service: Resource, kwargs: DeleteEvent):
-    result = service.events().delete(
+async def gcal_delete_event(service: CalendarSession, kwargs: DeleteEvent):
+    result = await service.execute(service.service.events().delete(
         calendarId='primary',
         eventId=kwargs['eventId']
-    )
-    return result # TODO parse
+    ))
+    return result
+
 
+async def gcal_find_slots(service: CalendarSession, kwargs: FindSlots):
+    """
+    One freebusy request for every calendar, then the busy periods are merged, padded by the buffer
+    and cut out of each day's working hours locally. Only a handful of candidate slots go back to
+    the model instead of every event in the range.
+    """
+    time_min, time_max = parse_time(kwargs["timeMin"]), parse_time(kwargs["timeMax"])
+    duration = datetime.timedelta(minutes=kwargs["durationMinutes"])
+    if time_max <= time_min or duration <= datetime.timedelta(0):
+        raise ValueError("timeMax must be after timeMin and durationMinutes must be positive")
+    tz = ZoneInfo(kwargs["timeZone"]) if kwargs.get("timeZone") else location[1]
+    hours = kwargs.get("workingHours") or {}
+    calendars = kwargs.get("calendars") or ["primary"]
+
+    result = await service.execute(service.service.freebusy().query(body={
+        "timeMin": time_min.isoformat(),
+        "timeMax": time_max.isoformat(),
+        "items": [{"id": calendar_id} for calendar_id in calendars]
+    }, fields=FREEBUSY_FIELDS))
+    busy, errors = [], {}
+    for calendar_id, calendar in result.get("calendars", {}).items():
+        if calendar.get("errors"): # e.g. notFound, or no permission to see that calendar's free/busy
+            errors[calendar_id] = calendar["errors"][0].get("reason")
+        busy.extend((parse_time(b["start"]), parse_time(b["end"])) for b in calendar.get("busy", []))
+
+    busy = availability.merge(busy, datetime.timedelta(minutes=kwargs.get("bufferMinutes") or 0))
+    windows = availability.working_windows(
+        time_min,
+        time_max,
+        tz,
+        datetime.time.fromisoformat(hours.get("start") or "09:00"),
+        datetime.time.fromisoformat(hours.get("end") or "17:00"),
+        bool(kwargs.get("includeWeekends"))
+    )
+    free = [(start.astimezone(tz), end.astimezone(tz)) for start, end in availability.subtract(windows, busy)] # local days and clock times for slot picking
+    slots = availability.candidate_slots(free, duration, kwargs.get("maxSlots") or 5)
+    output = {
+        "timeZone": str(tz),
+        "slots": [{"start": start.isoformat(), "end": end.isoformat()} for start, end in slots]
+    }
+    if errors:
+        output["unavailableCalendars"] = errors # their busy times are unknown, the slots ignore them
+    return output
 
 
 # async def cal_test(app: FastAPI, user_id: str):
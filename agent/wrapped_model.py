@@ -0,0 +1,34 @@
+from langchain_core.language_models import BaseChatModel
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import PrivateAttr
+
+'''
+Base of the chat models that call other chat models: LazyChatModel (agent/lazy_model.py) and
+ResilientChatModel (agent/resilience.py).
+'''
+
+# settings the wrapped models run with, their callbacks would report every call a second time
+INNER = {"callbacks": []}
+
+
+class WrapperChatModel(BaseChatModel):
+    """
+    A chat model answering through the models it wraps. Tools are bound to the wrapper and bound
+    to each wrapped model on first use, so binding never needs the wrapped models built.
+    """
+    _bound: dict = PrivateAttr(default_factory=dict)
+
+    def bind_tools(self, tools: list, **kwargs):
+        # declared as OpenAI-style dicts so create_react_agent sees the tools as bound
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], tool_options=kwargs)
+
+    def _with_tools(self, models: list, kwargs: dict) -> tuple[list, dict]:
+        """`models` with the call's bound tools, if any, and the kwargs left for them."""
+        kwargs = dict(kwargs)
+        tools, options = kwargs.pop("tools", None), kwargs.pop("tool_options", None) or {}
+        if tools is None:
+            return models, kwargs
+        key = id(tools) # the binding passes the same list on every call
+        if key not in self._bound:
+            self._bound[key] = (tools, [model.bind_tools(tools, **options) for model in models])
+        return self._bound[key][1], kwargs
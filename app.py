@@ -1,34 +1,110 @@
 from fastapi import FastAPI, Depends, BackgroundTasks, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from contextlib import asynccontextmanager
 import requests as rq
-from gotrue.errors import AuthApiError
 from fastapi.security import HTTPBearer
-from agent import graph
+from agent import graph, serde, resilience
 from agent.tools import google_cal
-from langgraph.checkpoint.redis import AsyncRedisSaver
-from utils import auth, errors, schemas, database
+from agent.tools.calendar_mirror import mirror
+from agent.tools.calendar_prefetch import prefetcher
+from agent.tools.calendar_results import result_stats
+from agent.retention import CheckpointRetention
+from utils import auth, errors, schemas, database, metrics
+from utils.sse import SSEResponse, SSEStream, StreamStats
+from utils.admission import AdmissionController
 import asyncpg
-from google_auth_oauthlib.flow import InstalledAppFlow
-import json, os, yaml
+import asyncio, json, os
+import datetime
+from utils.config import config
 
 os.makedirs('logs/', exist_ok=True)
 
 
-with open("config.yml", "r") as f: config = yaml.safe_load(f)
+stream_config = config.get("streaming", {})
+admission_config = config.get("admission", {})
+resilience_config = config.get("resilience", {})
+google_startup = True # read the Google OAuth client at startup, bench/offline_app.py runs without one
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # before
-    checkpointer = AsyncRedisSaver(config["redis"]["url"])
-    await checkpointer.asetup()
+    from google_auth_oauthlib.flow import InstalledAppFlow # only needed here, kept off the import path
+    checkpointer = serde.checkpointer(config["redis"]["url"], **config["redis"].get("serializer", {}))
+    # independent startup work runs at once, the slowest of it sets the time to ready
+    _, app.state.db_pool, _ = await asyncio.gather(
+        checkpointer.asetup(),
+        asyncpg.create_pool(config["postgres"]["url"], min_size=5, max_size=20),
+        asyncio.to_thread(graph.load_models) # imports the model provider's package
+        )
     app.state.graph = graph.workflow.compile(checkpointer=checkpointer) # compile graph w/ redis memory
-    app.state.db_pool = await asyncpg.create_pool(config["postgres"]["url"], min_size=5, max_size=20)
-    app.state.google_oauth_flow = InstalledAppFlow.from_client_secrets_file(config["google"]["oauth2_credentials"], config["google"]["oauth2_scopes"], redirect_uri=config["google"]["redirect_uri"])
+    app.state.chat_log = database.ChatLogWriter(app.state.db_pool, **config["postgres"].get("chat_log", {})) # batched chat_history writes
+    app.state.chat_log.start()
+    app.state.retention = CheckpointRetention(checkpointer, pool=app.state.db_pool, **config["redis"].get("retention", {})) # prune/expire checkpoints after each turn
+    if graph.memory:
+        from agent.memory.store import PostgresMemoryStore
+        graph.memory.start(graph.memory.store or PostgresMemoryStore(app.state.db_pool), versions=database.rds) # workers see each other's memory writes
+    app.state.streams = StreamStats() # time to first byte, bytes per frame of /chat streams
+    app.state.admission = AdmissionController( # caps concurrent turns per worker, per user and per thread
+        database.rds,
+        max_inflight=admission_config.get("max_inflight", 32),
+        max_queue=admission_config.get("max_queue", 64),
+        queue_timeout=admission_config.get("queue_timeout", 2.0),
+        rate=admission_config.get("rate", 0.5),
+        burst=admission_config.get("burst", 10),
+        lock_ttl=admission_config.get("lock_ttl", 60),
+        max_turn=admission_config.get("max_turn", 600)
+        ) if admission_config.get("enabled") else None
+    register_stats(app)
+    sweeper = asyncio.create_task(app.state.retention.run_sweeps()) if app.state.retention and app.state.retention.offload else None # archive idle threads
+    redis_probe = asyncio.create_task(metrics.probe_redis(database.rds, config.get("metrics", {}).get("redis_probe_interval", 15)))
+    keep_warm = None
+    if graph.resilient_models and resilience_config.get("prewarm", True):
+        await resilience.warm(graph.resilient_models.values()) # model connections are open before the first turn
+        keep_warm = asyncio.create_task(resilience.keep_warm(graph.resilient_models.values(), resilience_config.get("keep_warm_interval", 240)))
+    if google_startup:
+        app.state.google_oauth_flow = InstalledAppFlow.from_client_secrets_file(config["google"]["oauth2_credentials"], config["google"]["oauth2_scopes"], redirect_uri=config["google"]["redirect_uri"])
     yield
     # after
+    redis_probe.cancel()
+    if sweeper:
+        sweeper.cancel()
+    if keep_warm:
+        keep_warm.cancel()
+    await app.state.chat_log.stop() # drain buffered chat logs before the pool goes away
+    if graph.memory:
+        await graph.memory.stop() # write pending memories too
+    if graph.context_cache:
+        await graph.context_cache.close()
     await app.state.db_pool.close()
 
+def register_stats(app: FastAPI):
+    """Export the counters the app's components keep on /metrics."""
+    pool = app.state.db_pool
+    metrics.collector.register("db_pool", lambda: {
+        "size": pool.get_size(),
+        "max": pool.get_max_size(),
+        "in_use": pool.get_size() - pool.get_idle_size() # at max with waiters queued means the pool is saturated
+    })
+    metrics.collector.register("chat_log", app.state.chat_log.stats)
+    metrics.collector.register("streams", app.state.streams.summary)
+    metrics.collector.register("calendar_results", result_stats.summary, label="action")
+    if app.state.admission:
+        metrics.collector.register("admission", app.state.admission.stats)
+    if graph.router:
+        metrics.collector.register("router", graph.router.report, label="route")
+    if graph.resilient_models:
+        metrics.collector.register("model", lambda: {name: model.stats() for name, model in graph.resilient_models.items()}, label="model")
+        metrics.collector.register("circuit", resilience.breaker_stats, label="provider")
+    if graph.context_cache:
+        metrics.collector.register("context_cache", graph.context_cache.stats)
+    if graph.memory:
+        metrics.collector.register("memory", graph.memory.stats)
+    if prefetcher:
+        metrics.collector.register("prefetch", prefetcher.stats)
+    if mirror:
+        metrics.collector.register("mirror", mirror.stats)
+
 app = FastAPI(lifespan=lifespan)
 bearer = HTTPBearer()
 
@@ -42,51 +118,82 @@ async def login(username: str = None, password: str = None, token: str = None):
     """
     if token:
         try:
-            token_check = auth.check_token(token)
+            token_check = await auth.check_token(token)
             return {"token": token}
         except errors.UserAuthenticationFaliure as e:
             return {"error": e.message, "token": None}
     try:
-        return {"token": auth.login(username, password)}
-    except AuthApiError as e:
-        return {"error": str(e)}
+        return {"token": await auth.login(username, password)}
+    except errors.UserAuthenticationFaliure as e:
+        return {"error": e.message}
 
 @app.get("/chat", response_model=None)
-async def chat(prompt: str, thread_id: str, background: BackgroundTasks, token: str = Depends(bearer)):
-    input_time = await app.state.db_pool.fetchval("SELECT NOW()")
+async def chat(prompt: str, thread_id: str, background: BackgroundTasks, request: Request, token: str = Depends(bearer)):
+    """
+    Send a message and stream the agent's answer as server-sent events.\n
+    Events: `token` `{"text"}`, `tool_start` `{"name", "id"}`, `tool_end` `{"name", "id", "status"}`, then `done` or `error` `{"message"}`.\n
+    Token text is coalesced into frames of up to `streaming.max_bytes`, idle streams get `: ping` comments.\n
+    Answers 429 (with Retry-After) when the user or the server is over its limits, 409 while the thread is still answering.
+    """
+    input_time = datetime.datetime.now(datetime.timezone.utc)
     try:
-        userID = auth.check_token(token.credentials).user.id
+        userID = (await auth.check_token(token.credentials))["sub"]
 
         # print(app.__dict__)
 
+        ticket = await app.state.admission.admit(userID, thread_id) if app.state.admission else None
+
         ai_msg_buffer = []
         async def event_generator():
-            async for piece in graph.chat(msg=prompt, _id=thread_id, app=app, user_id=userID):
-                ai_msg_buffer.append(piece)         # collect for later
-                yield piece  
+            async for event, data in graph.chat_events(msg=prompt, _id=thread_id, app=app, user_id=userID):
+                if event == "token":
+                    ai_msg_buffer.append(data["text"])         # collect for later
+                yield event, data
 
             # log input chat
-            background.add_task(database.log_chat, app, userID, prompt, "".join(ai_msg_buffer), input_time)
-        
-        return StreamingResponse(event_generator(), media_type="text/event-stream")
+            background.add_task(database.log_chat, app, thread_id, prompt, "".join(ai_msg_buffer), input_time)
+
+        stream = SSEStream(
+            event_generator(),
+            max_bytes=stream_config.get("max_bytes", 256),
+            max_delay=stream_config.get("max_delay", 0.05),
+            heartbeat=stream_config.get("heartbeat", 15),
+            stats=app.state.streams,
+            disconnected=request.is_disconnected, # a closed connection cancels the turn
+            on_close=ticket.release if ticket else None
+        )
+        return SSEResponse(stream) # releases the ticket even if the body is never sent
     except errors.UserAuthenticationFaliure as e:
         return {"error": e.message}
     except errors.InvalidParameter as e:
         return {"error": e.message}
+    except errors.AdmissionRejected as e:
+        return JSONResponse({"error": e.message}, status_code=e.status, headers={"Retry-After": str(max(1, round(e.retry_after)))})
     
-@app.get("/history", response_model=schemas.Response)
-async def history(thread_id: str, token: str = Depends(bearer), num: int = 0):
+@app.get("/history", response_model=schemas.History)
+async def history(thread_id: str, token: str = Depends(bearer), num: int = 0, cursor: str = None, format: str = "json"):
+    """
+    Page through a thread's history, newest page first.\n
+    `num` parameter is the page size, `cursor` is the `next_cursor` of the previous page.\n
+    `format=ndjson` streams the whole thread as newline delimited JSON instead.\n
+    Will return: `{"data": list, "next_cursor": str | None}`
+    """
     try:
-        userID = auth.check_token(token.credentials).user.id
-        return {"data": await database.get_chat(app, thread_id, num)}
+        userID = (await auth.check_token(token.credentials))["sub"]
+        if format == "ndjson":
+            return StreamingResponse(database.stream_chat(app, thread_id), media_type="application/x-ndjson")
+        data, next_cursor = await database.get_chat(app, thread_id, num, cursor)
+        return {"data": data, "next_cursor": next_cursor}
     
     except errors.UserAuthenticationFaliure as e:
         return {"error": e.message}
+    except errors.InvalidParameter as e:
+        return {"error": e.message}
     
 @app.get("/oauth2token",response_model=schemas.Response)
 async def oath2token(bg: BackgroundTasks, token: str = Depends(bearer)):
     try:
-        userID = auth.check_token(token.credentials).user.id
+        userID = (await auth.check_token(token.credentials))["sub"]
         # google_creds, status = await auth.get_google_oauth_creds(app, userID)
         service = await google_cal.cal_test(app, userID)
         return {"data": service}
@@ -102,3 +209,24 @@ async def oauth2callback(request: Request):
     return {
         "data": "Credentials updated successfully"
     }
+
+@app.post("/calendar/notifications", include_in_schema=False)
+async def calendar_notifications(request: Request):
+    """
+    Google Calendar push notifications for the event mirror.\n
+    Google only needs a 2xx back, unknown channels are ignored rather than retried.
+    """
+    if mirror is None:
+        return Response(status_code=404)
+    await mirror.notify(
+        app,
+        request.headers.get("X-Goog-Channel-ID"),
+        request.headers.get("X-Goog-Channel-Token"),
+        request.headers.get("X-Goog-Resource-State")
+    )
+    return Response(status_code=200)
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus metrics of this worker: stage latencies, model and stream timings, component counters."""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
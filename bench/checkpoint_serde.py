@@ -0,0 +1,132 @@
+"""
+Bytes per checkpoint and encode/decode time of the default Redis checkpoint format against
+agent.serde (CompactSerializer + CompactRedisSaver). Replays a synthetic calendar thread and
+builds the documents the saver would write for every step, no Redis needed.
+
+    python -m bench.checkpoint_serde --turns 30
+"""
+import argparse
+import datetime
+import json
+import random
+import time
+import uuid
+from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+from langgraph.checkpoint.redis.jsonplus_redis import JsonPlusRedisSerializer
+from agent.serde import CompactSerializer
+
+def fake_events(n: int, start: datetime.datetime) -> list[dict]:
+    """Raw events shaped like the Calendar API's, as gcal_get_many_events returns them."""
+    events = []
+    for i in range(n):
+        begin = start + datetime.timedelta(hours=random.randint(0, 24 * 14))
+        eid = uuid.uuid4().hex
+        events.append({
+            "kind": "calendar#event",
+            "etag": f'"{random.randint(10**15, 10**16)}"',
+            "id": eid,
+            "status": "confirmed",
+            "htmlLink": f"https://www.google.com/calendar/event?eid={eid}",
+            "created": "2025-01-01T00:00:00.000Z",
+            "updated": "2025-01-01T00:00:00.000Z",
+            "summary": random.choice(["Standup", "1:1", "Dentist", "Lunch with Sam", "Planning", "Gym"]),
+            "description": "Agenda: " + " ".join(random.choice(["review", "roadmap", "budget", "hiring", "notes"]) for _ in range(12)),
+            "creator": {"email": "user@example.com", "self": True},
+            "organizer": {"email": "user@example.com", "self": True},
+            "start": {"dateTime": begin.isoformat(), "timeZone": "America/Denver"},
+            "end": {"dateTime": (begin + datetime.timedelta(minutes=30)).isoformat(), "timeZone": "America/Denver"},
+            "iCalUID": f"{eid}@google.com",
+            "sequence": 0,
+            "reminders": {"useDefault": True},
+            "eventType": "default"
+        })
+    return events
+
+def fake_turn(i: int) -> list:
+    """One user turn: question, tool call, raw tool result, answer."""
+    call_id = f"call_{i}"
+    start = datetime.datetime(2025, 6, 2, 8, tzinfo=datetime.timezone.utc)
+    return [
+        HumanMessage(f"What do I have going on in the week of June {i % 28 + 1}?", id=str(uuid.uuid4())),
+        AIMessage("", id=str(uuid.uuid4()), tool_calls=[{"name": "google_calendar", "args": {"action": "get_many", "kwargs": {"timeMin": start.isoformat()}}, "id": call_id}]),
+        ToolMessage(json.dumps(fake_events(8, start)), tool_call_id=call_id, id=str(uuid.uuid4())),
+        AIMessage("You have a standup every morning, a dentist appointment on Wednesday and lunch with Sam on Friday.", id=str(uuid.uuid4()))
+    ]
+
+def checkpoints(turns: int):
+    """Yield (checkpoint, changed channels) for every step, like the agent's graph writes them."""
+    messages = []
+    version = 0
+    for i in range(turns):
+        for message in fake_turn(i):
+            messages = messages + [message]
+            version += 1
+            values = {"messages": messages, "thread_id": "bench", "user_id": "bench"}
+            checkpoint = {
+                "v": 3,
+                "id": str(uuid.uuid4()),
+                "ts": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "channel_values": values,
+                "channel_versions": {"messages": version, "thread_id": 1, "user_id": 1},
+                "versions_seen": {"model": {"messages": version}},
+                "pending_sends": []
+            }
+            yield checkpoint, {"messages": messages}
+
+def write(serde, checkpoint: dict, changed: dict, compact: bool) -> list[str]:
+    """The JSON documents the saver stores for one checkpoint (see BaseRedisSaver._dump_* and CompactRedisSaver)."""
+    dumped = {**checkpoint, "channel_values": {}} if compact else checkpoint
+    type_, data = JsonPlusRedisSerializer.dumps_typed(serde, dumped)
+    docs = [json.dumps({"checkpoint": {"type": type_, **json.loads(data), "pending_sends": []}})]
+    for channel, value in changed.items():
+        t, b = serde.dumps_typed(value)
+        docs.append(json.dumps({"channel": channel, "type": t, "blob": b}))
+    return docs
+
+def read(serde, docs: list[str]):
+    json.loads(docs[0])
+    for doc in docs[1:]:
+        blob = json.loads(doc)
+        serde.loads_typed((blob["type"], blob["blob"]))
+
+def run(name: str, serde, compact: bool, turns: int) -> dict:
+    sizes, encode, decode = [], 0.0, 0.0
+    for checkpoint, changed in checkpoints(turns):
+        t0 = time.perf_counter()
+        docs = write(serde, checkpoint, changed, compact)
+        t1 = time.perf_counter()
+        read(serde, docs)
+        t2 = time.perf_counter()
+        encode += t1 - t0
+        decode += t2 - t1
+        sizes.append(sum(len(d) for d in docs))
+    return {
+        "format": name,
+        "checkpoints": len(sizes),
+        "avg_bytes": sum(sizes) / len(sizes),
+        "last_bytes": sizes[-1],
+        "total_bytes": sum(sizes),
+        "encode_ms": encode / len(sizes) * 1000,
+        "decode_ms": decode / len(sizes) * 1000
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    formats = [
+        ("json (default)", JsonPlusRedisSerializer(), False),
+        ("msgpack", CompactSerializer(compression=None), True),
+        ("msgpack+zstd", CompactSerializer(), True)
+    ]
+    results = []
+    for name, serde, compact in formats:
+        random.seed(args.seed)
+        results.append(run(name, serde, compact, args.turns))
+    base = results[0]["total_bytes"]
+    print(f"{'format':<16} {'checkpoints':>11} {'avg bytes':>10} {'last bytes':>11} {'ratio':>6} {'encode ms':>10} {'decode ms':>10}")
+    for r in results:
+        print(f"{r['format']:<16} {r['checkpoints']:>11} {r['avg_bytes']:>10.0f} {r['last_bytes']:>11} {r['total_bytes'] / base:>6.2f} {r['encode_ms']:>10.3f} {r['decode_ms']:>10.3f}")
@@ -0,0 +1,263 @@
+"""
+What a turn costs besides the model: the prompt template, the agent nested in the `model`
+node, ToolNode dispatch, add_messages merging and checkpoint serialization, as threads grow.
+Runs agent.graph.workflow (with the nodes config.yml enables) on a zero-latency fake model,
+FakeCalendar and an InMemorySaver using the app's checkpoint serializer. For every history
+length and number of tool calls per turn it seeds a thread and times `--turns` turns through
+chat_events, like /chat runs them. Compaction is off unless `--compaction`, so the history
+length is what the nodes actually see.
+
+    python -m bench.graph_overhead --history 10,100,1000 --tool-calls 0,1,4
+    python -m bench.graph_overhead --profile turn.prof   # cProfile of the largest case as well
+
+Per turn it reports wall time, the time models and tools were running and the rest (graph
+overhead), checkpoint writes and bytes, serialization time and memory allocated (tracemalloc,
+on one extra turn as tracing slows everything down). Per node times come from the same
+callback /metrics uses; `agent` and `tools` are the nodes of the agent nested in `model`.
+The growth exponent compares the two longest histories: 1 is linear per turn (so quadratic
+over a thread's life), 2 quadratic per turn.
+"""
+import argparse
+import asyncio
+import cProfile
+import datetime
+import math
+import pstats
+import statistics
+import time
+import tracemalloc
+import uuid
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.graph.message import add_messages
+from langgraph.prebuilt import create_react_agent
+from google.oauth2.credentials import Credentials
+from bench import offline_app
+from bench.checkpoint_serde import fake_turn
+from utils import metrics
+
+class CountingSerializer:
+    """Checkpoint serializer wrapper counting what goes through it."""
+    def __init__(self, serde):
+        self.serde = serde
+        self.reset()
+
+    def reset(self):
+        self.writes = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def dumps_typed(self, obj) -> tuple:
+        start = time.perf_counter()
+        type_, data = self.serde.dumps_typed(obj)
+        self.seconds += time.perf_counter() - start
+        self.writes += 1
+        self.bytes += len(data)
+        return type_, data
+
+    def loads_typed(self, data: tuple):
+        return self.serde.loads_typed(data)
+
+
+class Recorder(metrics.MetricsCallback):
+    """The /metrics callback, also keeping (stage, name, start, end) of every run it times."""
+    def __init__(self):
+        super().__init__()
+        self.spans = []
+
+    def _end(self, run_id, error: bool = False):
+        run = super()._end(run_id, error)
+        if run is not None:
+            self.spans.append((run[0], run[1], run[2], time.perf_counter()))
+        return run
+
+    def busy(self, stages: tuple) -> float:
+        """Seconds during which a run of one of `stages` was going, parallel runs counted once."""
+        total, until = 0.0, float("-inf")
+        for start, end in sorted((start, end) for stage, _, start, end in self.spans if stage in stages):
+            total += max(0.0, end - max(start, until))
+            until = max(until, end)
+        return total
+
+
+class ToolCalls:
+    """Fake model response making `calls` parallel calendar lookups once per turn, then answering."""
+    def __init__(self, tools: list, calls: int):
+        self.turns = offline_app.ScriptedTurns(tools, {"answer": 1})
+        self.calls = calls
+
+    def __call__(self, messages: list):
+        turn = max(i for i, m in enumerate(messages) if isinstance(m, HumanMessage))
+        if self.calls and not any(isinstance(m, AIMessage) and m.tool_calls for m in messages[turn:]):
+            return AIMessage("", tool_calls=[self.turns.call("get_many") for _ in range(self.calls)])
+        return self.turns(messages)
+
+def install_model(g, calls: int):
+    from agent.fake_models import FakeChatModel
+    def react(tools):
+        return create_react_agent(FakeChatModel(responses=[ToolCalls(tools, calls)]), tools)
+    g.agent = react(g.route_tools.get("full", g.tools))
+    if g.router:
+        g.router.routes = {route: react(g.route_tools.get(route, g.tools)) for route in g.router.routes}
+
+def history(n: int) -> list:
+    """About `n` messages of earlier turns (question, tool call, events, answer), whole turns only."""
+    messages = []
+    for i in range(max(1, round(n / 4))):
+        messages.extend(fake_turn(i))
+    return messages
+
+async def turn(g, graph, thread: str) -> float:
+    start = time.perf_counter()
+    async for _ in g.chat_events("What do I have going on this week?", thread, graph, "bench"):
+        pass
+    return time.perf_counter() - start
+
+async def run_case(g, graph, serde: CountingSerializer, recorder: Recorder, n: int, calls: int, turns: int, profiler: cProfile.Profile = None) -> dict:
+    install_model(g, calls)
+    thread = f"bench-{uuid.uuid4().hex[:8]}"
+    seeded = history(n)
+    config = {"configurable": {"thread_id": thread, "app": graph, "user_id": "bench"}}
+    # seeded the way chat_events starts a thread, the warm up turn then runs from that update
+    await graph.aupdate_state(config, {"messages": seeded, "user_id": "bench", "thread_id": thread})
+    async for _ in graph.astream({"messages": [HumanMessage("Hi")]}, config, stream_mode="messages"):
+        pass
+    measured = len((await graph.aget_state(config)).values["messages"])
+    times, model, tools, overhead, nodes = [], [], [], [], {}
+    serde.reset()
+    for _ in range(turns):
+        recorder.spans.clear()
+        if profiler:
+            profiler.enable()
+        times.append(await turn(g, graph, thread))
+        if profiler:
+            profiler.disable()
+        model.append(recorder.busy(("llm",)))
+        tools.append(recorder.busy(("tool",)))
+        overhead.append(times[-1] - recorder.busy(("llm", "tool")))
+        for stage, name, start, end in recorder.spans:
+            if stage == "node":
+                nodes.setdefault(name, [0.0] * turns)[len(times) - 1] += end - start
+    writes, written, serialize = serde.writes / turns, serde.bytes / turns, serde.seconds / turns
+
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    await turn(g, graph, thread)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "history": measured,
+        "calls": calls,
+        "turn": statistics.median(times),
+        "model": statistics.median(model),
+        "tools": statistics.median(tools),
+        "overhead": statistics.median(overhead),
+        "writes": writes,
+        "bytes": written,
+        "serialize": serialize,
+        "peak": peak - baseline,
+        "retained": retained - baseline,
+        "nodes": {name: statistics.median(values) for name, values in nodes.items()}
+    }
+
+async def best(run, repeat: int = 5) -> float:
+    """Fastest of `repeat` runs of a sync or async callable, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        if asyncio.iscoroutine(result):
+            await result
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+async def components(g, graph, n: int, serde) -> dict:
+    """Prompt rendering, message merging and serializing the message list, each on its own."""
+    messages = history(n)
+    state = {"messages": messages, "summary": None, "memories": "", "user_id": "bench", "thread_id": "bench"}
+    result = {"history": len(messages)}
+    for name, run in (
+            ("prompt", lambda: g.prompt_template.ainvoke({**state, "context": g.current_context(None)})),
+            ("add_messages", lambda: add_messages(messages, [HumanMessage("one more", id=str(uuid.uuid4()))])),
+            ("serialize", lambda: serde.dumps_typed(messages))):
+        result[name] = await best(run)
+    result["bytes"] = len(serde.dumps_typed(messages)[1])
+    return result
+
+def exponent(rows: list[dict], metric: str) -> float:
+    first, last = rows[-2], rows[-1] # the longest histories, where fixed costs matter least
+    if first[metric] <= 0 or last[metric] <= 0 or first["history"] == last["history"]:
+        return float("nan")
+    return math.log(last[metric] / first[metric]) / math.log(last["history"] / first["history"])
+
+async def main(args: argparse.Namespace):
+    from agent import graph as g, serde as checkpoint_serde
+    from agent.tools import calendar_client
+    from agent.tools.fake_calendar import FakeCalendar
+    from utils import auth
+
+    async def get_google_oauth_creds(app, user_id: str):
+        return Credentials("bench")
+    auth.get_google_oauth_creds = auth.find_google_oauth_creds = get_google_oauth_creds
+    calendar = FakeCalendar()
+    start = datetime.datetime.now(datetime.timezone.utc)
+    for i in range(args.events):
+        begin = start + datetime.timedelta(hours=i * 336 // max(1, args.events))
+        calendar.add_event({"summary": "Standup", "start": {"dateTime": begin.isoformat()}, "end": {"dateTime": (begin + datetime.timedelta(minutes=30)).isoformat()}})
+    calendar_client.set_http_factory(calendar.http_factory)
+    offline_app.fake_agents(g, {"answer": 1}, 0, 0, args.words) # summarizer, extractor, no context cache
+    if g.compactor and not args.compaction:
+        g.compactor.budget = float("inf") # the thread keeps its full history
+    recorder = metrics.callback = Recorder() # chat_events runs turns with metrics.callback
+
+    inner = checkpoint_serde.CompactSerializer() if args.serde == "compact" else checkpoint_serde.JsonPlusRedisSerializer()
+    counting = CountingSerializer(inner)
+    graph = g.workflow.compile(checkpointer=InMemorySaver(serde=counting))
+    lengths = [int(n) for n in args.history.split(",")]
+    tool_calls = [int(c) for c in args.tool_calls.split(",")]
+
+    rows = [await run_case(g, graph, counting, recorder, n, calls, args.turns) for calls in tool_calls for n in lengths]
+    print(f"nodes entered before the model: {', '.join(g.entry)}; serializer: {args.serde}; compaction: {'on' if g.compactor and args.compaction else 'off'}\n")
+    print(f"{'history':>8}{'calls':>6}{'turn ms':>9}{'model':>8}{'tools':>8}{'overhead':>10}{'ckpt writes':>12}{'ckpt KB':>9}{'serde ms':>9}{'alloc peak KB':>14}{'retained KB':>12}")
+    for r in rows:
+        print(
+            f"{r['history']:>8}{r['calls']:>6}{r['turn'] * 1000:>9.1f}{r['model'] * 1000:>8.1f}{r['tools'] * 1000:>8.1f}{r['overhead'] * 1000:>10.1f}"
+            f"{r['writes']:>12.1f}{r['bytes'] / 1024:>9.1f}{r['serialize'] * 1000:>9.2f}{r['peak'] / 1024:>14.0f}{r['retained'] / 1024:>12.0f}"
+        )
+
+    names = sorted({name for r in rows for name in r["nodes"]})
+    print(f"\nper node ms (median turn)\n{'history':>8}{'calls':>6}" + "".join(f"{name:>10}" for name in names))
+    for r in rows:
+        print(f"{r['history']:>8}{r['calls']:>6}" + "".join(f"{r['nodes'].get(name, 0) * 1000:>10.2f}" for name in names))
+
+    if len(lengths) > 1:
+        print("\ngrowth exponent between the two longest histories (1 linear, 2 quadratic)")
+        for calls in tool_calls:
+            case = [r for r in rows if r["calls"] == calls]
+            print(f"  {calls} tool calls: overhead {exponent(case, 'overhead'):.2f}, checkpoint bytes {exponent(case, 'bytes'):.2f}, allocations {exponent(case, 'peak'):.2f}")
+
+    parts = [await components(g, graph, n, inner) for n in lengths]
+    print(f"\n{'history':>8}{'prompt ms':>11}{'add_messages ms':>17}{'serialize ms':>14}{'messages KB':>13}")
+    for p in parts:
+        print(f"{p['history']:>8}{p['prompt'] * 1000:>11.2f}{p['add_messages'] * 1000:>17.3f}{p['serialize'] * 1000:>14.2f}{p['bytes'] / 1024:>13.1f}")
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        await run_case(g, graph, counting, recorder, max(lengths), max(tool_calls), args.turns, profiler)
+        profiler.dump_stats(args.profile)
+        print(f"\nprofile of {max(lengths)} messages and {max(tool_calls)} tool calls per turn written to {args.profile}, top functions by own time:")
+        pstats.Stats(profiler).sort_stats("tottime").print_stats(args.profile_top)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--history", default="10,100,1000", help="messages already in the thread, comma separated")
+    parser.add_argument("--tool-calls", default="0,1,4", help="parallel tool calls per turn, comma separated")
+    parser.add_argument("--turns", type=int, default=5, help="turns timed per case, the median is reported")
+    parser.add_argument("--words", type=int, default=40, help="words per answer")
+    parser.add_argument("--events", type=int, default=50, help="events in the fake calendar")
+    parser.add_argument("--serde", choices=["compact", "jsonplus"], default="compact", help="checkpoint serializer, compact is the app's default")
+    parser.add_argument("--compaction", action="store_true", help="keep compaction on (when configured), it caps the history the other nodes see")
+    parser.add_argument("--profile", help="also profile the largest case with cProfile and write the stats here")
+    parser.add_argument("--profile-top", type=int, default=25, help="functions printed from the profile")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,310 @@
+"""
+HTTP load test of /chat, /history and /login against the app with every external service
+faked (see bench.offline_app), so it runs on a laptop or in CI without keys or servers.
+Starts the offline app in a subprocess, keeps `--concurrency` virtual users sending requests
+back to back for `--duration` seconds and reports, per endpoint, requests/s, time to first
+byte, time to the first answer token (/chat) and p50/p95/p99 latencies, plus the server's RSS
+growth per concurrent connection.
+
+    python -m bench.load_test --concurrency 50 --duration 30 --token-rate 80
+    python -m bench.load_test --save                       # store as the scenario's baseline
+    python -m bench.load_test --url http://localhost:8000  # a running server, tokens "bench-<user>"
+
+Results are compared with the baseline of the same `--scenario` in `--baseline` when there is
+one, the run fails (exit 1) when a metric is worse by more than `--tolerance`. Baselines are
+only comparable on the same machine and settings, re-save them after changing either. With the
+default in-memory checkpointer the RSS growth includes the checkpoints of the threads created.
+"""
+import argparse
+import asyncio
+import bisect
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import httpx
+from bench import offline_app
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines", "load_test.json")
+
+MIN_REQUESTS = 30 # endpoints with fewer requests in either run aren't compared, their percentiles are noise
+
+# metric -> True when higher is better, compared against the baseline
+COMPARED = {
+    "rps": True,
+    "ttfb_p95": False,
+    "first_token_p95": False,
+    "latency_p95": False,
+    "latency_p99": False
+}
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def rss(pid: int) -> int:
+    """Resident set size of a process in bytes, 0 where /proc isn't available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Results:
+    """Timings of every request of one endpoint."""
+    def __init__(self):
+        self.ttfb = []
+        self.first_token = []
+        self.latency = []
+        self.errors = 0
+
+    def summary(self, seconds: float) -> dict:
+        return {
+            "requests": len(self.latency),
+            "errors": self.errors,
+            "rps": len(self.latency) / seconds,
+            **{f"ttfb_p{p}": percentile(self.ttfb, p / 100) for p in (50, 95, 99)},
+            **{f"first_token_p{p}": percentile(self.first_token, p / 100) for p in (50, 95, 99)},
+            **{f"latency_p{p}": percentile(self.latency, p / 100) for p in (50, 95, 99)}
+        }
+
+
+class LoadTest:
+    """
+    :param url: base URL of the server
+    :param concurrency: virtual users, each with one request in flight at a time
+    :param mix: endpoint -> weight
+    :param turns_per_thread: /chat turns a user sends to one thread before starting another,
+        threads grow by two messages (and their checkpoints) per turn
+    :param think: seconds a user waits between requests
+    """
+    def __init__(self, url: str, concurrency: int, mix: dict[str, float], turns_per_thread: int = 10, think: float = 0.0):
+        self.url = url
+        self.concurrency = concurrency
+        self.endpoints = list(mix)
+        self.cumulative = [sum(list(mix.values())[:i + 1]) for i in range(len(mix))]
+        self.turns_per_thread = turns_per_thread
+        self.think = think
+        self.results = {endpoint: Results() for endpoint in mix}
+        self.measuring = False
+
+    async def chat(self, client: httpx.AsyncClient, user: str, thread: str) -> tuple:
+        start = time.perf_counter()
+        ttfb = first_token = None
+        ok = False
+        async with client.stream("GET", "/chat", params={"prompt": "What's on my calendar this week?", "thread_id": thread}, headers={"Authorization": f"Bearer bench-{user}"}) as resp:
+            async for chunk in resp.aiter_raw():
+                now = time.perf_counter()
+                ttfb = ttfb or now - start
+                if first_token is None and b"event: token" in chunk:
+                    first_token = now - start
+                if b"event: done" in chunk:
+                    ok = True
+            ok = ok and resp.status_code == 200
+        return ok, ttfb, first_token
+
+    async def history(self, client: httpx.AsyncClient, user: str, thread: str) -> tuple:
+        start = time.perf_counter()
+        ttfb = None
+        async with client.stream("GET", "/history", params={"thread_id": thread, "num": 50}, headers={"Authorization": f"Bearer bench-{user}"}) as resp:
+            async for chunk in resp.aiter_raw():
+                ttfb = ttfb or time.perf_counter() - start
+        return resp.status_code == 200, ttfb, None
+
+    async def login(self, client: httpx.AsyncClient, user: str, thread: str) -> tuple:
+        start = time.perf_counter()
+        resp = await client.post("/login", params={"username": user, "password": "bench"})
+        return resp.status_code == 200 and bool(resp.json().get("token")), time.perf_counter() - start, None
+
+    async def user(self, client: httpx.AsyncClient, i: int, deadline: float):
+        rng = random.Random(i)
+        user, turns = f"load-{i}", 0
+        while time.perf_counter() < deadline:
+            endpoint = self.endpoints[bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])]
+            thread = f"{user}-{turns // self.turns_per_thread}"
+            start = time.perf_counter()
+            try:
+                ok, ttfb, first_token = await getattr(self, endpoint)(client, user, thread)
+            except httpx.HTTPError:
+                ok, ttfb, first_token = False, None, None
+            latency = time.perf_counter() - start
+            turns += endpoint == "chat"
+            if self.think:
+                await asyncio.sleep(self.think)
+            if not self.measuring:
+                continue
+            results = self.results[endpoint]
+            if not ok:
+                results.errors += 1
+                continue
+            results.latency.append(latency)
+            if ttfb is not None:
+                results.ttfb.append(ttfb)
+            if first_token is not None:
+                results.first_token.append(first_token)
+
+    async def run(self, duration: float, warmup: float, pid: int = None) -> dict:
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        async with httpx.AsyncClient(base_url=self.url, limits=limits, timeout=120) as client:
+            for endpoint in self.endpoints: # import paths and caches warm before the idle sample
+                await getattr(self, endpoint)(client, "warmup", "warmup")
+            idle = rss(pid) if pid else 0
+            peak = idle
+            deadline = time.perf_counter() + warmup + duration
+            users = [asyncio.create_task(self.user(client, i, deadline)) for i in range(self.concurrency)]
+            await asyncio.sleep(warmup)
+            self.measuring = True
+            start = time.perf_counter()
+            while not all(u.done() for u in users):
+                if pid:
+                    peak = max(peak, rss(pid))
+                await asyncio.sleep(0.2)
+            elapsed = min(time.perf_counter() - start, duration) # requests in flight at the deadline still finish
+            await asyncio.gather(*users)
+        return {
+            "endpoints": {endpoint: results.summary(elapsed) for endpoint, results in self.results.items()},
+            "memory": {
+                "rss_idle_mb": idle / 2**20,
+                "rss_peak_mb": peak / 2**20,
+                "per_connection_kb": (peak - idle) / self.concurrency / 1024
+            } if pid else {}
+        }
+
+
+def serve(port: int, args: argparse.Namespace) -> subprocess.Popen:
+    """Start bench.offline_app with the fake settings in `args` and wait for it to answer."""
+    command = [
+        sys.executable, "-m", "bench.offline_app", "--port", str(port),
+        "--tool-mix", args.tool_mix, "--first-token", str(args.first_token), "--token-rate", str(args.token_rate),
+        "--words", str(args.words), "--calendar-latency", str(args.calendar_latency), "--events", str(args.events),
+        "--auth-latency", str(args.auth_latency)
+    ]
+    for flag, value in (("--redis-url", args.redis_url), ("--postgres-url", args.postgres_url), ("--seed", args.seed)):
+        if value is not None:
+            command += [flag, str(value)]
+    server = subprocess.Popen(command)
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"offline app exited with {server.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise SystemExit("offline app didn't start within 60s")
+
+def settings(args: argparse.Namespace) -> dict:
+    """What a baseline's numbers depend on, a comparison with other settings is flagged."""
+    keys = ("concurrency", "duration", "mix", "turns_per_thread", "think", "tool_mix", "first_token", "token_rate", "words", "calendar_latency", "events", "auth_latency")
+    return {key: getattr(args, key) for key in keys}
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Metrics worse than the baseline by more than `tolerance`, formatted."""
+    regressions = []
+    print(f"\n{'vs baseline':<26}{'baseline':>12}{'now':>12}{'change':>10}")
+    rows = [(f"{endpoint} {metric}", baseline["endpoints"][endpoint][metric], values[metric], higher)
+            for endpoint, values in result["endpoints"].items()
+            if endpoint in baseline["endpoints"] and min(values["requests"], baseline["endpoints"][endpoint]["requests"]) >= MIN_REQUESTS
+            for metric, higher in COMPARED.items() if baseline["endpoints"][endpoint][metric]]
+    if result["memory"] and baseline.get("memory", {}).get("per_connection_kb"):
+        rows.append(("memory per_connection_kb", baseline["memory"]["per_connection_kb"], result["memory"]["per_connection_kb"], False))
+    for name, before, now, higher in rows:
+        change = (now - before) / before
+        worse = -change if higher else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        print(f"{name:<26}{before:>12.4f}{now:>12.4f}{change:>+10.1%}{flag}")
+        if flag:
+            regressions.append(f"{name} {before:.4f} -> {now:.4f}")
+    return regressions
+
+def report(result: dict):
+    print(f"{'endpoint':<10}{'requests':>9}{'errors':>7}{'req/s':>8}{'ttfb p50':>10}{'p95':>8}{'p99':>8}{'1st tok p50':>13}{'p95':>8}{'latency p50':>13}{'p95':>8}{'p99':>8}")
+    for endpoint, s in result["endpoints"].items():
+        print(
+            f"{endpoint:<10}{s['requests']:>9}{s['errors']:>7}{s['rps']:>8.1f}"
+            f"{s['ttfb_p50']:>10.3f}{s['ttfb_p95']:>8.3f}{s['ttfb_p99']:>8.3f}"
+            f"{s['first_token_p50']:>13.3f}{s['first_token_p95']:>8.3f}"
+            f"{s['latency_p50']:>13.3f}{s['latency_p95']:>8.3f}{s['latency_p99']:>8.3f}"
+        )
+    if result["memory"]:
+        m = result["memory"]
+        print(f"\nserver RSS {m['rss_idle_mb']:.1f} MB idle, {m['rss_peak_mb']:.1f} MB peak, {m['per_connection_kb']:.1f} KB per connection")
+
+async def main(args: argparse.Namespace) -> int:
+    mix = {}
+    for part in args.mix.split(","):
+        name, _, weight = part.partition(":")
+        if name.strip() not in ("chat", "history", "login"):
+            raise SystemExit(f"unknown endpoint {name!r} in --mix, expected chat, history or login")
+        mix[name.strip()] = float(weight or 1)
+    offline_app.parse_mix(args.tool_mix) # fail on a typo before starting anything
+    server, pid, url = None, args.pid, args.url
+    if not url:
+        port = free_port()
+        server = serve(port, args)
+        pid, url = server.pid, f"http://127.0.0.1:{port}"
+    try:
+        test = LoadTest(url, args.concurrency, mix, args.turns_per_thread, args.think)
+        result = await test.run(args.duration, args.warmup, pid)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    result["settings"] = settings(args)
+    report(result)
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.save:
+        baselines[args.scenario] = result
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"\nsaved as baseline {args.scenario!r} in {args.baseline}")
+        return 0
+    if args.scenario not in baselines:
+        return 0
+    baseline = baselines[args.scenario]
+    if baseline.get("settings") != result["settings"]:
+        print(f"\nnote: baseline {args.scenario!r} was recorded with other settings: {baseline.get('settings')}")
+    regressions = compare(result, baseline, args.tolerance)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.tolerance:.0%}: " + "; ".join(regressions))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=20, help="virtual users, one request in flight each")
+    parser.add_argument("--duration", type=float, default=20, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("--mix", default="chat:0.8,history:0.15,login:0.05", help="endpoints and their weights")
+    parser.add_argument("--turns-per-thread", type=int, default=10, help="/chat turns per thread before a user starts a new one")
+    parser.add_argument("--think", type=float, default=0.0, help="seconds a user waits between requests")
+    parser.add_argument("--url", help="load a running server instead of starting the offline app")
+    parser.add_argument("--pid", type=int, help="process ID of the --url server, to sample its memory")
+    parser.add_argument("--baseline", default=BASELINES, help="JSON file of baselines by scenario")
+    parser.add_argument("--scenario", default="default", help="name of the baseline compared with or saved")
+    parser.add_argument("--save", action="store_true", help="store the results as the scenario's baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative change that counts as a regression")
+    offline_app.add_arguments(parser)
+    raise SystemExit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,312 @@
+"""
+The FastAPI app with every external service swapped for a local stand-in, for load tests:
+
+- the Gemini models: FakeChatModel with a configurable first-token latency, token rate and
+  mix of tool-call patterns per turn
+- Google Calendar: FakeCalendar, seeded with events around now
+- Supabase: tokens "bench-<user>" verify as <user>, /login hands them out
+- Redis: fakeredis, or a real server with `redis_url` (then checkpoints go to it as well,
+  otherwise they stay in an InMemorySaver)
+- Postgres: MemoryPool, which only answers the chat_history and memories queries, or a real
+  server with `postgres_url` (needed with the calendar mirror on)
+
+The app's own lifespan runs with these patched in, the Google OAuth client aside (see
+`app.google_startup`).
+
+Run it on its own with
+
+    python -m bench.offline_app --port 8000 --token-rate 50 --tool-mix answer:0.6,lookup:0.3,chain:0.1
+"""
+import argparse
+import asyncio
+import bisect
+import datetime
+import random
+import uuid
+from contextlib import asynccontextmanager
+from fastapi import FastAPI
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.prebuilt import create_react_agent
+from google.oauth2.credentials import Credentials
+
+# tool calls of each step of a turn, by pattern; a turn without steps is answered directly
+PATTERNS = {
+    "answer": [],
+    "lookup": [["get_many"]],
+    "parallel": [["get_many", "find_slots"]],
+    "chain": [["get_many"], ["find_slots"]]
+}
+
+WORDS = "you have a standup at nine then lunch with Sam and the afternoon is free after three".split()
+
+def parse_mix(mix: str) -> dict[str, float]:
+    """"answer:0.6,lookup:0.4" -> {"answer": 0.6, "lookup": 0.4}"""
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition(":")
+        if name.strip() not in PATTERNS:
+            raise ValueError(f"unknown tool-call pattern {name!r}, expected one of {', '.join(PATTERNS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+def tool_args(action: str) -> dict:
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    window = {"timeMin": now.isoformat(), "timeMax": (now + datetime.timedelta(days=7)).isoformat()}
+    if action == "find_slots":
+        return {**window, "durationMinutes": 30}
+    return {**window, "maxResults": 20, "q": None}
+
+
+class ScriptedTurns:
+    """
+    FakeChatModel response picking a tool-call pattern per turn and answering in `words` words.
+    The pattern is drawn from the turn's human message, so every step of the turn agrees on it.
+    :param tools: the tools the model is bound to, calls are made in their format
+    :param mix: pattern -> weight
+    """
+    def __init__(self, tools: list, mix: dict[str, float], words: int = 40):
+        names = {tool.name for tool in tools}
+        self.union = "google_calendar" in names # one tool with an `action` argument, otherwise one tool per action
+        self.names = names
+        self.patterns = list(mix)
+        self.cumulative = [sum(list(mix.values())[:i + 1]) for i in range(len(mix))]
+        self.words = words
+
+    def call(self, action: str) -> dict:
+        if self.union:
+            return {"name": "google_calendar", "args": {"action": action, "kwargs": tool_args(action)}, "id": f"call_{uuid.uuid4().hex[:12]}"}
+        return {"name": f"calendar_{action}", "args": tool_args(action), "id": f"call_{uuid.uuid4().hex[:12]}"}
+
+    def __call__(self, messages: list):
+        turn = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
+        draw = random.Random(messages[turn].id or messages[turn].content).random() * self.cumulative[-1]
+        steps = PATTERNS[self.patterns[bisect.bisect(self.cumulative, draw)]]
+        done = sum(1 for m in messages[turn:] if isinstance(m, AIMessage) and m.tool_calls)
+        if done < len(steps):
+            calls = [self.call(action) for action in steps[done] if self.union or f"calendar_{action}" in self.names]
+            if calls:
+                return AIMessage("", tool_calls=calls)
+        return " ".join(WORDS[i % len(WORDS)] for i in range(self.words)).capitalize() + "."
+
+
+class MemoryConnection:
+    """The part of an asyncpg connection the chat_history code uses, over a list of rows."""
+    def __init__(self, pool: "MemoryPool"):
+        self.pool = pool
+
+    async def copy_records_to_table(self, table: str, records: list, columns: tuple):
+        if table != "chat_history":
+            raise NotImplementedError(f"MemoryPool has no table {table}")
+        for record in records:
+            self.pool.history.setdefault(record[0], []).append(dict(zip(columns, record)))
+
+    def _history(self, thread_id: str, before: datetime.datetime = None) -> list[dict]:
+        rows = [r for r in self.pool.history.get(thread_id, []) if before is None or r["created_at"] < before]
+        return [{"type": r["role"], "content": r["content"], "timestamp": r["created_at"]} for r in sorted(rows, key=lambda r: r["created_at"])]
+
+    async def fetch(self, query: str, *args):
+        if "FROM memories" in query:
+            return list(self.pool.memories.get(args[0], {}).values())
+        if "FROM chat_history" not in query:
+            raise NotImplementedError("MemoryPool only answers chat_history and memories queries, use a real Postgres")
+        thread_id, before, limit = args
+        return self._history(thread_id, before)[::-1][:limit]
+
+    async def cursor(self, query: str, thread_id: str, prefetch: int = None):
+        for row in self._history(thread_id):
+            yield row
+
+    def transaction(self):
+        return _nothing()
+
+    async def execute(self, query: str, *args):
+        if query.startswith("DELETE FROM memories"):
+            user_id, ids = args
+            for id in ids:
+                self.pool.memories.get(user_id, {}).pop(id, None)
+            return
+        raise NotImplementedError("MemoryPool only answers chat_history and memories queries, use a real Postgres")
+
+    async def executemany(self, query: str, args: list):
+        if "INTO memories" not in query:
+            raise NotImplementedError("MemoryPool only answers chat_history and memories queries, use a real Postgres")
+        columns = ("user_id", "memory_id", "kind", "text", "embedder", "embedding", "created_at", "updated_at")
+        for record in args:
+            self.pool.memories.setdefault(record[0], {})[record[1]] = dict(zip(columns, record))
+
+    fetchrow = fetchval = execute
+
+
+@asynccontextmanager
+async def _nothing():
+    yield
+
+
+class MemoryPool:
+    """Stand-in for the app's asyncpg pool holding chat_history and memories in memory."""
+    def __init__(self, max_size: int = 20):
+        self.history: dict[str, list[dict]] = {} # thread_id -> rows
+        self.memories: dict[str, dict[str, dict]] = {} # user_id -> memory_id -> row
+        self.max_size = max_size
+        self.in_use = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        self.in_use += 1
+        try:
+            yield MemoryConnection(self)
+        finally:
+            self.in_use -= 1
+
+    def get_size(self) -> int:
+        return self.max_size
+
+    def get_max_size(self) -> int:
+        return self.max_size
+
+    def get_idle_size(self) -> int:
+        return self.max_size - self.in_use
+
+    async def close(self):
+        pass
+
+
+class MemorySaver(InMemorySaver):
+    """InMemorySaver with the AsyncRedisSaver setup call the lifespan makes."""
+    async def asetup(self):
+        pass
+
+
+def fake_agents(g, mix: dict[str, float], latency: float, token_rate: float, words: int, seed: int = None):
+    """Put fake models everywhere agent.graph uses a Gemini model."""
+    from agent.fake_models import FakeChatModel
+    from agent.compaction import ModelSummarizer
+    from agent.memory.extract import ModelExtractor
+
+    def react(tools):
+        model = FakeChatModel(responses=[ScriptedTurns(tools, mix, words)], latency=latency, token_latency=1 / token_rate if token_rate else 0, seed=seed)
+        return create_react_agent(model, tools)
+
+    g.agent = react(g.route_tools.get("full", g.tools))
+    if g.router:
+        g.router.routes = {route: react(g.route_tools.get(route, g.tools)) for route in g.router.routes}
+    g.context_cache = None # cached prompts would go to base_model
+    if g.compactor:
+        g.compactor.summarizer = ModelSummarizer(FakeChatModel(responses=["The user asked about their week."], latency=latency))
+    if g.memory:
+        g.memory.extractor = ModelExtractor(FakeChatModel(responses=['[{"text": "Prefers mornings", "kind": "preference"}]'], latency=latency))
+    for model in g.lazy_models.values(): # built already, so the lifespan's load_models and warming stay offline
+        model._model = FakeChatModel(responses=["ok"], latency=latency)
+
+
+def build(
+        mix: str = "answer:0.6,lookup:0.3,chain:0.1",
+        latency: float = 0.3,
+        token_rate: float = 50,
+        words: int = 40,
+        calendar_latency: float = 0.05,
+        events: int = 200,
+        auth_latency: float = 0.0,
+        redis_url: str = None,
+        postgres_url: str = None,
+        seed: int = None) -> FastAPI:
+    """
+    The app, patched to run offline.
+    :param mix: tool-call patterns of turns and their weights, see PATTERNS
+    :param latency: seconds to a model call's first token
+    :param token_rate: streamed words per second, 0 for as fast as possible
+    :param words: words per answer
+    :param calendar_latency: seconds each Calendar API request takes
+    :param events: events seeded in the calendar, spread over the next two weeks
+    :param auth_latency: seconds a token verification takes
+    :param redis_url: a real Redis (Stack) for the app and its checkpoints, fakeredis otherwise
+    :param postgres_url: a real Postgres, MemoryPool otherwise
+    """
+    import asyncpg
+    import app as application
+    from agent import graph as g, serde
+    from agent.retention import CheckpointRetention
+    from agent.tools import calendar_client
+    from agent.tools.fake_calendar import FakeCalendar
+    from utils import auth, database, errors
+
+    fake_agents(g, parse_mix(mix), latency, token_rate, words, seed)
+
+    calendar = FakeCalendar(latency=calendar_latency)
+    start = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
+    rng = random.Random(seed)
+    for i in range(events):
+        begin = start + datetime.timedelta(hours=rng.randint(0, 24 * 14))
+        calendar.add_event({
+            "summary": rng.choice(["Standup", "1:1", "Dentist", "Lunch with Sam", "Planning", "Gym"]),
+            "start": {"dateTime": begin.isoformat()},
+            "end": {"dateTime": (begin + datetime.timedelta(minutes=rng.choice([30, 60]))).isoformat()}
+        })
+    calendar_client.set_http_factory(calendar.http_factory)
+
+    async def check_token(token: str) -> dict:
+        if auth_latency:
+            await asyncio.sleep(auth_latency)
+        if not token or not token.startswith("bench-"):
+            raise errors.UserAuthenticationFaliure("Invalid token")
+        return {"sub": token[len("bench-"):]}
+
+    async def login(username: str, password: str) -> str:
+        if auth_latency:
+            await asyncio.sleep(auth_latency)
+        return f"bench-{username}"
+
+    async def get_google_oauth_creds(app: FastAPI, user_id: str):
+        return Credentials("bench")
+
+    auth.check_token, auth.login = check_token, login
+    auth.get_google_oauth_creds = auth.find_google_oauth_creds = get_google_oauth_creds
+
+    if redis_url:
+        from redis.asyncio import Redis
+        database.rds = Redis.from_url(redis_url, decode_responses=True)
+    else:
+        import fakeredis
+        database.rds = fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    checkpointer, create_pool = serde.checkpointer, asyncpg.create_pool
+
+    def offline_checkpointer(url: str, **options):
+        return checkpointer(redis_url, **options) if redis_url else MemorySaver()
+
+    async def offline_pool(url: str, **options):
+        return await create_pool(postgres_url, **options) if postgres_url else MemoryPool()
+
+    def offline_retention(saver, pool=None, **options):
+        # prunes through the saver's Redis search indexes and archives to Postgres
+        return CheckpointRetention(saver, pool=pool, **options) if redis_url and postgres_url else None
+
+    serde.checkpointer, asyncpg.create_pool = offline_checkpointer, offline_pool
+    application.CheckpointRetention = offline_retention
+    application.google_startup = False
+    return application.app
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--tool-mix", default="answer:0.6,lookup:0.3,chain:0.1", help=f"tool-call patterns per turn with weights, of {', '.join(PATTERNS)}")
+    parser.add_argument("--first-token", type=float, default=0.3, help="seconds to a model call's first token")
+    parser.add_argument("--token-rate", type=float, default=50, help="streamed words per second, 0 for unthrottled")
+    parser.add_argument("--words", type=int, default=40, help="words per answer")
+    parser.add_argument("--calendar-latency", type=float, default=0.05, help="seconds per Calendar API request")
+    parser.add_argument("--events", type=int, default=200, help="events in the fake calendar")
+    parser.add_argument("--auth-latency", type=float, default=0.0, help="seconds per token verification")
+    parser.add_argument("--redis-url", help="use this Redis (Stack) instead of fakeredis and in-memory checkpoints")
+    parser.add_argument("--postgres-url", help="use this Postgres instead of the in-memory chat_history")
+    parser.add_argument("--seed", type=int)
+
+def from_arguments(args: argparse.Namespace) -> FastAPI:
+    return build(args.tool_mix, args.first_token, args.token_rate, args.words, args.calendar_latency, args.events, args.auth_latency, args.redis_url, args.postgres_url, args.seed)
+
+if __name__ == "__main__":
+    import uvicorn
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(from_arguments(args), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,112 @@
+"""
+Startup cost of a worker: how long `import app` takes in a fresh interpreter, which modules it
+goes to, and the time from starting a server to its first answer on /metrics (import, lifespan
+and binding the port). Every worker of `uvicorn --workers N` and every restart pays it once.
+
+    python -m bench.startup                          # the offline app, see bench.offline_app
+    python -m bench.startup --repeat 10 --top 30
+    python -m bench.startup --command "uvicorn app:app --port {port}"   # the real app, needs its services
+
+Import times come from `python -X importtime`, the modules listed are the slowest ones imported
+by the app's own modules (cumulative, so a module includes what it imports). The time to ready
+of the offline app leaves out the model provider's package, its models are never loaded, the
+real app loads them in its lifespan.
+"""
+import argparse
+import os
+import shlex
+import statistics
+import subprocess
+import sys
+import time
+import httpx
+
+def import_time(module: str) -> float:
+    """Seconds to import `module` in a fresh interpreter."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    return float(out.strip().splitlines()[-1])
+
+def import_profile(module: str) -> list[tuple[str, int, float, float]]:
+    """(module, depth, self seconds, cumulative seconds) of every import, from -X importtime."""
+    err = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        rows.append((name.strip(), depth, int(own) / 1e6, int(cumulative) / 1e6))
+    return rows
+
+def slowest(rows: list, packages: tuple[str, ...], top: int) -> list[tuple[str, float]]:
+    """The `top` slowest imports made directly by modules of `packages`, cumulative seconds."""
+    # -X importtime lists a module after everything it imports, its parent comes later at depth - 1
+    found, parents = [], {}
+    for name, depth, _, cumulative in reversed(rows):
+        parents[depth] = name
+        parent = parents.get(depth - 1, "")
+        if depth == 0 or parent.split(".")[0] in packages:
+            found.append((name, parent, cumulative))
+    found.sort(key=lambda row: -row[2])
+    return [(f"{name}  <- {parent}" if parent else name, cumulative) for name, parent, cumulative in found[:top]]
+
+def rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith("VmRSS")) / 1024
+    except (OSError, StopIteration):
+        return 0.0 # not Linux
+
+def time_to_ready(command: list[str], port: int, timeout: float) -> tuple[float, float]:
+    """Seconds from starting `command` to a 200 on /metrics, and the server's RSS then in MB."""
+    start = time.perf_counter()
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - start < timeout:
+            if server.poll() is not None:
+                raise SystemExit(f"{shlex.join(command)} exited with {server.returncode}")
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/metrics", timeout=1).status_code == 200:
+                    return time.perf_counter() - start, rss_mb(server.pid)
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.02)
+        raise SystemExit(f"not ready within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+def summary(values: list[float]) -> str:
+    return f"median {statistics.median(values):6.3f}s  min {min(values):6.3f}s  max {max(values):6.3f}s"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app", help="module imported by a worker")
+    parser.add_argument("--repeat", type=int, default=5, help="fresh interpreters (and servers) per measurement")
+    parser.add_argument("--top", type=int, default=15, help="slowest imports listed, 0 for none")
+    parser.add_argument("--packages", default="app,agent,utils", help="comma separated, imports made by these are listed")
+    parser.add_argument("--command", help="server command with {port}, defaults to the offline app")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds a server gets to become ready")
+    parser.add_argument("--no-server", action="store_true", help="only measure the import")
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    imports = [import_time(args.module) for _ in range(args.repeat)]
+    print(f"import {args.module:<18} {summary(imports)}")
+
+    if args.top:
+        rows = import_profile(args.module)
+        print(f"\n{'slowest imports (cumulative)':<70}{'seconds':>8}")
+        for name, cumulative in slowest(rows, tuple(args.packages.split(",")), args.top):
+            print(f"{name:<70}{cumulative:8.3f}")
+
+    if not args.no_server:
+        command = shlex.split(args.command.format(port=args.port)) if args.command else [sys.executable, "-m", "bench.offline_app", "--port", str(args.port)]
+        ready, rss = zip(*(time_to_ready(command, args.port, args.timeout) for _ in range(args.repeat)))
+        print(f"\n{'time to ready':<25} {summary(ready)}")
+        print(f"{'rss when ready':<25} median {statistics.median(rss):6.1f}MB")
+
+if __name__ == "__main__":
+    main()
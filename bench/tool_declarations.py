@@ -0,0 +1,28 @@
+"""
+Approximate tokens the calendar tool declarations add to every model call: the single
+google_calendar union tool against the per-action tools of agent.tools.calendar_tools, and the
+subset each route gets (google.calendar.tools.routes, or --fast for the fast route).
+
+    python -m bench.tool_declarations --fast get_many get find_slots
+"""
+import argparse
+from agent.tools import calendar_tools
+from utils.config import config
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fast", nargs="*", default=None, help="actions of the fast route, overrides the config")
+    args = parser.parse_args()
+
+    routes = config["google"].get("calendar", {}).get("tools", {}).get("routes", {})
+    if args.fast is not None:
+        routes = {**routes, "fast": args.fast}
+    report = calendar_tools.report(routes)
+    base = report["union"]
+    print(f"{'declaration':<28} {'tokens':>7} {'ratio':>6}")
+    print(f"{'google_calendar (union)':<28} {base:>7} {1:>6.2f}")
+    print(f"{'per-action, all':<28} {report['per_action']:>7} {report['per_action'] / base:>6.2f}")
+    for action, tokens in report["actions"].items():
+        print(f"{'  calendar_' + action:<28} {tokens:>7} {tokens / base:>6.2f}")
+    for route, tokens in report["routes"].items():
+        print(f"{'route ' + route:<28} {tokens:>7} {tokens / base:>6.2f}")
@@ -1,12 +1,9 @@
 import asyncio
-from langgraph.checkpoint.redis import AsyncRedisSaver
-from agent import graph as g
-import yaml
-
-with open("config.yml", "r") as f: config = yaml.safe_load(f)
+from agent import graph as g, serde
+from utils.config import config
 
 async def main():
-    checkpointer = AsyncRedisSaver(config["redis"]["url"])
+    checkpointer = serde.checkpointer(config["redis"]["url"], **config["redis"].get("serializer", {}))
     await checkpointer.asetup()
     graph = g.workflow.compile(checkpointer=checkpointer) # compile graph w/ redis memory
 
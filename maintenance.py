@@ -0,0 +1,45 @@
+import argparse
+import asyncio
+from agent import serde
+from agent.retention import CheckpointRetention
+import asyncpg
+from utils.config import config
+
+async def main(args):
+    checkpointer = serde.checkpointer(config["redis"]["url"], **config["redis"].get("serializer", {}))
+    await checkpointer.asetup()
+    retention_config = config["redis"].get("retention", {})
+    pool = None
+    if args.command == "sweep" or retention_config.get("offload"):
+        pool = await asyncpg.create_pool(config["postgres"]["url"], min_size=1, max_size=2)
+    retention = CheckpointRetention(checkpointer, pool=pool, **retention_config)
+
+    if args.command == "report":
+        threads = await retention.report()
+        print(f"{'thread_id':<40} {'checkpoints':>11} {'writes':>8} {'blobs':>8} {'bytes':>12}")
+        for t in threads[:args.top]:
+            print(f"{t['thread_id']:<40} {t['checkpoints']:>11} {t['writes']:>8} {t['blobs']:>8} {t['bytes']:>12}")
+        print(f"{len(threads)} threads, {sum(t['bytes'] for t in threads)} bytes")
+    elif args.command == "prune":
+        thread_ids = args.thread or [t["thread_id"] for t in await retention.report()]
+        deleted = 0
+        for thread_id in thread_ids:
+            deleted += await retention.prune(thread_id)
+        print(f"pruned {len(thread_ids)} threads, deleted {deleted} keys")
+    elif args.command == "sweep":
+        retention.offload = True
+        print(f"archived {await retention.sweep()} idle threads")
+
+    if pool is not None:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checkpoint retention maintenance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    report = sub.add_parser("report", help="per-thread checkpoint counts and memory usage")
+    report.add_argument("--top", type=int, default=50)
+    prune = sub.add_parser("prune", help="apply the retention policy now")
+    prune.add_argument("--thread", action="append", help="thread to prune, repeatable (default: every thread)")
+    sub.add_parser("sweep", help="archive idle threads to Postgres")
+    asyncio.run(main(parser.parse_args()))
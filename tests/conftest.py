@@ -0,0 +1,17 @@
+import os
+import tempfile
+import yaml
+
+# the app reads its settings at import, point it at a minimal config unless one is given
+if "CONFIG_PATH" not in os.environ:
+    directory = tempfile.mkdtemp(prefix="tests-")
+    os.environ["CONFIG_PATH"] = os.path.join(directory, "config.yml")
+    with open(os.environ["CONFIG_PATH"], "w") as f:
+        yaml.safe_dump({
+            "supabase": {"url": "http://localhost:54321", "key": "test", "jwt_secret": "test"},
+            "redis": {"url": "redis://localhost:6379"},
+            "postgres": {"url": "postgres://localhost/test"},
+            "google": {"key": "test", "oauth2_scopes": [], "oauth2_credentials": "credentials.json", "redirect_uri": "http://localhost:8000/callback"},
+            "logging": {"logs_dir": directory, "training": {"file": "training.jsonl"}},
+            "prompts": {"active": "cos", "cos": "cos_agent.txt"}
+        }, f)
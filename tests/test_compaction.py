@@ -0,0 +1,45 @@
+import asyncio
+from typing import Annotated
+from typing_extensions import TypedDict
+from langchain_core.messages import AIMessage, HumanMessage
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.graph import StateGraph, START, END
+from langgraph.graph.message import add_messages
+from agent.compaction import Compactor, ModelSummarizer
+from agent.fake_models import FakeChatModel
+from agent.graph import chat_events
+
+
+class State(TypedDict):
+    messages: Annotated[list, add_messages]
+    user_id: str
+    thread_id: str
+    language: str
+    summary: str
+
+
+def test_deferred_compaction_stays_out_of_the_stream():
+    summarizer = FakeChatModel(responses=["summary of the earlier turns"])
+    compactor = Compactor(ModelSummarizer(summarizer), budget=40, keep=10)
+    model = FakeChatModel(responses=["the answer"])
+    history = [m for i in range(10) for m in (HumanMessage(f"question {i} " * 5), AIMessage(f"answer {i} " * 5))]
+
+    async def node(state: State):
+        answer = await model.ainvoke(state["messages"])
+        compactor.schedule(state["thread_id"], {**state, "messages": history + state["messages"] + [answer]})
+        await asyncio.gather(*compactor._tasks.values()) # summarized while the turn still streams
+        return {"messages": [answer]}
+
+    workflow = StateGraph(State)
+    workflow.add_node("model", node)
+    workflow.add_edge(START, "model")
+    workflow.add_edge("model", END)
+    graph = workflow.compile(checkpointer=InMemorySaver())
+
+    async def turn():
+        return [data["text"] async for event, data in chat_events("one more", "t", graph, "u") if event == "token"]
+
+    text = "".join(asyncio.run(turn()))
+    assert "answer" in text
+    assert "summary" not in text
+    assert compactor._pending.get("t")[0] == "summary of the earlier turns"
@@ -0,0 +1,206 @@
+import asyncio
+import collections
+import logging
+import secrets
+import time
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
+from utils.errors import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+'''
+Admission control for agent runs. A /chat turn is admitted in three steps, cheapest first:
+
+1. the user's token bucket in Redis (`rate` turns per second, bursts of `burst`), shared by all
+   workers, rejects with 429 and a Retry-After when it is empty
+2. a per-thread lock in Redis, so two turns on the same thread never race on its checkpoint,
+   rejects with 409 while the previous turn is still running
+3. a slot under this worker's in-flight cap, waiting in a bounded queue for at most
+   `queue_timeout` seconds, rejects with 429 right away when the queue is full
+
+If Redis is unreachable the first two steps are skipped rather than failing every turn.
+'''
+
+# KEYS[1] bucket, ARGV rate (tokens/s), burst -> {allowed, seconds until the next token}
+TOKEN_BUCKET = """
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed, retry = 0, (1 - tokens) / rate
+if tokens >= 1 then
+    tokens, allowed, retry = tokens - 1, 1, 0
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return {allowed, tostring(retry)}
+"""
+
+# KEYS[1] lock, ARGV[1] owner token -> 1 if released
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end
+return 0
+"""
+
+# KEYS[1] lock, ARGV owner token, ttl ms -> 1 if still held
+RENEW_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('PEXPIRE', KEYS[1], ARGV[2]) end
+return 0
+"""
+
+
+class Ticket:
+    """An admitted turn, release it when the turn ends (releasing twice is harmless)."""
+    def __init__(self, controller: "AdmissionController", thread_id: str, lock_token: str):
+        self.controller = controller
+        self.thread_id = thread_id
+        self.lock_token = lock_token
+        self.released = False
+        self._watchdog = asyncio.create_task(controller._watch(self))
+
+    async def release(self):
+        if self.released:
+            return
+        self.released = True
+        self.controller._slots.release()
+        self.controller.inflight -= 1
+        if self._watchdog is not asyncio.current_task(): # the watchdog releases tickets itself
+            self._watchdog.cancel()
+        if self.lock_token:
+            try:
+                await self.controller._release_lock(self.thread_id, self.lock_token)
+            except RedisError as e: # the lock expires on its own after lock_ttl
+                logger.warning("releasing the lock of thread %s failed: %r", self.thread_id, e)
+
+
+class AdmissionController:
+    """
+    :param redis: client for the token buckets and thread locks
+    :param max_inflight: turns running at once on this worker
+    :param max_queue: turns waiting for a slot before new ones are rejected immediately
+    :param queue_timeout: seconds a turn waits for a slot before it is rejected
+    :param rate: turns per second a user's bucket refills with
+    :param burst: size of a user's bucket
+    :param lock_ttl: seconds a thread lock lives without renewal, it is renewed while the turn runs
+    :param max_turn: seconds after which a ticket nobody released is released anyway, and its lock no longer renewed
+    """
+    def __init__(
+            self,
+            redis: Redis,
+            max_inflight: int = 32,
+            max_queue: int = 64,
+            queue_timeout: float = 2.0,
+            rate: float = 0.5,
+            burst: int = 10,
+            lock_ttl: int = 60,
+            max_turn: float = 600,
+            prefix: str = "admission"):
+        self.redis = redis
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate = rate
+        self.burst = burst
+        self.lock_ttl = lock_ttl
+        self.max_turn = max_turn
+        self.prefix = prefix
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._bucket = redis.register_script(TOKEN_BUCKET)
+        self._release = redis.register_script(RELEASE_LOCK)
+        self._renew = redis.register_script(RENEW_LOCK)
+        # metrics
+        self.inflight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.expired = 0 # tickets released by the watchdog
+        self.rejected = collections.Counter() # reason -> count
+        self.waits = collections.deque(maxlen=1000) # seconds spent queued by admitted turns
+
+    async def admit(self, user_id: str, thread_id: str) -> Ticket:
+        """
+        Admit one turn or raise AdmissionRejected.
+        :return: the ticket to release when the turn ends
+        """
+        try:
+            allowed, retry_after = await self._bucket(keys=[f"{self.prefix}:bucket:{user_id}"], args=[self.rate, self.burst])
+            if not allowed:
+                self.rejected["rate"] += 1
+                raise AdmissionRejected("Too many messages, please slow down.", 429, float(retry_after))
+        except RedisError as e:
+            logger.warning("token bucket unavailable, admitting user %s: %r", user_id, e)
+
+        lock_token = secrets.token_hex(8)
+        try:
+            if not await self.redis.set(f"{self.prefix}:lock:{thread_id}", lock_token, nx=True, px=self.lock_ttl * 1000):
+                self.rejected["thread_busy"] += 1
+                raise AdmissionRejected("Still answering the previous message in this thread.", 409, 1)
+        except RedisError as e:
+            logger.warning("thread lock unavailable, admitting thread %s unlocked: %r", thread_id, e)
+            lock_token = None
+
+        try:
+            await self._acquire_slot()
+        except BaseException: # rejected, or cancelled while queued (the client went away)
+            if lock_token:
+                try:
+                    await self._release_lock(thread_id, lock_token)
+                except RedisError:
+                    pass # expires after lock_ttl
+            raise
+        self.admitted += 1
+        self.inflight += 1
+        return Ticket(self, thread_id, lock_token)
+
+    async def _acquire_slot(self):
+        if self._slots.locked() and self.waiting >= self.max_queue:
+            self.rejected["queue_full"] += 1
+            raise AdmissionRejected("The assistant is busy, please try again shortly.", 429, 1)
+        self.waiting += 1
+        start = time.perf_counter()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected["queue_timeout"] += 1
+            raise AdmissionRejected("The assistant is busy, please try again shortly.", 429, self.queue_timeout)
+        finally:
+            self.waiting -= 1
+        self.waits.append(time.perf_counter() - start)
+
+    async def _watch(self, ticket: Ticket):
+        """
+        Renew the ticket's thread lock while the turn runs, until the lock is lost. A ticket still
+        held after `max_turn` seconds was leaked (its response never ran), release it.
+        """
+        deadline = time.monotonic() + self.max_turn
+        renewing = ticket.lock_token is not None
+        while (remaining := deadline - time.monotonic()) > 0:
+            await asyncio.sleep(min(self.lock_ttl / 3, remaining))
+            if not renewing or time.monotonic() >= deadline:
+                continue
+            try:
+                renewing = bool(await self._renew(keys=[f"{self.prefix}:lock:{ticket.thread_id}"], args=[ticket.lock_token, self.lock_ttl * 1000]))
+                if not renewing:
+                    logger.warning("thread %s lost its lock, no longer renewing it", ticket.thread_id)
+            except RedisError as e:
+                logger.warning("renewing the lock of thread %s failed: %r", ticket.thread_id, e)
+        self.expired += 1
+        logger.warning("turn on thread %s held its ticket for %ss, releasing it", ticket.thread_id, self.max_turn)
+        await ticket.release()
+
+    async def _release_lock(self, thread_id: str, lock_token: str):
+        await self._release(keys=[f"{self.prefix}:lock:{thread_id}"], args=[lock_token])
+
+    def stats(self) -> dict:
+        waits = sorted(self.waits)
+        return {
+            "inflight": self.inflight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "expired": self.expired,
+            "rejected": dict(self.rejected),
+            "p95_queue_wait": waits[int(len(waits) * 0.95)] if waits else 0.0
+        }
@@ -1,35 +1,143 @@
-from supabase import create_client
-import yaml
-from gotrue.errors import AuthApiError
+import asyncio
+import functools
+import hashlib
+import time
+import datetime
+import logging
+import jwt
 from utils.errors import UserAuthenticationFaliure, GoogleOauthFaliure
 from utils.schemas import Token
-from utils.database import write_oath_token, get_oath_token, update_oath_token
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
+from utils.database import write_oath_token, get_oath_token, update_oath_token, Redis
+from utils.cache import TTLCache
+from utils import metrics
 from google.auth.transport.requests import Request
-import os.path
-import pickle
+from google.auth.exceptions import RefreshError
+from google.oauth2.credentials import Credentials
 from fastapi import FastAPI
 import json
+from utils.config import config
 
 
-with open("config.yml", "r") as f: config = yaml.safe_load(f)
+logger = logging.getLogger(__name__)
 
-supabase = create_client(config["supabase"]["url"], config["supabase"]["key"])
+@functools.cache
+def supabase_client():
+    """The Supabase client, created on first use: only logins and remote token checks need it."""
+    from supabase import create_client # slow to import, most workers only verify tokens locally
+    return create_client(config["supabase"]["url"], config["supabase"]["key"])
 
-def check_token(token): # supabase
-    try:
-        response = supabase.auth.get_user(token)
-        return response
-    except AuthApiError as e:
-        raise UserAuthenticationFaliure("Invalid token")
+class TokenVerifier:
+    """
+    Verifies Supabase access tokens locally (signature, expiry, audience) and keeps a
+    bounded TTL cache of the verified claims so repeat requests skip verification entirely.
+    HS256 tokens are checked against the project's JWT secret, asymmetric tokens against the
+    project's JWKS. Only when neither is possible does it fall back to asking Supabase,
+    and that call runs in a worker thread so the event loop is never blocked.
+    """
+    def __init__(self, supabase_url: str, jwt_secret: str = None, audience: str = "authenticated", maxsize: int = 10000, ttl: float = 300, leeway: float = 5):
+        self.jwt_secret = jwt_secret
+        self.audience = audience
+        self.leeway = leeway
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.jwks_client = jwt.PyJWKClient(f"{supabase_url.rstrip('/')}/auth/v1/.well-known/jwks.json", cache_keys=True)
+        # kid -> (key, algorithm), or None for a kid the JWKS doesn't have: forged kids cost one fetch a minute
+        self._keys = TTLCache(maxsize=64, ttl=3600)
+        self.unknown_kid_ttl = 60
+
+    async def verify(self, token: str) -> dict:
+        """
+        Return the claims of a valid token.
+        :param token: the bearer token sent by the client
+        :return: dict of JWT claims, `sub` is the Supabase user ID
+        """
+        cache_key = hashlib.sha256(token.encode()).digest() # never keep raw tokens around
+        claims = self.cache.get(cache_key)
+        if claims is not None:
+            return claims
+
+        try:
+            header = jwt.get_unverified_header(token)
+        except jwt.PyJWTError:
+            raise UserAuthenticationFaliure("Invalid token")
+
+        signing = await self._signing_key(header)
+        if signing is None:
+            claims = await self._remote_verify(token)
+        else:
+            key, algorithm = signing
+            try:
+                claims = jwt.decode(
+                    token,
+                    key,
+                    algorithms=[algorithm], # pinned by the key, never taken from the token's header
+                    audience=self.audience,
+                    leeway=self.leeway,
+                    options={"require": ["exp", "sub"]}
+                )
+            except jwt.ExpiredSignatureError:
+                raise UserAuthenticationFaliure("Token expired")
+            except (jwt.PyJWTError, TypeError): # InvalidKeyError and friends included
+                raise UserAuthenticationFaliure("Invalid token")
+
+        # never cache a token past its own expiry
+        self.cache.set(cache_key, claims, ttl=min(self.cache.ttl, claims["exp"] - time.time()))
+        return claims
+
+    async def _signing_key(self, header: dict):
+        """
+        (key, algorithm) to check the token with, None to ask Supabase instead.
+        :raises UserAuthenticationFaliure: the token can't be valid (alg none, unknown kid)
+        """
+        alg = header.get("alg")
+        if alg == "HS256":
+            return (self.jwt_secret, "HS256") if self.jwt_secret else None # no secret configured -> remote check
+        kid = header.get("kid")
+        if not alg or alg == "none" or alg.startswith("HS") or kid is None:
+            raise UserAuthenticationFaliure("Invalid token")
+        if kid not in self._keys:
+            try: # the JWKS fetch is a blocking HTTP call, keep it off the loop
+                jwk = await asyncio.to_thread(self.jwks_client.get_signing_key, kid)
+                self._keys.set(kid, (jwk.key, jwk.algorithm_name))
+            except jwt.PyJWKClientConnectionError:
+                return None # JWKS unreachable, Supabase decides
+            except jwt.PyJWTError:
+                self._keys.set(kid, None, ttl=self.unknown_kid_ttl)
+        signing = self._keys.get(kid)
+        if signing is None:
+            raise UserAuthenticationFaliure("Invalid token")
+        return signing
+
+    async def _remote_verify(self, token: str) -> dict:
+        from gotrue.errors import AuthApiError
+        try:
+            response = await asyncio.to_thread(lambda: supabase_client().auth.get_user(token)) # the first call imports supabase, in the thread too
+        except AuthApiError:
+            raise UserAuthenticationFaliure("Invalid token")
+        if not response or not response.user:
+            raise UserAuthenticationFaliure("Invalid token")
+        # supabase vouched for the token, the unverified claims can be trusted
+        return jwt.decode(token, options={"verify_signature": False, "verify_aud": False})
+
+verifier = TokenVerifier(
+    config["supabase"]["url"],
+    jwt_secret=config["supabase"].get("jwt_secret"),
+    audience=config["supabase"].get("jwt_audience", "authenticated"),
+    maxsize=config["supabase"].get("token_cache_size", 10000),
+    ttl=config["supabase"].get("token_cache_ttl", 300)
+    )
+
+@metrics.timed("auth")
+async def check_token(token: str) -> dict: # supabase
+    """Verify a Supabase access token and return its claims. `claims["sub"]` is the user ID."""
+    return await verifier.verify(token)
     
-def login(username: str, password: str) -> str: # supabase
+async def login(username: str, password: str) -> str: # supabase
+    from gotrue.errors import AuthApiError
     try:
-        response = supabase.auth.sign_in_with_password({"email": username,"password": password})
+        response = await asyncio.to_thread(lambda: supabase_client().auth.sign_in_with_password({"email": username,"password": password}))
         return response.session.access_token
     except AuthApiError as e:
-        raise e
+        raise UserAuthenticationFaliure(str(e))
 
 def generate_auth_url(app: FastAPI):
     return app.state.google_oauth_flow.authorization_url(
@@ -38,20 +146,135 @@ def generate_auth_url(app: FastAPI):
         access_type='offline',
         prompt='consent'
         )
-async def get_google_oauth_creds(app: FastAPI, user_id: str):
-    creds = await get_oath_token(app, user_id)
+class GoogleCredentialCache:
+    """
+    Two tier cache for users' Google credentials: an in-process LRU in front of Redis,
+    in front of Postgres. Entries live until the access token expires, so the hot path
+    is a dict lookup. Redis only gets the access token and its expiry, the refresh token and
+    client secret stay in Postgres and are read from there when a refresh needs them. Refreshes are single-flight per user and start `refresh_ahead`
+    seconds before expiry in the background, so callers rarely wait on Google.
+    """
+    def __init__(self, maxsize: int = 4096, refresh_ahead: float = 600, key_prefix: str = "gcal_creds:"):
+        self.local = TTLCache(maxsize=maxsize, ttl=3600)
+        self.remote = Redis()
+        self.refresh_ahead = refresh_ahead
+        self.key_prefix = key_prefix
+        self._loading: dict[str, asyncio.Task] = {} # user_id -> in-flight cache fill
+        self._refreshing: dict[str, asyncio.Task] = {} # user_id -> in-flight refresh
+
+    @staticmethod
+    def expires_in(creds: Credentials) -> float:
+        if creds.expiry is None:
+            return float("inf")
+        return (creds.expiry - datetime.datetime.utcnow()).total_seconds() # google-auth uses naive UTC
+
+    async def get(self, app: FastAPI, user_id: str) -> Credentials:
+        """
+        Return the cached credentials for a user, loading them from Redis or Postgres on a miss.
+        :return: Credentials (possibly expired) or None if the user has none stored
+        """
+        creds: Credentials = self.local.get(user_id)
+        if creds is None:
+            creds = await self._single_flight(self._loading, user_id, lambda: self._load(app, user_id))
+            if creds is None:
+                return None
+
+        if creds.valid and self.expires_in(creds) < self.refresh_ahead:
+            self.refresh_soon(app, user_id, creds) # refresh ahead of expiry, don't wait on it
+        return creds
+
+    async def _load(self, app: FastAPI, user_id: str) -> Credentials:
+        info = await self.remote.get_credentials(self.key_prefix + user_id)
+        if info is not None and info.get("token"):
+            expiry = datetime.datetime.fromisoformat(info["expiry"]) if info.get("expiry") else None
+            if expiry is not None and expiry.tzinfo is not None:
+                expiry = expiry.astimezone(datetime.timezone.utc).replace(tzinfo=None) # google-auth uses naive UTC
+            creds = Credentials(token=info["token"], expiry=expiry, scopes=config["google"]["oauth2_scopes"])
+            await self.store(user_id, creds, remote=False)
+            return creds
+        creds = await get_oath_token(app, user_id)
+        if creds is not None:
+            await self.store(user_id, creds)
+        return creds
+
+    @staticmethod
+    async def _single_flight(inflight: dict, user_id: str, factory):
+        task = inflight.get(user_id)
+        if task is None:
+            task = asyncio.create_task(factory())
+            inflight[user_id] = task
+            task.add_done_callback(lambda t: inflight.pop(user_id, None))
+        return await asyncio.shield(task) # a cancelled caller must not cancel the shared work
+
+    async def store(self, user_id: str, creds: Credentials, remote: bool = True):
+        ttl = self.expires_in(creds)
+        if not creds.valid or ttl <= 0:
+            return # only cache usable tokens
+        ttl = min(ttl, self.local.ttl)
+        self.local.set(user_id, creds, ttl=ttl)
+        if remote:
+            # the access token only, it expires with the key anyway
+            await self.remote.set_credentials(self.key_prefix + user_id, {"token": creds.token, "expiry": creds.expiry.isoformat() if creds.expiry else None}, ex=int(ttl))
+
+    async def invalidate(self, user_id: str):
+        self.local.pop(user_id)
+        await self.remote.delete_credentials(self.key_prefix + user_id)
+
+    async def refresh(self, app: FastAPI, user_id: str, creds: Credentials) -> Credentials:
+        """Refresh a user's token, concurrent callers for the same user share one refresh."""
+        return await self._single_flight(self._refreshing, user_id, lambda: self._refresh(app, user_id, creds))
+
+    def refresh_soon(self, app: FastAPI, user_id: str, creds: Credentials):
+        if user_id in self._refreshing:
+            return
+        task = asyncio.create_task(self.refresh(app, user_id, creds))
+        task.add_done_callback(self._log_background_failure)
+
+    @staticmethod
+    def _log_background_failure(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("background Google token refresh failed: %r", task.exception())
+
+    async def _refresh(self, app: FastAPI, user_id: str, creds: Credentials) -> Credentials:
+        if not creds.refresh_token: # came from Redis, the refresh token is in Postgres
+            creds = await get_oath_token(app, user_id)
+            if creds is None or not creds.refresh_token:
+                raise RefreshError("no refresh token stored")
+        # refresh a copy, other requests may be using `creds` while the refresh is in flight
+        fresh = Credentials.from_authorized_user_info(json.loads(creds.to_json()), scopes=creds.scopes)
+        await asyncio.to_thread(fresh.refresh, Request()) # blocking HTTP call to Google
+        await self.store(user_id, fresh)
+        await update_oath_token(app, user_id, fresh.to_json())
+        return fresh
+
+google_creds = GoogleCredentialCache(
+    maxsize=config["google"].get("creds_cache_size", 4096),
+    refresh_ahead=config["google"].get("creds_refresh_ahead", 600)
+    )
+
+async def find_google_oauth_creds(app: FastAPI, user_id: str) -> Credentials:
+    """
+    The user's valid credentials, refreshed if they expired, or None. Unlike get_google_oauth_creds
+    it never starts re-authorization, so background work can't replace a sign-in link the user was given.
+    """
+    creds = await google_creds.get(app, user_id)
     if creds and creds.valid:
         return creds
+    if creds and creds.expired:
+        try:
+            return await google_creds.refresh(app, user_id, creds)
+        except RefreshError: # refresh token revoked or expired, the user has to sign in again
+            await google_creds.invalidate(user_id)
+    return None
+
+async def get_google_oauth_creds(app: FastAPI, user_id: str):
+    creds = await find_google_oauth_creds(app, user_id)
+    if creds is not None:
+        return creds
     # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-            await update_oath_token(app, user_id, creds.to_json())
-            return creds
-        else:
-            auth_url, callbacktoken = generate_auth_url(app)
-            if not await get_oath_token(app, user_id):
-                await write_oath_token(app, user_id, json.dumps({"token":f"{callbacktoken}"}))
-            else:
-                await update_oath_token(app, user_id, json.dumps({"token":f"{callbacktoken}"}))
-            raise GoogleOauthFaliure(f"The user's Google Oauth credentials expired. Please instruct the user to sign in using the following link and retry the request: {auth_url}")
\ No newline at end of file
+    auth_url, callbacktoken = generate_auth_url(app)
+    if not await get_oath_token(app, user_id):
+        await write_oath_token(app, user_id, json.dumps({"token":f"{callbacktoken}"}))
+    else:
+        await update_oath_token(app, user_id, json.dumps({"token":f"{callbacktoken}"}))
+    raise GoogleOauthFaliure(f"The user's Google Oauth credentials expired. Please instruct the user to sign in using the following link and retry the request: {auth_url}")
@@ -0,0 +1,62 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Bounded in-process LRU cache where every entry carries its own expiry.
+    Not thread safe, it is meant to be used from the event loop only.
+    :param maxsize: maximum number of entries kept before the least recently used is evicted
+    :param ttl: default time to live in seconds for entries set without an explicit ttl
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict() # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key) # mark as most recently used
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0: # already expired, nothing to keep
+            self._data.pop(key, None)
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False) # evict least recently used
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def ttl_remaining(self, key: Hashable) -> float:
+        item = self._data.get(key)
+        if item is None:
+            return 0
+        return max(0, item[0] - time.monotonic())
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] > time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
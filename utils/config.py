@@ -0,0 +1,108 @@
+import functools
+import os
+import yaml
+from pydantic import ConfigDict, TypeAdapter, ValidationError
+from typing_extensions import NotRequired, TypedDict
+
+'''
+The app's settings. config.yml (or the file in $CONFIG_PATH) is read and validated once per
+process, every module shares the same dict:
+
+    from utils.config import config
+
+The sections are typed below. Only what the app can't start without is required, options are
+read with `.get(key, default)` where they are used, and keys not listed here are kept.
+'''
+
+ALLOW = ConfigDict(extra="allow")
+
+class SupabaseConfig(TypedDict):
+    __pydantic_config__ = ALLOW
+    url: str
+    key: str
+    jwt_secret: NotRequired[str]
+    jwt_audience: NotRequired[str]
+    token_cache_size: NotRequired[int]
+    token_cache_ttl: NotRequired[float]
+
+class RedisConfig(TypedDict):
+    __pydantic_config__ = ALLOW
+    url: str
+    serializer: NotRequired[dict] # agent.serde.checkpointer options
+    retention: NotRequired[dict] # agent.retention.CheckpointRetention options
+    history_cache_size: NotRequired[int]
+    history_cache_ttl: NotRequired[float]
+
+class PostgresConfig(TypedDict):
+    __pydantic_config__ = ALLOW
+    url: str
+    history_page_size: NotRequired[int]
+    history_max_page_size: NotRequired[int]
+    chat_log: NotRequired[dict] # utils.database.ChatLogWriter options
+
+class CalendarConfig(TypedDict, total=False):
+    __pydantic_config__ = ALLOW
+    tools: dict # per_action, routes
+    prefetch: dict
+    mirror: dict
+    results: dict
+    max_operations: int
+    batch_concurrency: int
+    max_workers: int
+    http_timeout: float
+    http_per_user: bool
+    num_retries: int
+    pool_size: int
+    pool_ttl: float
+
+class GoogleConfig(TypedDict):
+    __pydantic_config__ = ALLOW
+    key: str
+    oauth2_scopes: list[str]
+    oauth2_credentials: str # client secrets file, read by the lifespan
+    redirect_uri: str
+    creds_cache_size: NotRequired[int]
+    creds_refresh_ahead: NotRequired[float]
+    calendar: NotRequired[CalendarConfig]
+    context_cache: NotRequired[dict]
+
+class LoggingConfig(TypedDict):
+    __pydantic_config__ = ALLOW
+    logs_dir: str
+    training: dict # file, and utils.loggers.JsonlSink options
+
+class PromptsConfig(TypedDict):
+    __pydantic_config__ = ALLOW
+    active: str # name of the entry below holding the system prompt's file in prompts/
+
+class Config(TypedDict):
+    __pydantic_config__ = ALLOW
+    supabase: SupabaseConfig
+    redis: RedisConfig
+    postgres: PostgresConfig
+    google: GoogleConfig
+    logging: LoggingConfig
+    prompts: PromptsConfig
+    streaming: NotRequired[dict]
+    admission: NotRequired[dict]
+    metrics: NotRequired[dict]
+    resilience: NotRequired[dict]
+    router: NotRequired[dict]
+    compaction: NotRequired[dict]
+    memory: NotRequired[dict]
+
+@functools.cache
+def load(path: str = None) -> Config:
+    """
+    Read and validate the config file, once per path.
+    :param path: defaults to $CONFIG_PATH, then config.yml in the working directory
+    """
+    path = path or os.environ.get("CONFIG_PATH", "config.yml")
+    with open(path, "r") as f:
+        raw = yaml.safe_load(f)
+    try:
+        return TypeAdapter(Config).validate_python(raw)
+    except ValidationError as e:
+        raise ValueError(f"invalid {path}: {e}") from e
+
+config = load()
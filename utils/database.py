@@ -1,52 +1,171 @@
 from fastapi import FastAPI
-import yaml, os, json
+import os, json
+import asyncio
+import datetime
+import logging
+import time
 from redis.asyncio import Redis
+from redis.exceptions import WatchError
+from utils.errors import InvalidParameter
+from utils import metrics
 from google.oauth2.credentials import Credentials
 import pprint
 import requests as rq
+from utils.config import config
 
-with open("config.yml", "r") as f: config = yaml.safe_load(f)
+logger = logging.getLogger(__name__)
+
+class ChatLogWriter:
+    """
+    Write-behind buffer for `chat_history` rows.
+    Rows are stamped in-process when queued and written in batches with COPY once
+    `batch_size` rows are waiting or `flush_interval` seconds have passed, whichever is first.
+    The queue is bounded, when it is full `put` waits, pushing back on the callers.
+    :param pool: asyncpg pool
+    :param max_queue: maximum number of rows buffered in memory
+    :param batch_size: rows per COPY
+    :param flush_interval: maximum seconds a row waits before it is flushed
+    """
+    COLUMNS = ("thread_id", "role", "content", "created_at")
+
+    def __init__(self, pool, max_queue: int = 10000, batch_size: int = 500, flush_interval: float = 1.0, max_retries: int = 3):
+        self.pool = pool
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task = None
+        # stats
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.rows_dropped = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything still queued and stop the writer. Call before closing the pool."""
+        self._stopping = True
+        self._wake.set()
+        if self._task is not None:
+            await self._task
+
+    async def put(self, thread_id: str, user_msg: str, ai_msg: str, input_time: datetime.datetime):
+        await self.queue.put((thread_id, "user", user_msg, input_time))
+        await self.queue.put((thread_id, "ai", ai_msg, datetime.datetime.now(datetime.timezone.utc)))
+        if self.queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "flushes": self.flushes,
+            "rows_flushed": self.rows_flushed,
+            "rows_dropped": self.rows_dropped,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            while not self.queue.empty(): # drains fully on shutdown, one batch per wake otherwise
+                batch = [self.queue.get_nowait() for _ in range(min(self.batch_size, self.queue.qsize()))]
+                await self._flush(batch)
+                if not self._stopping and self.queue.qsize() < self.batch_size:
+                    break
+            if self._stopping and self.queue.empty():
+                return
+
+    async def _flush(self, batch: list):
+        for attempt in range(1, self.max_retries + 1):
+            start = time.perf_counter()
+            try:
+                with metrics.span("log_chat", "copy"):
+                    async with self.pool.acquire() as conn:
+                        await conn.copy_records_to_table("chat_history", records=batch, columns=self.COLUMNS)
+            except Exception as e:
+                logger.warning("chat_history flush of %d rows failed (attempt %d/%d): %r", len(batch), attempt, self.max_retries, e)
+                await asyncio.sleep(0.5 * attempt)
+                continue
+            self.last_flush_latency = time.perf_counter() - start
+            self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+            self.flushes += 1
+            self.rows_flushed += len(batch)
+            try:
+                await history_cache.append(batch)
+            except Exception as e: # the cache is best effort, Postgres has the rows
+                logger.warning("failed to update history cache: %r", e)
+            return
+        self.rows_dropped += len(batch)
+        logger.error("dropped %d chat_history rows after %d failed flushes", len(batch), self.max_retries)
 
 async def log_chat(
         app: FastAPI, 
         thread_id: str, 
         user_msg: str, 
         ai_msg: str, 
-        input_time: str,):
-    
-    CHAT_SQL = """
-INSERT INTO chat_history(thread_id, role, content, created_at)
-VALUES ($1, 'user', $2, $3),
-        ($1, 'ai',   $4, $5)
+        input_time: datetime.datetime,):
+    """Queue a user/ai message pair on the app's ChatLogWriter. The ai message is stamped now."""
+    await app.state.chat_log.put(thread_id, user_msg, ai_msg, input_time)
+
+HISTORY_SQL = """
+SELECT role AS type, content, created_at AS timestamp
+FROM chat_history
+WHERE thread_id = $1 AND ($2::timestamptz IS NULL OR created_at < $2)
+ORDER BY created_at DESC
+LIMIT $3
 """
+
+def _parse_cursor(cursor: str) -> datetime.datetime:
+    if cursor is None:
+        return None
+    try:
+        before = datetime.datetime.fromisoformat(cursor)
+    except ValueError:
+        raise InvalidParameter("Invalid cursor")
+    # timestamps are stored in UTC, a cursor without an offset is read as UTC too
+    return before if before.tzinfo else before.replace(tzinfo=datetime.timezone.utc)
+
+def _timestamp(value) -> datetime.datetime:
+    return value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(value)
+
+async def get_chat(app: FastAPI, thread_id: str, num: int = 0, cursor: str = None) -> tuple[list, str]:
+    """
+    Return one page of a thread's history, oldest first, using keyset pagination on (thread_id, created_at).
+    The first page is the most recent `num` messages, pass the returned cursor to get the page before it.
+    Pages inside the recent-message cache are answered from Redis without touching Postgres.
+    :param num: page size, 0 uses `postgres.history_page_size`
+    :param cursor: `next_cursor` from the previous page, None for the most recent page
+    :return: (messages, next_cursor), next_cursor is None on the oldest page
+    """
+    num = min(num or config["postgres"].get("history_page_size", 50), config["postgres"].get("history_max_page_size", 500))
+    before = _parse_cursor(cursor)
+
+    page = await history_cache.page(app, thread_id, num, before)
+    if page is not None:
+        return page
+
     async with app.state.db_pool.acquire() as conn:
-        await conn.execute(
-            CHAT_SQL,
-            thread_id, # thread_id
-            user_msg, # content (user)
-            input_time, # created_at (user)
-            ai_msg, # content (ai)
-            await app.state.db_pool.fetchval("SELECT NOW()") # created_at (ai)
-        )
+        rows = await conn.fetch(HISTORY_SQL, thread_id, before, num + 1) # one extra row tells us if there is an older page
+    has_more = len(rows) > num
+    rows = rows[:num][::-1]
+    messages = [{"type": row["type"], "content": row["content"], "timestamp": row["timestamp"]} for row in rows]
+    return messages, messages[0]["timestamp"].isoformat() if has_more else None
 
-async def get_chat(app: FastAPI, thread_id: str, num: int = 0):
+async def stream_chat(app: FastAPI, thread_id: str):
+    """Yield a thread's full history as NDJSON lines, oldest first, without loading it into memory."""
     async with app.state.db_pool.acquire() as conn:
-        if num > 0:
-            # Fetch the most recent `num`, then reverse for oldest-first
-            rows = await conn.fetch(
-                """
-                SELECT role AS type, content, created_at AS timestamp
-                FROM chat_history
-                WHERE thread_id = $1
-                ORDER BY created_at DESC
-                LIMIT $2
-                """,
-                thread_id, num,
-            )
-            rows = rows[::-1]
-        else:
-            # Fetch all messages in chronological order
-            rows = await conn.fetch(
+        async with conn.transaction(): # server side cursors only live inside a transaction
+            async for row in conn.cursor(
                 """
                 SELECT role AS type, content, created_at AS timestamp
                 FROM chat_history
@@ -54,8 +173,9 @@ async def get_chat(app: FastAPI, thread_id: str, num: int = 0):
                 ORDER BY created_at ASC
                 """,
                 thread_id,
-            )
-    return [{"type": row["type"], "content": row["content"], "timestamp": row["timestamp"]} for row in rows]
+                prefetch=500
+            ):
+                yield json.dumps({"type": row["type"], "content": row["content"], "timestamp": row["timestamp"].isoformat()}) + "\n"
 
 async def write_oath_token(app: FastAPI, user_id: str, token: str):
     SQL_EXP = """
@@ -115,6 +235,74 @@ WHERE "user" = $1
             scopes=config["google"]["oauth2_scopes"]
         )
     
+'''Calendar mirror'''
+
+CALENDAR_EVENT_UPSERT = """
+INSERT INTO calendar_events(user_id, event_id, start_time, end_time, event)
+VALUES ($1, $2, $3, $4, $5::jsonb)
+ON CONFLICT (user_id, event_id) DO UPDATE
+SET start_time = EXCLUDED.start_time, end_time = EXCLUDED.end_time, event = EXCLUDED.event
+"""
+
+CALENDAR_EVENT_QUERY = """
+SELECT event
+FROM calendar_events
+WHERE user_id = $1
+    AND ($2::timestamptz IS NULL OR end_time > $2)
+    AND ($3::timestamptz IS NULL OR start_time < $3)
+    AND ($4::text IS NULL OR search @@ plainto_tsquery('simple', $4))
+ORDER BY start_time
+LIMIT $5
+"""
+
+def _event_rows(user_id: str, events: list[tuple]) -> list[tuple]:
+    return [(user_id, event["id"], start, end, json.dumps(event)) for event, start, end in events]
+
+async def apply_calendar_changes(app: FastAPI, user_id: str, events: list[tuple], deleted: list[str] = (), replace: bool = False):
+    """
+    Write synced events to a user's mirror in one transaction.
+    :param events: (event, start, end) tuples to upsert
+    :param deleted: IDs of cancelled events to remove
+    :param replace: drop every other event of the user first (full sync)
+    """
+    async with app.state.db_pool.acquire() as conn:
+        async with conn.transaction():
+            if replace:
+                await conn.execute("DELETE FROM calendar_events WHERE user_id = $1", user_id)
+            if deleted:
+                await conn.execute("DELETE FROM calendar_events WHERE user_id = $1 AND event_id = ANY($2::text[])", user_id, list(deleted))
+            if events:
+                await conn.executemany(CALENDAR_EVENT_UPSERT, _event_rows(user_id, events))
+
+async def query_calendar_events(app: FastAPI, user_id: str, time_min: datetime.datetime = None, time_max: datetime.datetime = None, q: str = None, limit: int = 250) -> list[dict]:
+    async with app.state.db_pool.acquire() as conn:
+        rows = await conn.fetch(CALENDAR_EVENT_QUERY, user_id, time_min, time_max, q or None, limit)
+    return [json.loads(row["event"]) for row in rows]
+
+async def get_calendar_event(app: FastAPI, user_id: str, event_id: str) -> dict:
+    async with app.state.db_pool.acquire() as conn:
+        event = await conn.fetchval("SELECT event FROM calendar_events WHERE user_id = $1 AND event_id = $2", user_id, event_id)
+    return json.loads(event) if event else None
+
+async def get_calendar_sync(app: FastAPI, user_id: str):
+    async with app.state.db_pool.acquire() as conn:
+        return await conn.fetchrow("SELECT * FROM calendar_sync WHERE user_id = $1", user_id)
+
+async def find_calendar_channel(app: FastAPI, channel_id: str):
+    async with app.state.db_pool.acquire() as conn:
+        return await conn.fetchrow("SELECT * FROM calendar_sync WHERE channel_id = $1", channel_id)
+
+async def set_calendar_sync(app: FastAPI, user_id: str, **fields):
+    """Upsert a user's sync state, `fields` are calendar_sync columns (sync_token, channel_id, ...)."""
+    columns = ["user_id", *fields]
+    values = ", ".join(f"${i + 1}" for i in range(len(columns)))
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in fields)
+    async with app.state.db_pool.acquire() as conn:
+        await conn.execute(
+            f"INSERT INTO calendar_sync({', '.join(columns)}) VALUES ({values}) ON CONFLICT (user_id) DO UPDATE SET {updates}",
+            user_id, *fields.values()
+        )
+
 '''Redis'''
 
 rds = Redis.from_url(config["redis"]["url"], decode_responses=True)
@@ -186,4 +374,104 @@ class Redis:
             creds = await self.get_credentials(key)
             if creds is not None:
                 result[key] = creds
-        return result
\ No newline at end of file
+        return result
+
+# KEYS[1] list, KEYS[2] primed marker, KEYS[3] tail, ARGV size, ttl, then (created_at in us, item) pairs
+# oldest first -> items pushed. Rows at or before the tail are already in the list: a prime read them
+# from Postgres after their flush committed but before the flush got here.
+APPEND_RECENT = """
+local size, ttl = tonumber(ARGV[1]), tonumber(ARGV[2])
+local tail = redis.call('GET', KEYS[3])
+local last = tonumber(tail) or -1
+local pushed = 0
+for i = 3, #ARGV, 2 do
+    if tonumber(ARGV[i]) > last then
+        redis.call('RPUSH', KEYS[1], ARGV[i + 1])
+        tail, last, pushed = ARGV[i], tonumber(ARGV[i]), pushed + 1
+    end
+end
+if pushed > 0 then
+    redis.call('LTRIM', KEYS[1], -size, -1)
+    redis.call('SET', KEYS[3], tail)
+end
+redis.call('EXPIRE', KEYS[1], ttl)
+redis.call('EXPIRE', KEYS[2], ttl)
+redis.call('EXPIRE', KEYS[3], ttl)
+return pushed
+"""
+
+def _micros(timestamp: datetime.datetime) -> int:
+    return round(timestamp.timestamp() * 1_000_000)
+
+class HistoryCache:
+    """
+    Redis list of the most recent `size` messages of each thread, kept current by ChatLogWriter.
+    A thread's list is only trusted once it has been primed from Postgres (marked by a second key),
+    after that repeated history polls are served entirely from Redis. A third key holds the time of
+    the newest message in the list, so a flush racing a prime never adds its rows twice.
+    """
+    def __init__(self, size: int = 100, ttl: int = 86400, prefix: str = "chat_recent:"):
+        self.size = size
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _keys(self, thread_id: str) -> tuple:
+        return f"{self.prefix}{thread_id}", f"{self.prefix}{thread_id}:primed", f"{self.prefix}{thread_id}:tail"
+
+    async def append(self, rows: list):
+        """Push flushed (thread_id, role, content, created_at) rows onto their threads' lists."""
+        by_thread = {}
+        for thread_id, role, content, created_at in rows:
+            by_thread.setdefault(thread_id, []).extend((_micros(created_at), json.dumps({"type": role, "content": content, "timestamp": created_at.isoformat()})))
+        async with rds.pipeline(transaction=False) as pipe:
+            for thread_id, items in by_thread.items():
+                pipe.eval(APPEND_RECENT, 3, *self._keys(thread_id), self.size, self.ttl, *items)
+            await pipe.execute()
+
+    async def recent(self, app: FastAPI, thread_id: str) -> list:
+        """The cached recent messages of a thread, oldest first, priming the cache from Postgres on a miss."""
+        key, primed, tail = self._keys(thread_id)
+        async with rds.pipeline(transaction=False) as pipe:
+            pipe.exists(primed)
+            pipe.lrange(key, 0, -1)
+            is_primed, items = await pipe.execute()
+        if is_primed:
+            return [json.loads(item) for item in items]
+
+        async with rds.pipeline(transaction=True) as pipe:
+            await pipe.watch(key) # a concurrent flush touching the list aborts the prime
+            async with app.state.db_pool.acquire() as conn:
+                rows = await conn.fetch(HISTORY_SQL, thread_id, None, self.size)
+            messages = [{"type": row["type"], "content": row["content"], "timestamp": row["timestamp"].isoformat()} for row in rows[::-1]]
+            pipe.multi()
+            pipe.delete(key, tail)
+            if messages:
+                pipe.rpush(key, *[json.dumps(m) for m in messages])
+                pipe.set(tail, _micros(rows[0]["timestamp"]), ex=self.ttl)
+            pipe.set(primed, 1, ex=self.ttl)
+            pipe.expire(key, self.ttl)
+            try:
+                await pipe.execute()
+            except WatchError:
+                pass # still correct for this request, the next poll primes again
+        return messages
+
+    async def page(self, app: FastAPI, thread_id: str, num: int, before: datetime.datetime = None) -> tuple:
+        """
+        Answer a history page from the cache.
+        :return: (messages, next_cursor) or None if the page reaches past what is cached
+        """
+        messages = await self.recent(app, thread_id)
+        complete = len(messages) < self.size # the cache holds the whole thread
+        if before is not None:
+            messages = [m for m in messages if _timestamp(m["timestamp"]) < before]
+        if len(messages) < num and not complete:
+            return None
+        page = messages[-num:]
+        has_more = len(messages) > num or not complete
+        return page, page[0]["timestamp"] if has_more and page else None
+
+history_cache = HistoryCache(
+    size=config["redis"].get("history_cache_size", 100),
+    ttl=config["redis"].get("history_cache_ttl", 86400)
+    )
@@ -11,4 +11,11 @@ class InvalidParameter(Exception):
 class GoogleOauthFaliure(Exception):
     def __init__(self, message):
         self.message = message
-        super().__init__(self.message)
\ No newline at end of file
+        super().__init__(self.message)
+
+class AdmissionRejected(Exception):
+    def __init__(self, message, status: int = 429, retry_after: float = 1):
+        self.message = message
+        self.status = status # 429 overloaded or rate limited, 409 thread busy
+        self.retry_after = retry_after # seconds
+        super().__init__(self.message)
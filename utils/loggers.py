@@ -1,19 +1,183 @@
 
+import atexit
+import gzip
+import json
 import logging
-import yaml
-import sys
 import os
-from typing import TypedDict
+import queue
+import shutil
+import threading
+import time
 from datetime import datetime
+from utils.config import config
+
+logger = logging.getLogger(__name__)
+
+class JsonlSink:
+    """
+    Appends records to a JSON Lines file from a background thread.
+    `write` only puts the record on a bounded queue, serialization, disk writes, fsyncs and
+    rotation all happen on the writer thread, so callers never wait on the disk.
+    :param path: file to append to
+    :param max_queue: records buffered before the overflow policy applies
+    :param policy: "drop" discards records when the queue is full, "block" waits up to `block_timeout` first
+    :param batch_size: maximum records written per loop
+    :param fsync_interval: seconds between fsyncs, records are flushed to the OS every batch either way
+    :param max_bytes: rotate once the file is this large, 0 disables
+    :param rotate_interval: rotate once the sink has had the file open this many seconds, 0 disables
+    :param compress: gzip rotated files
+    :param max_backoff: longest wait in seconds before retrying the file after an OSError (disk
+        full, permissions), records queued meanwhile are subject to the overflow policy
+    """
+    def __init__(
+            self,
+            path: str,
+            max_queue: int = 10000,
+            policy: str = "drop",
+            block_timeout: float = 0.05,
+            batch_size: int = 512,
+            fsync_interval: float = 1.0,
+            max_bytes: int = 64 * 1024 * 1024,
+            rotate_interval: float = 86400,
+            compress: bool = True,
+            max_backoff: float = 30.0):
+        self.path = path
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.fsync_interval = fsync_interval
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.max_backoff = max_backoff
+        self.queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0 # OSErrors writing, syncing or rotating the file
+        self._closed = False
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name=f"jsonl-sink:{os.path.basename(path)}", daemon=True)
+        self._thread.start()
+
+    def write(self, record: dict) -> bool:
+        """Queue a record. Returns False if it was dropped because the queue was full."""
+        try:
+            if self.policy == "block":
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout: float = 5):
+        """Write out everything queued and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self.queue.put(None) # sentinel, may wait if the queue is full
+        self._thread.join(timeout)
+
+    def _open(self):
+        # opened now: the file's mtime moves with every append, so it can't tell the file's age
+        return open(self.path, "a", encoding="utf-8"), time.time()
+
+    def _rotate(self, f):
+        f.close()
+        rotated = f"{self.path}.{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+        if os.path.exists(rotated) or os.path.exists(f"{rotated}.gz"): # rotated twice within a second
+            rotated = f"{rotated}-{time.time_ns()}"
+        os.replace(self.path, rotated)
+        if self.compress:
+            with open(rotated, "rb") as src, gzip.open(f"{rotated}.gz", "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(rotated)
+        return self._open()
+
+    def _run(self):
+        f, opened = None, 0.0
+        last_fsync = time.monotonic()
+        backoff = 0.0
+        stopping = False
+        while not stopping:
+            try:
+                batch = [self.queue.get(timeout=self.fsync_interval)]
+            except queue.Empty:
+                batch = []
+            while batch and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch: # close() was called
+                stopping = True
+                batch = [r for r in batch if r is not None]
+
+            try:
+                lines = "".join(json.dumps(record, default=str) + "\n" for record in batch)
+            except (TypeError, ValueError) as e:
+                self.dropped += len(batch)
+                logger.warning("failed to serialize %d records for %s: %r", len(batch), self.path, e)
+                batch, lines = [], ""
+
+            try:
+                if f is None:
+                    f, opened = self._open()
+                if batch:
+                    f.write(lines)
+                    f.flush()
+                    self.written += len(batch)
+                    batch = []
+                now = time.monotonic()
+                if stopping or now - last_fsync >= self.fsync_interval:
+                    os.fsync(f.fileno())
+                    last_fsync = now
+                if (self.max_bytes and f.tell() >= self.max_bytes) or (self.rotate_interval and f.tell() and time.time() - opened >= self.rotate_interval):
+                    rotating, f = f, None # _rotate closes it, reopened on the next loop if rotating fails
+                    f, opened = self._rotate(rotating)
+                backoff = 0.0
+            except OSError as e:
+                # the thread must survive, every later record would be queued and silently lost
+                self.errors += 1
+                self.dropped += len(batch)
+                backoff = min(self.max_backoff, backoff * 2 or 0.1)
+                logger.warning("writing %s failed, %d records dropped, retrying in %.1fs: %r", self.path, len(batch), backoff, e)
+                if f is not None:
+                    try:
+                        f.close()
+                    except OSError:
+                        pass
+                    f = None # reopened on the next loop
+                if not stopping:
+                    time.sleep(backoff)
+        if f is not None:
+            try:
+                f.close()
+            except OSError:
+                pass
+
+
+_sinks: dict[str, JsonlSink] = {} # one writer thread per file
+
+def get_sink(path: str, **kwargs) -> JsonlSink:
+    if path not in _sinks:
+        _sinks[path] = JsonlSink(path, **kwargs)
+    return _sinks[path]
+
+@atexit.register
+def _close_sinks():
+    for sink in _sinks.values():
+        sink.close()
 
-with open("config.yml", "r") as f: config = yaml.safe_load(f)
 
 class TrainingDataLogger:
     def __init__(self, name):
         self.name = name
-        self.log_file = f"{config['logging']["logs_dir"]}/{config['logging']['training']["file"]}"
+        self.log_file = f"{config['logging']['logs_dir']}/{config['logging']['training']['file']}"
+        sink_config = {k: v for k, v in config['logging']['training'].items() if k != "file"}
+        self.sink = get_sink(self.log_file, **sink_config)
 
     def log(self, data: dict):
         data["time"] = datetime.now().timestamp()
-        with open(self.log_file, "a") as f:
-            f.write(f"{dict(data)}\n")
\ No newline at end of file
+        self.sink.write(data)
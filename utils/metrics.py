@@ -0,0 +1,189 @@
+import asyncio
+import contextlib
+import functools
+import logging
+import time
+from typing import Callable
+from prometheus_client import Counter, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from langchain_core.callbacks import AsyncCallbackHandler
+from utils.cache import TTLCache
+from utils.config import config
+
+try:
+    from opentelemetry import trace
+except ImportError: # tracing is optional
+    trace = None
+
+logger = logging.getLogger(__name__)
+
+metrics_config = config.get("metrics", {})
+
+'''
+Latency instrumentation. Every stage of a turn is timed into one Prometheus histogram,
+`agent_stage_seconds{stage, name}`, and, with `metrics.tracing`, also opened as an OpenTelemetry
+span (the exporter is whatever OpenTelemetry SDK the process is started with). Graph nodes, model
+calls and tools are timed by `callback`, a LangChain callback handler the graph runs with, so new
+nodes and tools show up without changes. Counters the components already keep (router, prefetch,
+mirror, ...) are exported as gauges through `collector`. Everything is served by GET /metrics.
+'''
+
+tracer = trace.get_tracer("agent") if trace and metrics_config.get("tracing") else None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram("agent_stage_seconds", "Time spent in each stage of a turn", ["stage", "name"], buckets=LATENCY_BUCKETS)
+STAGE_ERRORS = Counter("agent_stage_errors_total", "Stages that raised", ["stage", "name"])
+FIRST_TOKEN_SECONDS = Histogram("agent_first_token_seconds", "Time from the start of a model call to its first streamed token", ["model"], buckets=LATENCY_BUCKETS)
+TOKENS_PER_SECOND = Histogram("agent_output_tokens_per_second", "Output tokens per second of a model call", ["model"], buckets=(5, 10, 20, 40, 80, 160, 320, 640))
+TOOL_CALLS_PER_TURN = Histogram("agent_tool_calls_per_turn", "Tool calls made in one turn", buckets=(0, 1, 2, 3, 5, 8, 13, 21))
+STREAM_FIRST_BYTE = Histogram("chat_stream_first_byte_seconds", "Time from the start of a /chat stream to its first frame", buckets=LATENCY_BUCKETS)
+
+@contextlib.contextmanager
+def span(stage: str, name: str = "", **attributes):
+    """Time a block as `stage`/`name`, usable in sync and async code."""
+    otel = tracer.start_as_current_span(f"{stage} {name}".strip(), attributes=attributes) if tracer else contextlib.nullcontext()
+    start = time.perf_counter()
+    try:
+        with otel:
+            yield
+    except Exception:
+        STAGE_ERRORS.labels(stage, name).inc()
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage, name).observe(time.perf_counter() - start)
+
+def timed(stage: str, name: str = None):
+    """Decorator timing every call of an async function, `name` defaults to the function's."""
+    def decorator(func):
+        label = name or func.__name__
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(stage, label):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument(obj, stage: str, methods: list[str]):
+    """Time the given async methods of one object in place, e.g. a checkpointer built elsewhere."""
+    for method in methods:
+        setattr(obj, method, timed(stage, method)(getattr(obj, method)))
+    return obj
+
+
+class MetricsCallback(AsyncCallbackHandler):
+    """Times graph nodes, model calls (first token, tokens per second) and tools of every run it is passed to."""
+    def __init__(self):
+        self._runs = TTLCache(maxsize=10000, ttl=600) # run_id -> (stage, name, start, first token), runs that never end expire
+
+    def _start(self, run_id, stage: str, name: str):
+        self._runs.set(run_id, [stage, name, time.perf_counter(), None])
+
+    def _end(self, run_id, error: bool = False):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return None
+        stage, name, start, _ = run
+        STAGE_SECONDS.labels(stage, name).observe(time.perf_counter() - start)
+        if error:
+            STAGE_ERRORS.labels(stage, name).inc()
+        return run
+
+    async def on_chain_start(self, serialized, inputs, *, run_id, metadata=None, **kwargs):
+        node = (metadata or {}).get("langgraph_node")
+        if node and kwargs.get("name") == node: # the node itself, not the runnables inside it
+            self._start(run_id, "node", node)
+
+    async def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    async def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    async def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        self._start(run_id, "llm", (metadata or {}).get("ls_model_name") or (serialized or {}).get("name") or "model")
+
+    async def on_llm_new_token(self, token, *, run_id, **kwargs):
+        run = self._runs.get(run_id)
+        if run is not None and run[3] is None:
+            run[3] = time.perf_counter()
+            FIRST_TOKEN_SECONDS.labels(run[1]).observe(run[3] - run[2])
+
+    async def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._end(run_id)
+        if run is None:
+            return
+        usage = getattr(response.generations[0][0], "message", None) if response.generations and response.generations[0] else None
+        usage = getattr(usage, "usage_metadata", None)
+        elapsed = time.perf_counter() - (run[3] or run[2]) # generation time after the first token when streaming
+        if usage and usage.get("output_tokens") and elapsed > 0:
+            TOKENS_PER_SECOND.labels(run[1]).observe(usage["output_tokens"] / elapsed)
+
+    async def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    async def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, "tool", (serialized or {}).get("name") or kwargs.get("name") or "tool")
+
+    async def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    async def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+
+class StatsCollector:
+    """
+    Exports the stats dicts components already keep as gauges at scrape time.
+    A source registered with `label` returns {label value: {metric: number}} (e.g. the router's
+    per-route report), one without returns {metric: number or {key: number}}.
+    """
+    def __init__(self):
+        self.sources: dict[str, tuple[Callable[[], dict], str]] = {}
+
+    def register(self, name: str, source: Callable[[], dict], label: str = None):
+        self.sources[name] = (source, label)
+
+    def collect(self):
+        for name, (source, label) in list(self.sources.items()):
+            try:
+                stats = source()
+            except Exception as e:
+                logger.warning("collecting %s stats failed: %r", name, e)
+                continue
+            families = {}
+            def sample(metric: str, labels: dict, value):
+                if isinstance(value, bool):
+                    value = int(value)
+                if not isinstance(value, (int, float)):
+                    return
+                family = families.get(metric)
+                if family is None:
+                    family = families[metric] = GaugeMetricFamily(f"agent_{name}_{metric}", f"{name} {metric}", labels=list(labels))
+                family.add_metric(list(labels.values()), value)
+            for key, value in (stats or {}).items():
+                if label:
+                    for metric, v in (value or {}).items():
+                        sample(metric, {label: str(key)}, v)
+                elif isinstance(value, dict):
+                    for k, v in value.items():
+                        sample(key, {"key": str(k)}, v)
+                else:
+                    sample(key, {}, value)
+            yield from families.values()
+
+
+async def probe_redis(redis, interval: float = 15.0):
+    """Time a PING every `interval` seconds as stage "redis", run it as a background task."""
+    while True:
+        try:
+            with span("redis", "ping"):
+                await redis.ping()
+        except Exception as e:
+            logger.warning("redis ping failed: %r", e)
+        await asyncio.sleep(interval)
+
+
+callback = MetricsCallback()
+collector = StatsCollector()
+REGISTRY.register(collector)
@@ -1,6 +1,6 @@
 from pydantic import BaseModel, Field
 from typing_extensions import TypedDict
-from typing import Optional, Annotated
+from typing import Optional, Annotated, Union
 import json
 import pprint
 
@@ -9,6 +9,11 @@ class Response(BaseModel):
     data: str | list | dict | None = None
     error: str | None = None
 
+class History(BaseModel):
+    data: list | None = None
+    next_cursor: str | None = None
+    error: str | None = None
+
 class Token(BaseModel):
     token: str | None = None
     error: str | None = None
@@ -54,6 +59,28 @@ class DeleteEvent(TypedDict):
     # eventId: str = Field(description="The ID of the event")
     eventId: Annotated[str, 'The ID of the event']
 
+class WorkingHours(TypedDict):
+    """Input schema for the part of each day slots may fall in"""
+    start: Annotated[str, 'Local start of the working day, "HH:MM". The default is "09:00".']
+    end: Annotated[str, 'Local end of the working day, "HH:MM". The default is "17:00".']
+
+class FindSlots(TypedDict):
+    """Input schema for finding free time slots"""
+    timeMin: Annotated[str, 'Start of the range to search. Must be an RFC3339 timestamp with mandatory time zone offset, for example, 2011-06-03T10:00:00-07:00.']
+    timeMax: Annotated[str, 'End of the range to search. Must be an RFC3339 timestamp with mandatory time zone offset.']
+    durationMinutes: Annotated[int, 'Length of the slot needed, in minutes']
+    calendars: Optional[Annotated[list[str], 'Calendar IDs (e.g. email addresses) that must all be free. The default is ["primary"].']]
+    timeZone: Optional[Annotated[str, 'IANA time zone the working hours are in, e.g. "America/Denver". The default is the user\'s time zone.']]
+    workingHours: Optional[Annotated[WorkingHours, 'Hours of the day slots may fall in. The default is 09:00 to 17:00.']]
+    includeWeekends: Optional[Annotated[bool, 'Whether Saturdays and Sundays are searched. The default is false.']]
+    bufferMinutes: Optional[Annotated[int, 'Minutes to keep free before and after every busy period. The default is 0.']]
+    maxSlots: Optional[Annotated[int, 'Maximum number of slots returned. The default is 5.']]
+
+class Operation(TypedDict):
+    """One action of a batched calendar tool call"""
+    action: Annotated[str, "Either 'create', 'get', 'get_many', 'update', 'delete', or 'find_slots'"]
+    kwargs: Annotated[Union[CreateEvent, GetEvent, UpdateEvent, DeleteEvent, GetManyEvents, FindSlots], 'Keyword arguments for the action']
+
 # def rep_schema():
 #     # test1 = str(TimeBlock.__annotations__).replace("typing.Annotated[","").replace("typing.Optional[","[Optional, ").replace("[[","[").replace("]]","]")
 #     objects = {"TimeBlock": TimeBlock, "create": CreateEvent, "get_many": GetManyEvents, "get": GetEvent, "update": UpdateEvent, "delete": DeleteEvent} #{" GetEvent, UpdateEvent, DeleteEvent}
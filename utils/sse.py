@@ -0,0 +1,265 @@
+import asyncio
+import collections
+import json
+import logging
+import statistics
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+from utils import metrics as prometheus
+
+logger = logging.getLogger(__name__)
+
+'''
+Server-sent events for the /chat stream. A turn is consumed as (event, data) pairs and written as
+SSE frames:
+
+    event: token
+    data: {"text": "You have two meetings"}
+
+Tokens are coalesced: they are buffered until `max_bytes` of text are waiting or `max_delay`
+seconds have passed since the first of them, so a fast model doesn't cost one write per token.
+Any other event (tool_start, tool_end) flushes the buffer first, so the order is kept. The stream
+ends with a `done` event, or an `error` event if the turn failed, and sends a comment line as a
+heartbeat after `heartbeat` seconds without a frame so proxies keep the connection open.
+When the client disconnects the turn is cancelled, so it stops spending model tokens and
+calendar quota on an answer nobody reads.
+'''
+
+def frame(event: str, data: Any) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n".encode()
+
+HEARTBEAT = b": ping\n\n"
+
+_END = object() # producer finished
+
+_closing = set() # streams shutting down, referenced until their cleanup ran
+
+
+class StreamMetrics:
+    """Counters of one stream."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_byte = None # seconds from start to the first frame
+        self.duration = None
+        self.frames = 0
+        self.bytes = 0
+        self.chunks = 0 # token chunks received from the model, before coalescing
+        self.heartbeats = 0
+        self.error = False
+        self.cancelled = False # stopped before the turn finished
+
+    def sent(self, data: bytes):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter() - self.started
+        self.frames += 1
+        self.bytes += len(data)
+
+
+class StreamStats:
+    """
+    Aggregate metrics of the streams served by this worker.
+    :param window: number of recent streams kept for the latency percentiles
+    """
+    def __init__(self, window: int = 1000):
+        self.streams = 0
+        self.active = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.frames = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.heartbeats = 0
+        self.first_byte = collections.deque(maxlen=window)
+        self.durations = collections.deque(maxlen=window)
+
+    def record(self, metrics: StreamMetrics):
+        self.streams += 1
+        self.errors += metrics.error
+        self.cancelled += metrics.cancelled
+        self.frames += metrics.frames
+        self.bytes += metrics.bytes
+        self.chunks += metrics.chunks
+        self.heartbeats += metrics.heartbeats
+        if metrics.first_byte is not None:
+            self.first_byte.append(metrics.first_byte)
+            prometheus.STREAM_FIRST_BYTE.observe(metrics.first_byte)
+        self.durations.append(metrics.duration)
+
+    def summary(self) -> dict:
+        first_byte = sorted(self.first_byte)
+        return {
+            "streams": self.streams,
+            "active": self.active,
+            "errors": self.errors,
+            "cancelled": self.cancelled,
+            "p50_first_byte": statistics.median(first_byte) if first_byte else 0.0,
+            "p95_first_byte": first_byte[int(len(first_byte) * 0.95)] if first_byte else 0.0,
+            "bytes_per_frame": self.bytes / self.frames if self.frames else 0.0,
+            "chunks_per_frame": self.chunks / self.frames if self.frames else 0.0,
+            "frames": self.frames,
+            "heartbeats": self.heartbeats
+        }
+
+
+class SSEStream:
+    """
+    Async iterator of SSE frames for one turn.
+    :param events: async iterator of (event, data) pairs, token data is {"text": str}
+    :param max_bytes: coalesced token text flushed once it reaches this many bytes
+    :param max_delay: seconds a token waits in the buffer at most
+    :param heartbeat: seconds without a frame before a heartbeat comment is sent, 0 disables
+    :param stats: StreamStats the stream's metrics are added to when it ends
+    :param disconnected: async callable polled every `poll` seconds, True stops the turn
+    :param on_close: async callable awaited once the stream ends, however it ends
+    """
+    def __init__(
+            self,
+            events: AsyncIterator[tuple[str, Any]],
+            max_bytes: int = 256,
+            max_delay: float = 0.05,
+            heartbeat: float = 15.0,
+            stats: StreamStats = None,
+            disconnected: Callable[[], Awaitable[bool]] = None,
+            poll: float = 1.0,
+            on_close: Callable[[], Awaitable[None]] = None):
+        self.events = events
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.heartbeat = heartbeat
+        self.stats = stats
+        self.disconnected = disconnected
+        self.poll = poll
+        self.on_close = on_close
+        self.metrics = StreamMetrics()
+        self.started = False
+
+    async def _produce(self, queue: asyncio.Queue):
+        try:
+            async for item in self.events:
+                await queue.put(item)
+            await queue.put(_END)
+        except Exception:
+            logger.exception("chat stream failed")
+            await queue.put(("error", {"message": "The response failed, please try again."}))
+            await queue.put(_END)
+
+    def _send(self, data: bytes) -> bytes:
+        self.metrics.sent(data)
+        return data
+
+    async def __aiter__(self):
+        self.started = True
+        queue = asyncio.Queue()
+        producer = asyncio.create_task(self._produce(queue))
+        if self.stats:
+            self.stats.active += 1
+        buffer, pending, buffered_at = [], 0, None # token text waiting, its size in bytes, arrival of the first of it
+        last_sent = next_poll = time.perf_counter()
+        try:
+            while True:
+                deadlines = []
+                if buffer:
+                    deadlines.append(buffered_at + self.max_delay)
+                elif self.heartbeat:
+                    deadlines.append(last_sent + self.heartbeat)
+                if self.disconnected:
+                    deadlines.append(next_poll)
+                timeout = max(0.0, min(deadlines) - time.perf_counter()) if deadlines else None
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    now = time.perf_counter()
+                    if self.disconnected and now >= next_poll:
+                        next_poll = now + self.poll
+                        if await self.disconnected():
+                            self.metrics.cancelled = True
+                            return
+                    if buffer and now >= buffered_at + self.max_delay:
+                        yield self._send(frame("token", {"text": "".join(buffer)}))
+                        buffer, pending = [], 0
+                        last_sent = time.perf_counter()
+                    elif not buffer and self.heartbeat and now >= last_sent + self.heartbeat:
+                        self.metrics.heartbeats += 1
+                        yield HEARTBEAT # comments aren't counted as frames
+                        last_sent = time.perf_counter()
+                    continue
+
+                if item is not _END and item[0] == "token":
+                    self.metrics.chunks += 1
+                    if not buffer:
+                        buffered_at = time.perf_counter()
+                    buffer.append(item[1]["text"])
+                    pending += len(item[1]["text"].encode())
+                    if pending < self.max_bytes:
+                        continue
+                    item = None # buffer is full, flush it below
+                if buffer:
+                    yield self._send(frame("token", {"text": "".join(buffer)}))
+                    buffer, pending = [], 0
+                    last_sent = time.perf_counter()
+                if item is _END:
+                    break
+                if item is not None:
+                    if item[0] == "error":
+                        self.metrics.error = True
+                    yield self._send(frame(*item))
+                    last_sent = time.perf_counter()
+            if not self.metrics.error:
+                yield self._send(frame("done", {}))
+        finally:
+            # in its own task: when the response is torn down this generator is being cancelled
+            # itself and couldn't wait for the turn to stop
+            task = asyncio.create_task(self._close(producer))
+            _closing.add(task)
+            task.add_done_callback(_closing.discard)
+
+    async def abandon(self):
+        """Run on_close for a stream whose body was never iterated, nothing else would."""
+        if self.started:
+            return
+        self.started = True
+        if hasattr(self.events, "aclose"): # the turn never started, don't leave its generator pending
+            await self.events.aclose()
+        if self.on_close:
+            await self.on_close()
+
+    async def _close(self, producer: asyncio.Task):
+        if not producer.done():
+            self.metrics.cancelled = True
+            producer.cancel() # the client went away, stop the turn's model and tool calls too
+        try:
+            await producer # the turn has stopped before on_close runs, e.g. before its thread is unlocked
+        except asyncio.CancelledError:
+            pass
+        self.metrics.duration = time.perf_counter() - self.metrics.started
+        if self.stats:
+            self.stats.active -= 1
+            self.stats.record(self.metrics)
+        if self.on_close:
+            try:
+                await self.on_close()
+            except Exception:
+                logger.exception("closing the chat stream failed")
+
+
+class SSEResponse(StreamingResponse):
+    """
+    Response for an SSEStream. Starlette only iterates the body once the headers are sent: when
+    the client is gone by then, or sending them fails, the stream's on_close (releasing the turn's
+    admission ticket) still runs.
+    """
+    def __init__(self, stream: SSEStream, headers: dict = None):
+        super().__init__(
+            stream,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **(headers or {})} # keep proxies (nginx) from buffering the stream
+            )
+        self.stream = stream
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.stream.abandon()